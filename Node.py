@@ -7,6 +7,9 @@ utilization of those resources (CPU, RAM, disk, and network).'''
 import logging
 import functools
 
+import metrics
+import scoring
+
 
 # include this so nodes can be "sorted" as objects
 @functools.total_ordering
@@ -18,6 +21,19 @@ class Node:
 
     shown = False
 
+    # how much of a node a VM takes up (an overcommit.Feasibility);
+    # None charges every VM its full maxcpu/maxmem
+    feasibility = None
+
+    # placement constraints for the current packing run, if any
+    # (a constraints.ConstraintState, set up by packing.pack_setup)
+    constraints = None
+
+    # where VMs' disks are (a storage.StorageMap), if known; packing
+    # binds it to a storage.StorageState for each run, like constraints
+    storage = None
+    storage_state = None
+
     weight = {
         'mem':  1.0,
         'disk': 0.0,   # This will be normalized to GB (not bytes
@@ -94,109 +110,133 @@ class Node:
 
 
     def show(self):
-        '''Pretty print a node, for use in tables and reports and such'''
+        '''Pretty print a node, for use in tables and reports and such
+        (see report.py)'''
+
+        import report
 
         if not Node.shown:
             Node.shown = True
-            print(Node.fmt.format(
-                name=self.dash(25),
-                cpu=self.dash(3),
-                maxcpu=self.dash(2),
-                cpu_perc=self.dash(2),
-                maxmem=self.dash(3),
-                mem_perc=self.dash(2),
-                score=self.dash(15),
-            ))
-
-        print(Node.fmt.format(
-            name     = self.id,
-            cpu      = '{:>02.1f}'.format(self.cpu),
-            maxcpu   = '{:>2}'.format(self.maxcpu),
-            cpu_perc = '{:>2.0f}'.format(float( float(self.cpu)/float(self.maxcpu)*100)),
-            maxmem   = '{:>3.0f}'.format(int(self.maxmem_gb)),
-            mem_perc = '{:>2.0f}'.format(float( float(self.mem)/float(self.maxmem)*100)),
-            score    = self.score(full=True)
-
-            #cpu      = '{d}'.format(self.cpu),
-            #maxcpu   = '{d}'.format(self.maxcpu),
-            #maxmem   = '{>3d}'.format(self.maxmem / 2**30),
-            #cpu_perc = '{>4.2f}'.format(float( float(self.cpu)/float(self.maxcpu )*100) ),
-            #mem_perc = '{>4.2f}'.format(float( float(self.mem)/float(self.maxmem )*100) ),
-            #score    = score_node(name,loadout, mode='total', output='full'),
-        ))
-
-
-    def allocate(self, vm, force=False):
+            print(report.node_header())
+
+        print(report.node_line(self))
+
+
+    def row(self):
+        '''The node's status as a flat dict, for reports'''
+        return {
+            'node':      self.name,
+            'status':    self.status,
+            'cpu':       self.cpu,
+            'maxcpu':    self.maxcpu,
+            'mem_gb':    round(self.mem_gb, 3),
+            'maxmem_gb': round(self.maxmem_gb, 3),
+            'score':     self.score(),
+        }
+
+
+    def allocate(self, vm, force=False, record=True):
         '''Allocate a VM to a node, if there is space.  "Free" resources
         are deducted accordingly.  True is returned if the node was
         allocated; False is returned otherwise.  If a vm is allocated,
         the self.allocated_vms list is updated accordingly with a copy
-        of the VMa.'''
+        of the VMa.  record=False leaves it out of the allocation
+        metrics (for replaying a placement, not making one).'''
 
-        if force or self.has_space(vm, quiet=False):
-            self.freemem -= vm.maxmem
+        if force or (self.allows(vm) and self.has_space(vm, quiet=False)):
+            mem, cpu = self.demand(vm)
+            self.freemem -= mem
             self.freemem_gb = self.freemem/2**30
-            self.freecpu -= vm.maxcpu
+            self.freecpu -= cpu
             self.allocated_vms.append(vm)
+            scoring.invalidate(self)
+            if self.constraints is not None:
+                self.constraints.place(vm, self)
+            if self.storage_state is not None:
+                self.storage_state.place(vm, self)
             if force:
                 self.log.debug("  %s placement on %s forced.", vm.name, self.name)
+            if record:
+                metrics.ALLOCATIONS.inc(result='forced' if force else 'placed')
             return True
+        if record:
+            metrics.ALLOCATIONS.inc(result='rejected')
         return False
 
 
+    def deallocate(self, vm):
+        '''Undo allocate(): remove the VM and give its resources back.'''
+
+        self.allocated_vms.remove(vm)
+        mem, cpu = self.demand(vm)
+        self.freemem += mem
+        self.freemem_gb = self.freemem/2**30
+        self.freecpu += cpu
+        scoring.invalidate(self)
+        if self.constraints is not None:
+            self.constraints.unplace(vm, self)
+        if self.storage_state is not None:
+            self.storage_state.unplace(vm, self)
+
+
+    def allows(self, vm):
+        '''True if no placement constraint keeps the vm off this node,
+        and the node can reach the vm's disks'''
+        if self.constraints is not None and not self.constraints.allows(vm, self):
+            self.log.debug("    %s not allowed on %s by constraints", vm.name, self.name)
+            return False
+        if self.storage_state is not None and not self.storage_state.allows(vm, self):
+            self.log.debug("    %s can't reach its storage from %s", vm.name, self.name)
+            return False
+        return True
+
+
+
+    def demand(self, vm):
+        '''(memory bytes, cpus) that the vm would take up on this node'''
+        if Node.feasibility is None:
+            return vm.maxmem, vm.maxcpu
+        return Node.feasibility.demand(vm, self)
+
 
     def has_space(self, vm, quiet=False):
         '''Takes a vm, and returns True/False if there is space for it'''
+        mem, cpu = self.demand(vm)
         if not quiet:
             mem_delta = self.freemem/2**30 - self.minfreemem/2**30
             cpu_delta = self.freecpu - self.minfreecpu
             self.log.debug("    {} (M{:>.1f}-m{:>.1f}=F{:>.1f}) > v{:>.1f}  and (n{}-{}={}) > v{}".format(
                 self.name,
-                self.freemem/2**30, self.minfreemem/2**30, mem_delta, vm.maxmem_gb,
-                self.freecpu, self.minfreecpu, cpu_delta, vm.maxcpu))
-        if self.freemem - self.minfreemem > vm.maxmem:
-            if self.freecpu - self.minfreecpu > vm.maxcpu:
-                return True
+                self.freemem/2**30, self.minfreemem/2**30, mem_delta, mem/2**30,
+                self.freecpu, self.minfreecpu, cpu_delta, cpu))
+        if self.freemem - self.minfreemem > mem:
+            if self.freecpu - self.minfreecpu > cpu:
+                # local disks are a resource too
+                return self.storage_state is None or self.storage_state.has_space(vm, self)
         return False
 
 
-    def score(self, full=False, mode='total', biased=True):
+    def score(self, mode='total', biased=True):
         '''"Score" the node, based on various resource usage, weighting,
         and bias.  Generally speaking, the score is the weighted %actual
-        usage plus a bias for the node (if any)'''
+        usage plus a bias for the node (if any).  See scoring.py for the
+        modes.  Returns a float.'''
 
-        score = 0.0
+        return scoring.score_nodes([self], mode=mode, biased=biased)[0]
 
-        scores = {
-            'cpu': 0.0,
-            'mem': 0.0,
-            'net': 0.0,
-            'disk': 0.0,
-            'vm': 0.0,
-            'bias': self.bias if biased else 0.0,
-        }
 
-        if mode in [ 'total', 'node']:
-            # metrics we care about
-            cpu    = self.cpu
-            maxcpu = self.maxcpu
-            maxmem = self.maxmem
-            mem    = self.mem
-            #net    = node['netin'] + node['netout']
-            #disk   = node['diskread'] + node['diskwrite']
+    def score_parts(self, mode='total', biased=True):
+        '''The weighted components that make up score()'''
+
+        return scoring.node_score(self, mode=mode, biased=biased)[1]
 
-            scores['cpu'] = cpu/maxcpu * Node.weight['cpu']
-            scores['mem'] = mem/maxmem * Node.weight['mem']
 
-        score = sum(scores.values())
+    def score_str(self, full=False, mode='total', biased=True):
+        '''score(), formatted for display'''
 
+        score = self.score(mode=mode, biased=biased)
         if full:
-            return '{: 6.3f} = {: 5.3f} + {: 5.3f} + {:3.1f}'.format(
-                score,
-                scores['cpu'],
-                scores['mem'],
-                scores['bias'],
-            )
+            return scoring.format_parts(score, self.score_parts(mode=mode, biased=biased))
         return '{:>.3f}'.format(score)
 
 
@@ -8,9 +8,9 @@ class PVE():
     '''Class for a connection to a cluster. Fetches JSON output of node and VM infomration.'''
 
 
-    def __init__(self, host=None, u=None, pw=None, excludes=None):
+    def __init__(self, host=None, u=None, pw=None, excludes=None, client=None, **client_options):
 
-        import proxmoxer
+        from PVEClient import PVEClient, AuthenticationError, APIError
 
 
         self.log = logging.getLogger(__name__)
@@ -20,21 +20,21 @@ class PVE():
         self.nodes = None
         self.nodeobj = None
         self.vms = None
-        self.excludes = excludes
+        self.excludes = excludes or []
 
 
-        # Connect to the API, and return a connection handler for later use
+        # Connect to the API, and keep the connection handler for later use
         try:
-            self.proxmox = proxmoxer.ProxmoxAPI(host, user=u, password=pw)
+            self.api = client or PVEClient(host, u, pw, **client_options)
+            self.api.login()
 
-        except proxmoxer.backends.https.AuthenticationError as e:
+        except AuthenticationError as e:
             self.log.error("Authention error: {}".format(e))
             sys.exit(1)
 
-        except Exception as e:
+        except (APIError, OSError) as e:
             self.log.error("Unhandled Exception of type {} occured: {}".format(type(e), str(e)))
             sys.exit(1)
-            #log.error("Authention error: %s" % str(e))
 
 
 
@@ -48,7 +48,7 @@ class PVE():
             self.nodes = []
             self.nodeobj = []
 
-            for node in self.proxmox.nodes.get():
+            for node in self.api.get('nodes'):
 
                 if node['node'] in self.excludes:
                     self.log.info("Excluding node {} on request.".format(node['node']))
@@ -70,7 +70,7 @@ class PVE():
         if self.vms is None:
             self.vms = []
 
-            for vm in self.proxmox.cluster.resources.get(type='vm'):
+            for vm in self.api.get('cluster/resources', type='vm'):
                 self.log.debug("VM={}".format(str(vm)))
                 if vm['name'] in self.excludes:
                     self.log.info('Excluding vm {} by request.'.format(vm['name']))
@@ -90,3 +90,46 @@ class PVE():
             return [vm for vm in self.vms if (filter_node is None or vm.node == filter_node)]
 
         return [vm.name for vm in self.vms if (filter_node is None or vm.node == filter_node)]
+
+
+    def get_storage(self, allow_local_migration=False):
+        '''Fetch node storages and VM disk locations, as a storage.StorageMap'''
+        import storage
+
+        self.log.debug("Getting storage.")
+
+        return storage.StorageMap.collect(self.api, self.get_nodes(full=True), self.get_vms(full=True),
+                                          allow_local_migration=allow_local_migration)
+
+
+    def migrate(self, vm, target, online=True, with_local_disks=False):
+        '''Start migrating a VM to node target.  Returns the task's UPID.'''
+
+        params = {'target': target}
+        if vm.status == 'running':
+            if getattr(vm, 'type', 'qemu') == 'lxc':
+                params['restart'] = 1
+            elif online:
+                params['online'] = 1
+        if with_local_disks:
+            params['with-local-disks'] = 1
+
+        self.log.debug("Migrating %s from %s to %s", vm.name, vm.node, target)
+
+        return self.api.post('nodes/{}/{}/{}/migrate'.format(vm.node, getattr(vm, 'type', 'qemu'), vm.vmid), **params)
+
+
+    def task_status(self, node, upid):
+        '''Status dict of a task: "status" is running or stopped, and
+        "exitstatus" is OK when it stopped successfully'''
+
+        return self.api.get('nodes/{}/tasks/{}/status'.format(node, upid))
+
+
+    def get_rrddata(self, vm, timeframe='week', cf='AVERAGE'):
+        '''Fetch the rrd history (list of sample dicts) for a VM'''
+
+        self.log.debug("Getting rrddata for %s (%s/%s).", vm.name, timeframe, cf)
+
+        return self.api.get('nodes/{}/{}/{}/rrddata'.format(vm.node, vm.type, vm.vmid),
+                            timeframe=timeframe, cf=cf)
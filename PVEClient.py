@@ -0,0 +1,170 @@
+'''Thin client for the Proxmox REST API, shared by PVE.py and the
+dump/collection scripts.  Keeps one pooled HTTPS session, caches the
+auth ticket on disk between runs, retries idempotent GETs and caps the
+number of calls in flight.'''
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cachedir import cache_dir
+import metrics
+
+
+# PVE tickets are good for two hours; stop trusting a cached one a
+# little before that so it can't expire mid-run.
+TICKET_LIFETIME = 2 * 60 * 60
+TICKET_MARGIN = 10 * 60
+
+
+class APIError(Exception):
+    '''Raised when the API returns an error.'''
+
+class AuthenticationError(APIError):
+    '''Raised when logging in fails.'''
+
+
+
+class PVEClient:
+    '''Connection to a single Proxmox API endpoint.'''
+
+    def __init__(self, host, user, password, port=8006, scheme='https', verify=True,
+                 timeout=30, retries=3, backoff=0.5, max_concurrent=4, ticket_cache=True):
+
+        self.log = logging.getLogger(__name__)
+
+        self.host = host
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.base_url = '{}://{}:{}/api2/json'.format(scheme, host, port)
+
+        self.ticket = None
+        self.csrf = None
+        self.ticket_time = 0
+        self.ticket_file = None
+
+        if ticket_cache:
+            digest = hashlib.sha1('{} {}'.format(self.base_url, user).encode()).hexdigest()
+            self.ticket_file = os.path.join(cache_dir('tickets'), '{}.json'.format(digest))
+
+        # Only GETs are retried; a POST (login, migrate) might have
+        # taken effect even though the response was lost.
+        retry = Retry(total=retries, backoff_factor=backoff, allowed_methods=['GET'],
+                      status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+
+
+    def login(self, force=False):
+        '''Make sure we hold a valid ticket, fetching a new one only if
+        the cached one is missing or close to expiring.'''
+
+        with self.lock:
+            if not force and self.ticket is None:
+                self._load_ticket()
+
+            if not force and self.ticket and time.time() < self.ticket_time + TICKET_LIFETIME - TICKET_MARGIN:
+                return
+
+            self.log.debug("Requesting new ticket for %s from %s", self.user, self.host)
+
+            with self.slots:
+                response = self.session.post(self.base_url + '/access/ticket', timeout=self.timeout,
+                                             data={'username': self.user, 'password': self.password})
+
+            if response.status_code != 200:
+                raise AuthenticationError("{} {}".format(response.status_code, response.reason))
+
+            try:
+                data = response.json()['data']
+                self.ticket = data['ticket']
+                self.csrf = data['CSRFPreventionToken']
+            except (ValueError, KeyError, TypeError):
+                raise AuthenticationError("Unexpected login response from {}".format(self.host))
+
+            self.ticket_time = time.time()
+            self._save_ticket()
+
+        self.session.cookies.set('PVEAuthCookie', self.ticket)
+
+
+    def _load_ticket(self):
+        if not self.ticket_file:
+            return
+        try:
+            with open(self.ticket_file) as fp:
+                cached = json.load(fp)
+            self.ticket = cached['ticket']
+            self.csrf = cached['csrf']
+            self.ticket_time = cached['time']
+            self.session.cookies.set('PVEAuthCookie', self.ticket)
+            self.log.debug("Using cached ticket from %s", self.ticket_file)
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+    def _save_ticket(self):
+        if not self.ticket_file:
+            return
+
+        tmp = '{}.{}'.format(self.ticket_file, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'ticket': self.ticket, 'csrf': self.csrf, 'time': self.ticket_time}, fp)
+        os.replace(tmp, self.ticket_file)
+
+
+    def request(self, method, path, params=None, data=None):
+        '''Issue an API call and return the "data" member of the reply.
+        A 401 (e.g. a cached ticket revoked server side) triggers one
+        fresh login and a retry.'''
+
+        self.login()
+
+        for attempt in (1, 2):
+            headers = {}
+            if method != 'GET':
+                headers['CSRFPreventionToken'] = self.csrf
+
+            with self.slots, metrics.API_SECONDS.time(method=method):
+                response = self.session.request(method, '{}/{}'.format(self.base_url, path.strip('/')),
+                                                params=params, data=data, headers=headers,
+                                                timeout=self.timeout)
+
+            if response.status_code == 401 and attempt == 1:
+                self.log.info("Ticket rejected by %s, logging in again", self.host)
+                self.login(force=True)
+                continue
+            break
+
+        if response.status_code != 200:
+            raise APIError("{} {} failed: {} {}".format(method, path, response.status_code, response.reason))
+
+        return response.json()['data']
+
+
+    def get(self, path, **params):
+        return self.request('GET', path, params=params)
+
+
+    def post(self, path, **data):
+        return self.request('POST', path, data=data)
+
+
+    def close(self):
+        self.session.close()
@@ -5,6 +5,8 @@ import logging
 
 import functools
 
+import scoring
+
 #allow for sorting objects via arbitrary means.
 @functools.total_ordering
 class VM:
@@ -33,6 +35,15 @@ class VM:
         self.log = logging.getLogger(__name__)
         self.bias = bias
 
+        # how cpu/mem usage was arrived at: the instantaneous sample,
+        # or a percentile of the rrd history (see usage.py)
+        self.sizing = 'sample'
+
+        # network and disk I/O in bytes/sec, smoothed (see rates.py);
+        # the netin/diskread/... fields are counters since boot
+        self.net_rate = 0.0
+        self.disk_rate = 0.0
+
     def __str__(self):
         return self.name
 
@@ -52,18 +63,44 @@ class VM:
         return False
 
 
+    def set_usage(self, cpu, mem, sizing='sample'):
+        '''Replace the cpu/mem usage figures (e.g. with historical
+        percentiles), keeping the original sample around.'''
+        if self.sizing == 'sample':
+            self.cpu_sample = self.cpu
+            self.mem_sample = self.mem
+
+        self.cpu = cpu
+        self.mem = mem
+        self.mem_gb = float(self.mem / 2**30)
+        self.sizing = sizing
+        scoring.invalidate(self)
+
+
+    def set_rates(self, net, disk):
+        '''Set the network and disk I/O rates (bytes/sec)'''
+        self.net_rate = net
+        self.disk_rate = disk
+        scoring.invalidate(self)
+
+
     def show(self):
-        print(VM.fmt.format(
-            vmid     = self.vmid,
-            name     = self.name,
-            state    = ' ' if self.status == 'running' else '*',
-            cpu      = '{:>03.1f}'.format(self.cpu),
-            maxcpu   = '{:>2}'.format(self.maxcpu),
-            node     = '{:8}'.format(self.node),
-            cpu_perc = '{:>2.0f}'.format(float( float(self.cpu)/float(self.maxcpu)*100)),
-            maxmem   = '{:>3.0f}'.format(self.maxmem_gb),
-            score    = self.score(full=True),
-        ))
+        import report
+        print(report.vm_line(self))
+
+    def row(self):
+        '''The VM's status as a flat dict, for reports'''
+        return {
+            'vmid':      self.vmid,
+            'name':      self.name,
+            'node':      self.node,
+            'status':    self.status,
+            'cpu':       self.cpu,
+            'maxcpu':    self.maxcpu,
+            'mem_gb':    round(self.mem_gb, 3),
+            'maxmem_gb': round(self.maxmem_gb, 3),
+            'score':     self.score(),
+        }
 
     def area_perc(self):
         return float(self.mem_gb) * self.cpu
@@ -73,26 +110,18 @@ class VM:
         return float(self.maxmem_gb) * self.maxcpu
 
 
-    def score(self, biased=True, full=False):
+    def score(self, biased=True):
+        '''Weighted score of the VM (a float), see scoring.py'''
 
-        score = 0.0
+        return scoring.score_vms([self], biased=biased)[0]
 
-        scores = {
-            'cpu':  self.cpu      * VM.weight['cpu'],
-            'mem':  self.maxmem_gb * VM.weight['mem'],
-            'net':  0.0           * VM.weight['net'],
-            'disk': 0.0           * VM.weight['disk'],
-            'bias': self.bias if biased else 0.0,
-        }
 
-        score = sum(scores.values())
+    def score_str(self, biased=True, full=False):
+        '''score(), formatted for display'''
 
+        score = self.score(biased=biased)
 
         if full:
-            return '{:-6.3f} = {:6.3f} + {:6.3f} + {:3.1f}'.format(
-                score,
-                scores['cpu'],
-                scores['mem'],
-                scores['bias'],
-                )
+            parts = self.score_cache[(biased, scoring.weights_key(VM.weight))][1]
+            return scoring.format_parts(score, parts, fmt='{:-6.3f} = {:6.3f} + {:6.3f} + {:3.1f}')
         return '{:< 6.3f}'.format(score)
@@ -4,14 +4,20 @@
 import sys
 import json
 import copy
+import functools
 
 import logging
 import argparse
+import threading
 
 from PVE import PVE
 
 import packing
+import bounds
+import report
 import graphics
+import metrics
+import memprofile
 
 nodes = {}
 vms = {}
@@ -24,6 +30,17 @@ vms = {}
 #####################
 # Argument parsing
 
+def percentile(text):
+    '''-P: strictly between 0 and 100, as usage.P2Quantile needs'''
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a number: {}".format(text))
+    if not 0 < value < 100:
+        raise argparse.ArgumentTypeError("must be between 0 and 100, exclusive (e.g. 95, 99.9), not {}".format(text))
+    return value
+
+
 parser = argparse.ArgumentParser(
     description='''
 Exactly two arguments may be passed on the CLI.  The first
@@ -33,7 +50,46 @@ be a JSON dump of the VM definitions.
 
 parser.add_argument('-c', '--current', action='store_true', help="Only show current status.")
 parser.add_argument('-n', '--nopics',  action='store_true', help="Do not generate output picutres", default=False)
+parser.add_argument('--atlas', action='store', metavar='FILE', help="Write all pictures into one tiled PNG (strategies side by side) instead of one file per node", default=None)
 parser.add_argument('-a', '--allocated',action='store_true', help="Show allocated CPU/RAM, in addition to max usage", default=False)
+parser.add_argument('-P', '--percentile', action='store', type=percentile, help="Size VMs by this percentile of their rrd usage history (e.g. 50, 95, 99)", default=None)
+parser.add_argument('--timeframe', action='store', help="rrd history to use with --percentile (hour, day, week, month, year)", default='week')
+parser.add_argument('--usage-ttl', action='store', type=int, help="Seconds to cache percentile results per VM", default=3600)
+parser.add_argument('--rates', action='store_true', help="Work out VMs' network/disk I/O rates from their counters, against the last run's (see rates.py)", default=False)
+parser.add_argument('--rate-halflife', action='store', type=float, metavar='SECONDS', help="Smoothing half-life for --rates", default=300.0)
+parser.add_argument('-C', '--constraints', action='store', metavar='FILE', help="JSON file of placement constraints (affinity, anti-affinity, gangs, pinning)", default=None)
+parser.add_argument('--partition', action='store', choices=['pool', 'groups', 'shards'], help="Pack each pool / node group / shard separately, in parallel, then merge", default=None)
+parser.add_argument('--node-groups', action='store', metavar='FILE', help="JSON node-group config for --partition groups", default=None)
+parser.add_argument('--shards', action='store', type=int, help="Number of shards for --partition shards", default=4)
+parser.add_argument('--strategy', action='store', help="Packing routine used by --partition and --clusters", default='pack_size')
+parser.add_argument('--clusters', action='store', metavar='FILE', help="JSON list of clusters to fetch and pack, each on its own and all pooled (see clusters.py)", default=None)
+parser.add_argument('--absorb', action='append', metavar='A:B', help="With --clusters: could cluster B's nodes run cluster A's VMs too? (repeatable)", default=[])
+parser.add_argument('-F', '--failures', action='store', type=int, metavar='K', help="Simulate every combination of up to K failed nodes, and report stranded VMs", default=0)
+parser.add_argument('--failure-base', action='store', choices=['current', 'packed'], help="Placement to fail nodes from: current, or pack_size's", default='current')
+parser.add_argument('--scenario-limit', action='store', type=int, help="Maximum number of failure scenarios", default=10000)
+parser.add_argument('--feasibility', action='store', metavar='FILE', help="JSON overcommit/feasibility config (see overcommit.py)", default=None)
+parser.add_argument('--cpu-ratio', action='store', type=float, help="CPU overcommit ratio for every node", default=None)
+parser.add_argument('--mem-ratio', action='store', type=float, help="Memory overcommit ratio for every node", default=None)
+parser.add_argument('--usage-margin', action='store', type=float, metavar='MARGIN', help="Pack by observed usage plus this safety margin (e.g. 0.25), instead of allocations", default=None)
+parser.add_argument('--storage', action='store', metavar='FILE', help="JSON storage map (node storages and VM disks, see storage.py) to keep VMs on nodes that can reach their disks", default=None)
+parser.add_argument('--collect-storage', action='store_true', help="Fetch node storages and VM disks from the API, as for --storage", default=False)
+parser.add_argument('--allow-local-migration', action='store_true', help="Let plans move VMs with disks on local storage (copying the disks)", default=False)
+parser.add_argument('--balance-objective', action='store', choices=['max', 'variance'], help="What pack_balance evens out: the busiest node, or the spread of node loads", default='max')
+parser.add_argument('--rebalance', action='store_true', help="Have pack_balance start from the current placement and move VMs off busy nodes, rather than start from scratch", default=False)
+parser.add_argument('--max-moves', action='store', type=int, help="Most VMs --rebalance may move", default=None)
+parser.add_argument('--trials', action='store', type=int, metavar='N', help="Also pack by the best of N shuffled pack_size runs", default=0)
+parser.add_argument('--portfolio', action='store_true', help="Also pack with the best of many VM orderings x node policies, raced in parallel (see portfolio.py)", default=False)
+parser.add_argument('--improve', action='store', type=float, metavar='SECONDS', help="Polish each packing with local search for this long (see localsearch.py)", default=0)
+parser.add_argument('--improve-objective', action='store', choices=['nodes', 'balance'], help="What --improve aims for: fewer nodes used, or even load", default='nodes')
+parser.add_argument('--no-cache', action='store_true', help="Always repack and redraw, rather than reuse results for an unchanged cluster (see cache.py)", default=False)
+parser.add_argument('--cache-entries', action='store', type=int, help="Packing results to keep in the cache", default=64)
+parser.add_argument('-j', '--jobs', action='store', type=int, help="Worker processes for rendering images (default: one per CPU)", default=None)
+parser.add_argument('--format', action='store', choices=report.FORMATS, help="Report format: the human readable table, or JSON/JSON lines/CSV records", default='table')
+parser.add_argument('--output', action='store', metavar='FILE', help="Write the report to FILE instead of stdout", default=None)
+parser.add_argument('-q', '--quiet', action='store_true', help="Only report packing summaries, not node/VM status and placements", default=False)
+parser.add_argument('--memprofile', action='store', metavar='FILE', help="Profile memory use per stage (tracemalloc and RSS) and write it to FILE as JSON (see memprofile.py)", default=None)
+parser.add_argument('--metrics-file', action='store', metavar='FILE', help="Write Prometheus metrics to FILE at the end (for the node_exporter textfile collector)", default=None)
+parser.add_argument('--metrics-port', action='store', type=int, metavar='PORT', help="Serve Prometheus metrics on PORT at /metrics; stays up after the report until interrupted", default=None)
 parser.add_argument('-v', '--verbose', action='count',      help="Be verbose, (multiples okay)")
 
 parser.add_argument('-H', '--host',
@@ -73,6 +129,216 @@ logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=L
 logging.debug(parsed_options)
 logging.debug(remaining_args)
 
+writer = report.ReportWriter(fmt=parsed_options.format, output=parsed_options.output, quiet=parsed_options.quiet)
+
+if parsed_options.metrics_port:
+    metrics_server = metrics.serve(parsed_options.metrics_port)
+
+profiler = memprofile.MemoryProfiler(enabled=bool(parsed_options.memprofile))
+
+
+def finish():
+    '''Close the report, put the metrics out, and exit'''
+
+    writer.close()
+    profiler.write(parsed_options.memprofile)
+    if parsed_options.metrics_file:
+        metrics.write_textfile(parsed_options.metrics_file)
+    if parsed_options.metrics_port:
+        logging.warning("Report done, still serving metrics on port %d (interrupt to stop)", parsed_options.metrics_port)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            metrics_server.shutdown()
+    sys.exit(0)
+
+
+if parsed_options.feasibility or parsed_options.cpu_ratio or parsed_options.mem_ratio or parsed_options.usage_margin is not None:
+    import overcommit
+    from Node import Node as NodeClass
+
+    if parsed_options.feasibility:
+        feasibility = overcommit.Feasibility.load(parsed_options.feasibility)
+    else:
+        feasibility = overcommit.Feasibility()
+    if parsed_options.cpu_ratio:
+        feasibility.default['cpu'] = parsed_options.cpu_ratio
+    if parsed_options.mem_ratio:
+        feasibility.default['mem'] = parsed_options.mem_ratio
+    if parsed_options.usage_margin is not None:
+        feasibility.model = 'usage'
+        feasibility.margin = parsed_options.usage_margin
+
+    NodeClass.feasibility = feasibility
+
+
+constraints = None
+if parsed_options.constraints:
+    import constraints as constraints_module
+    constraints = constraints_module.Constraints.load(parsed_options.constraints)
+
+
+# graphics views, in strategy order, for --atlas
+atlas_views = []
+
+def pictures(packed_nodes, filename):
+    '''Draw a set of packed nodes, either straight out to per-node
+    files, or held back to be tiled into the atlas at the end.
+    (graphics.py reuses images it has drawn before.)'''
+
+    if parsed_options.nopics:
+        return
+
+    with profiler.stage('draw:' + filename):
+        g = graphics.graphics(packed_nodes, height=600, width=800, filename=filename,
+                              show_allocated=parsed_options.allocated, workers=parsed_options.jobs)
+
+        if parsed_options.atlas:
+            atlas_views.append((filename, g))
+        else:
+            g.save()
+
+
+def save_atlas():
+    if atlas_views:
+        graphics.save_atlas([g for name, g in atlas_views], parsed_options.atlas,
+                            labels=[name for name, g in atlas_views])
+
+
+def summarize(strategy, packed_nodes, packed_count, unpacked_count, **extra):
+    '''Report a packing: its placement plan, then how it came out,
+    including how far it might be from the fewest nodes possible'''
+    writer.placement(strategy, packed_nodes)
+    state = packed_nodes[0].storage_state if packed_nodes else None
+    if state is not None:
+        extra['local_moves'] = len(state.local_moves(packed_nodes))
+    bound = bounds.lower_bound(nodes, vms)
+    writer.summary(strategy, packed_nodes, packed_count, unpacked_count, bound=bound, **extra)
+    metrics.observe_nodes(strategy, packed_nodes, vms)
+    metrics.observe_summary(strategy, packed_nodes, packed_count, unpacked_count, bound=bound)
+
+
+def improve(packed_nodes):
+    '''Local search over a packing, if asked for (--improve)'''
+
+    if not parsed_options.improve:
+        return
+
+    import localsearch
+    stats = localsearch.improve(packed_nodes, budget=parsed_options.improve, objective=parsed_options.improve_objective)
+    writer.message("Local search: nodes used {nodes_before} -> {nodes_after} ({iterations} steps in {seconds:.1f}s)".format(**stats))
+
+
+results = None
+if not parsed_options.no_cache:
+    import cache
+    results = cache.ResultCache(max_entries=parsed_options.cache_entries)
+
+
+def cache_extra():
+    '''Settings outside the nodes and VMs that packing results depend on'''
+
+    import hashlib
+    from Node import Node as NodeClass
+
+    extra = {}
+    if NodeClass.feasibility is not None:
+        extra['feasibility'] = vars(NodeClass.feasibility)
+    if NodeClass.storage is not None:
+        extra['storage'] = [NodeClass.storage.nodes, NodeClass.storage.vms, NodeClass.storage.allow_local_migration]
+    if parsed_options.constraints:
+        with open(parsed_options.constraints, 'rb') as fp:
+            extra['constraints'] = hashlib.sha1(fp.read()).hexdigest()
+    return extra
+
+
+def pack(strategy, filename, polish=True, packer=None, info=None, **params):
+    '''Pack with a packing routine (polished by improve(), unless told
+    otherwise), or take the packing from the result cache, and draw it.  The
+    routine is packing.<strategy>, unless packer is given; anything it
+    puts in the info dict is cached with the result.  Returns (nodes,
+    placed, unplaced).'''
+
+    from Node import Node as NodeClass
+
+    with profiler.stage('copy:' + strategy):
+        temp_vms = copy.deepcopy(vms)
+
+    # random draws and time-budgeted local search give a new answer each run
+    use_cache = results is not None and cache.cacheable(strategy, params) and not (polish and parsed_options.improve)
+
+    key = None
+    if use_cache:
+        usage = NodeClass.feasibility is not None and NodeClass.feasibility.model == 'usage'
+        key = cache.fingerprint(temp_nodes, temp_vms, strategy, key='area', params=params,
+                                usage=usage, extra=cache_extra())
+        entry = results.get(key)
+        if entry is not None:
+            writer.message("Cached result for {}".format(strategy))
+            if info is not None:
+                info.update(entry.get('info', {}))
+            with profiler.stage('pack:' + strategy):
+                packed_nodes, packed_count, unpacked_count = cache.restore(temp_nodes, temp_vms, entry, constraints=constraints)
+            pictures(packed_nodes, filename)
+            return packed_nodes, packed_count, unpacked_count
+
+    with profiler.stage('pack:' + strategy):
+        packer = packer or getattr(packing, strategy)
+        packed_nodes, packed_count, unpacked_count = packer(temp_nodes, temp_vms, key='area',
+                                                            constraints=constraints, **params)
+        if polish:
+            improve(packed_nodes)
+
+    if use_cache:
+        results.put(key, packed_nodes, temp_vms, packed_count, unpacked_count, info=info)
+
+    pictures(packed_nodes, filename)
+    return packed_nodes, packed_count, unpacked_count
+
+
+if parsed_options.clusters:
+    import clusters
+
+    fetched = clusters.fetch_all(clusters.load_config(parsed_options.clusters))
+    strategy = parsed_options.strategy
+
+    writer.message("Packing {} clusters with {}....".format(len(fetched), strategy))
+    cluster_results = clusters.pack_clusters(fetched, strategy=strategy, key='area', constraints=constraints,
+                                             workers=parsed_options.jobs)
+
+    for name, (packed_nodes, packed_count, unpacked_count) in cluster_results.items():
+        pictures(packed_nodes, "{}-{}".format(name, strategy))
+        writer.placement("{}:{}".format(name, strategy), packed_nodes)
+        bound = bounds.lower_bound(*fetched[name])
+        writer.summary("{}:{}".format(name, strategy), packed_nodes, packed_count, unpacked_count,
+                       bound=bound, cluster=name)
+        metrics.observe_summary("{}:{}".format(name, strategy), packed_nodes, packed_count, unpacked_count, bound=bound)
+
+    if len(fetched) > 1:
+        writer.message("All clusters pooled....")
+        all_nodes, all_vms = clusters.combine(fetched)
+        packed_nodes, packed_count, unpacked_count = getattr(packing, strategy)(
+            all_nodes, all_vms, key='area', constraints=clusters.prefix_constraints(constraints, fetched))
+        writer.placement("combined:{}".format(strategy), packed_nodes)
+        writer.summary("combined:{}".format(strategy), packed_nodes, packed_count, unpacked_count,
+                       bound=bounds.lower_bound(all_nodes, all_vms), cluster='combined')
+
+    for what_if in parsed_options.absorb:
+        source, target = what_if.split(':')
+        if source not in fetched or target not in fetched:
+            logging.error("Can't absorb %s into %s: unknown or unreachable cluster", source, target)
+            continue
+        writer.message("Could {} absorb {}'s VMs?....".format(target, source))
+        packed_nodes, packed_count, unpacked_count = clusters.absorb(fetched, source, target, strategy=strategy,
+                                                                     key='area', constraints=constraints)
+        writer.placement("absorb:{}:{}".format(what_if, strategy), packed_nodes)
+        writer.summary("absorb:{}:{}".format(what_if, strategy), packed_nodes, packed_count, unpacked_count,
+                       bound=bounds.lower_bound(packed_nodes, fetched[source][1] + fetched[target][1]),
+                       cluster=target)
+
+    save_atlas()
+    finish()
+
 
 if parsed_options.json_files:
 
@@ -83,20 +349,22 @@ if parsed_options.json_files:
         import Node
         import VM
 
-        fp = open(parsed_options.json_files[0])
-        node_list = json.load(fp)
-        fp.close()
+        with profiler.stage('parse'):
+            fp = open(parsed_options.json_files[0])
+            node_list = json.load(fp)
+            fp.close()
 
-        fp = open(parsed_options.json_files[1])
-        vm_list = json.load(fp)
-        fp.close()
+            fp = open(parsed_options.json_files[1])
+            vm_list = json.load(fp)
+            fp.close()
 
         logging.debug("Parsed node JSON=%s",str(node_list))
         #logging.debug("Parsed VM JSON=%s",+str(vm_list))
 
         # Build Node and VM objects from imported JSON data
-        nodes = [ Node.Node(data=n) for n in node_list['data'] ]
-        vms = [ VM.VM(data=v) for v in vm_list['data'] ]
+        with profiler.stage('objects'):
+            nodes = [ Node.Node(data=n) for n in node_list['data'] ]
+            vms = [ VM.VM(data=v) for v in vm_list['data'] ]
 
     else:
         parser.print_help()
@@ -107,90 +375,131 @@ else:
     #P = PVE(host=H, u=U, pw=P, excludes=['pve3'])
     P = PVE(host=parsed_options.host, u=parsed_options.username, pw=parsed_options.password, excludes=['badnode'])
 
-    print("Dumping Nodes")
-    nodes = P.get_nodes(full=True)
+    writer.message("Dumping Nodes")
+    with metrics.COLLECT_SECONDS.time(what='nodes'), profiler.stage('collect:nodes'):
+        nodes = P.get_nodes(full=True)
 
-    print("Dumping VMs")
+    writer.message("Dumping VMs")
 
     #vms = P.get_vms(full=False, filter_node='pve2')
-    vms = P.get_vms(full=True, )
+    with metrics.COLLECT_SECONDS.time(what='vms'), profiler.stage('collect:vms'):
+        vms = P.get_vms(full=True, )
 
+    if parsed_options.percentile:
+        import usage
+        writer.message("Sizing VMs by p{:g} of {} history".format(parsed_options.percentile, parsed_options.timeframe))
+        usage.size_vms(P, vms, percentile=parsed_options.percentile, timeframe=parsed_options.timeframe,
+                       cache=usage.UsageCache(ttl=parsed_options.usage_ttl))
 
+    if parsed_options.collect_storage:
+        writer.message("Collecting storage")
+        from Node import Node as NodeClass
+        with metrics.COLLECT_SECONDS.time(what='storage'):
+            NodeClass.storage = P.get_storage(allow_local_migration=parsed_options.allow_local_migration)
 
-#print(vms)
-#print(nodes)
-for x in nodes:
-    x.show()
 
-for x in vms:
-    x.show()
+if parsed_options.storage:
+    import storage
+    from Node import Node as NodeClass
+    NodeClass.storage = storage.StorageMap.load(parsed_options.storage,
+                                                allow_local_migration=parsed_options.allow_local_migration)
 
-temp_vms = vms.copy()
 
-#for tvm in sorted(temp_vms):
-#    log.info('{}: {}'.format(tvm.node, tvm.name))
 
+if parsed_options.rates:
+    import rates
+    rates.RateTracker(halflife=parsed_options.rate_halflife).update_all(vms)
 
-# Print vms by node
-for node in sorted(nodes):
-    print(node.name)
-    for tvm in sorted(temp_vms):
-        if tvm.node == node.name:
-            temp_vms.remove(tvm)
-            print('  {}'.format(tvm.name))
 
+#print(vms)
+#print(nodes)
+writer.nodes(nodes)
+writer.vms(vms)
 
-temp_nodes = copy.deepcopy(nodes)
-temp_vms = copy.deepcopy(vms)
+
+profiler.note(nodes=len(nodes), vms=len(vms))
+
+with profiler.stage('copy'):
+    temp_nodes = copy.deepcopy(nodes)
+    temp_vms = copy.deepcopy(vms)
 temp_vms.sort(key=lambda x: x.area())
 
 for tvm in temp_vms:
-    print('{:>25}: {:>.4f} {:>.4f}'.format(tvm.name, tvm.area_perc(), tvm.area()))
+    writer.message('{:>25}: {:>.4f} {:>.4f}'.format(tvm.name, tvm.area_perc(), tvm.area()))
+
+
+writer.message("Current status....")
+
+
+with profiler.stage('pack:current'):
+    packed_nodes, packed_count, unpacked_count = packing.pack_null(temp_nodes, temp_vms, key='area', constraints=constraints)
+
+if constraints is not None:
+    for problem in packed_nodes[0].constraints.violations(packed_nodes):
+        writer.message("Constraint violated: {}".format(problem))
+
+# VMs by node, as they are now
+writer.placement("current", packed_nodes)
+metrics.observe_nodes("current", packed_nodes, vms)
 
+pictures(packed_nodes, "current")
 
-print("Current status....")
 
+if parsed_options.failures:
+    import failure
 
-packed_nodes, packed_count, unpacked_count = packing.pack_null(temp_nodes, temp_vms, key='area')
+    if parsed_options.failure_base == 'packed':
+        packed_nodes, packed_count, unpacked_count = packing.pack_size(temp_nodes, temp_vms, key='area', constraints=constraints)
 
-if not parsed_options.nopics:
-    g=graphics.graphics(packed_nodes, height=600, width=800, filename="current", show_allocated=parsed_options.allocated)
-    g.save()
+    writer.message("Failure analysis ({} placement, up to {} nodes)....".format(parsed_options.failure_base, parsed_options.failures))
+    failure.report(failure.simulate(packed_nodes, max_failures=parsed_options.failures,
+                                    limit=parsed_options.scenario_limit, workers=parsed_options.jobs), writer)
+    finish()
 
 
 if parsed_options.current:
-    sys.exit(0)
+    save_atlas()
+    finish()
+
+
+if parsed_options.partition:
+    import partition
+
+    writer.message("Partitioned packing by {} with {}....".format(parsed_options.partition, parsed_options.strategy))
+
+    packed_nodes, packed_count, unpacked_count = partition.pack_partitioned(
+        temp_nodes, temp_vms, strategy=parsed_options.strategy, by=parsed_options.partition,
+        node_groups=parsed_options.node_groups, shards=parsed_options.shards,
+        workers=parsed_options.jobs, key='area', constraints=constraints)
+    improve(packed_nodes)
 
+    pictures(packed_nodes, "partitioned")
 
+    summarize("partitioned", packed_nodes, packed_count, unpacked_count)
 
+    save_atlas()
+    finish()
 
-print("Packing....")
 
 
 
-packed_nodes, packed_count, unpacked_count = packing.pack_size(temp_nodes, temp_vms, key='area')
+writer.message("Packing....")
 
-if not parsed_options.nopics:
-    g=graphics.graphics(packed_nodes, height=600, width=800, filename="packed", show_allocated=parsed_options.allocated)
-    g.save()
 
 
-print("Packed {}/{} nodes. ({:.0f}%)".format(packed_count, unpacked_count+packed_count, 100*packed_count/(packed_count+unpacked_count)))
+packed_nodes, packed_count, unpacked_count = pack('pack_size', "packed")
+
+
+summarize("packed", packed_nodes, packed_count, unpacked_count)
 
 for node in packed_nodes:
     node.efficency()
 
 #========================================================================
-#temp_nodes = copy.deepcopy(nodes)
-temp_vms = copy.deepcopy(vms)
-packed_nodes, packed_count, unpacked_count = packing.pack_size_rr(temp_nodes, temp_vms, key='area')
+packed_nodes, packed_count, unpacked_count = pack('pack_size_rr', "packed_rr")
 
-if not parsed_options.nopics:
-    g=graphics.graphics(packed_nodes, height=600, width=800, filename="packed_rr", show_allocated=parsed_options.allocated)
-    g.save()
 
-
-print("Packed {}/{} nodes. ({:.0f}%)".format(packed_count, unpacked_count+packed_count, 100*packed_count/(packed_count+unpacked_count)))
+summarize("packed_rr", packed_nodes, packed_count, unpacked_count)
 
 
 for node in packed_nodes:
@@ -198,16 +507,10 @@ for node in packed_nodes:
 
 
 #========================================================================
-#temp_nodes = copy.deepcopy(nodes)
-temp_vms = copy.deepcopy(vms)
-packed_nodes, packed_count, unpacked_count = packing.pack_size_df(temp_nodes, temp_vms, key='area')
-
-if not parsed_options.nopics:
-    g=graphics.graphics(packed_nodes, height=600, width=800, filename="packed_df", show_allocated=parsed_options.allocated)
-    g.save()
+packed_nodes, packed_count, unpacked_count = pack('pack_size_df', "packed_df")
 
 
-print("Packed {}/{} nodes. ({:.0f}%)".format(packed_count, unpacked_count+packed_count, 100*packed_count/(packed_count+unpacked_count)))
+summarize("packed_df", packed_nodes, packed_count, unpacked_count)
 
 
 for node in packed_nodes:
@@ -215,22 +518,68 @@ for node in packed_nodes:
 
 
 #========================================================================
-#temp_nodes = copy.deepcopy(nodes)
-temp_vms = copy.deepcopy(vms)
-packed_nodes, packed_count, unpacked_count = packing.pack_random(temp_nodes, temp_vms, key='area')
+packed_nodes, packed_count, unpacked_count = pack('pack_balance', "packed_balance", polish=False,
+                                                  objective=parsed_options.balance_objective,
+                                                  current=parsed_options.rebalance, moves=parsed_options.max_moves)
 
-if not parsed_options.nopics:
-    g=graphics.graphics(packed_nodes, height=600, width=800, filename="packed_random", show_allocated=parsed_options.allocated)
-    g.save()
+
+loads = [node.score(mode='allocated') for node in packed_nodes if node.status == 'online']
+summarize("packed_balance", packed_nodes, packed_count, unpacked_count,
+          max_load=max(loads), mean_load=sum(loads)/len(loads))
+writer.message("Node load: max {:.3f}, mean {:.3f}".format(max(loads), sum(loads)/len(loads)))
+
+
+for node in packed_nodes:
+    node.efficency()
+
+
+#========================================================================
+packed_nodes, packed_count, unpacked_count = pack('pack_random', "packed_random")
 
 
-print("Packed {}/{} nodes. ({:.0f}%)".format(packed_count, unpacked_count+packed_count, 100*packed_count/(packed_count+unpacked_count)))
+summarize("packed_random", packed_nodes, packed_count, unpacked_count)
 
 
 for node in packed_nodes:
     node.efficency()
 
 
+#========================================================================
+if parsed_options.trials:
+    packed_nodes, packed_count, unpacked_count = pack('pack_best_of', "packed_best", trials=parsed_options.trials)
+
+
+    summarize("packed_best", packed_nodes, packed_count, unpacked_count)
+
+
+    for node in packed_nodes:
+        node.efficency()
+
+
+#========================================================================
+if parsed_options.portfolio:
+    import portfolio
+
+    recipe = {}
+    # bound here rather than passed through pack(), to keep the worker
+    # count out of the cache key
+    packer = functools.partial(portfolio.pack_portfolio, workers=parsed_options.jobs, info=recipe)
+    packed_nodes, packed_count, unpacked_count = pack('pack_portfolio', "packed_portfolio",
+                                                      packer=packer, info=recipe)
+    writer.message("Portfolio winner: {order} ordering, {policy} node policy".format(**recipe))
+
+
+    summarize("packed_portfolio", packed_nodes, packed_count, unpacked_count,
+              order=recipe['order'], policy=recipe['policy'])
+
+
+    for node in packed_nodes:
+        node.efficency()
+
+
+save_atlas()
+finish()
+
 
 #######################################################################
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''Time the collectors against the fake API (fake_pve.py): the node/VM
+listing done by PVE, and the per-VM rrddata fetches behind
+--percentile, at several levels of client concurrency.'''
+
+import sys
+import time
+import logging
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PVE import PVE
+from PVEClient import PVEClient
+import fake_pve
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('json_files', nargs='*', help="nodes.json and vms.json to serve (default: synthetic cluster)")
+parser.add_argument('--nodes', type=int, default=100, help="Nodes in the synthetic cluster")
+parser.add_argument('--vms', type=int, default=2000, help="VMs in the synthetic cluster")
+parser.add_argument('--latency', type=float, default=0.005, help="Seconds added to every response")
+parser.add_argument('--jitter', type=float, default=0.002)
+parser.add_argument('--error-rate', type=float, default=0.0)
+parser.add_argument('--concurrency', default='1,2,4,8,16', help="Comma separated client concurrency levels to try")
+parser.add_argument('--repeat', type=int, default=3, help="Collections per concurrency level")
+parser.add_argument('-v', '--verbose', action='count', default=0)
+options = parser.parse_args()
+
+logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=max(1, 30 - options.verbose * 10))
+
+if options.json_files:
+    if len(options.json_files) != 2:
+        parser.print_help()
+        sys.exit(1)
+    data = fake_pve.load_json(*options.json_files)
+else:
+    data = fake_pve.synthetic_cluster(options.nodes, options.vms)
+
+fake = fake_pve.FakePVE(*data, latency=options.latency, jitter=options.jitter,
+                        error_rate=options.error_rate, seed=0).start()
+
+print("{:>5} {:>10} {:>10} {:>10} {:>8} {:>8}".format('conc', 'list(s)', 'rrd(s)', 'rrd/s', 'reqs', 'logins'))
+
+for concurrency in [int(c) for c in options.concurrency.split(',')]:
+
+    list_time = 0.0
+    rrd_time = 0.0
+    fake.requests = fake.logins = 0
+
+    for _ in range(options.repeat):
+        client = PVEClient(fake.host, fake.user, fake.password, max_concurrent=concurrency,
+                           **fake.client_options())
+
+        start = time.perf_counter()
+        P = PVE(client=client)
+        P.get_nodes(full=True)
+        vms = P.get_vms(full=True)
+        list_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(P.get_rrddata, vms))
+        rrd_time += time.perf_counter() - start
+
+        client.close()
+
+    print("{:>5} {:>10.3f} {:>10.3f} {:>10.1f} {:>8} {:>8}".format(
+        concurrency, list_time/options.repeat, rrd_time/options.repeat,
+        len(vms) * options.repeat / rrd_time, fake.requests, fake.logins))
+
+fake.stop()
@@ -0,0 +1,136 @@
+'''Lower bounds on the number of nodes a set of VMs needs.
+
+Packing is NP-hard, so the packers can't promise the fewest nodes; a
+lower bound says how far off they might be.  If a packing uses as many
+nodes as the bound, it is optimal and there is no point searching on
+(pack_best_of() and localsearch.improve() stop there).
+
+Each online node offers its capacity above minfree; offline nodes take
+nothing.  Each VM is charged its smallest demand on any online node
+(Node.demand(), so overcommit ratios count), which keeps the bounds
+valid with per-node ratios.  VMs that no single online node can hold
+(by has_space()'s test, in both dimensions at once) are left out, since
+no packing places them.'''
+
+# Bounds, per dimension (memory, CPU), taking the best:
+#   volume  fewest nodes, biggest first, whose capacities add up to the
+#           total demand.  Handles mixed node sizes directly.
+#   L2      Martello & Toth's bound for one-dimensional bin packing,
+#           with every node given the biggest node's capacity (which
+#           can only lower the count).  Counts VMs that can't share a
+#           node with each other, plus the volume of the mid-sized ones
+#           that can't go alongside them.  Much stronger than volume when
+#           there are lots of VMs bigger than half a node.
+
+import math
+import bisect
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def online(nodes):
+    return [node for node in nodes if node.status == 'online']
+
+
+def capacities(nodes):
+    '''(memory, cpu) each online node has above its minfree limits'''
+    return [(node.maxmem - node.minfreemem, node.maxcpu - node.minfreecpu) for node in online(nodes)]
+
+
+def demands(nodes, vms):
+    '''Smallest (memory, cpu) each placeable VM takes on any online node'''
+
+    nodes = online(nodes)
+    caps = capacities(nodes)
+
+    sizes = []
+    for vm in vms:
+        charged = [node.demand(vm) for node in nodes]
+        # placeable means one node holds it, strictly, in both dimensions
+        if not any(cap_mem > mem and cap_cpu > cpu for (cap_mem, cap_cpu), (mem, cpu) in zip(caps, charged)):
+            continue
+        sizes.append((min(m for m, c in charged), min(c for m, c in charged)))
+    return sizes
+
+
+def volume_bound(sizes, caps):
+    '''Fewest of the (largest) capacities that hold the total size'''
+
+    total = sum(sizes)
+    if total <= 0:
+        return 0
+
+    held = 0.0
+    for count, cap in enumerate(sorted(caps, reverse=True), start=1):
+        held += cap
+        if held >= total:
+            return count
+    return len(caps)
+
+
+def l2_bound(sizes, capacity):
+    '''Martello & Toth L2 bound, for sizes in bins of one capacity'''
+
+    if not sizes or capacity <= 0:
+        return 0
+
+    sizes = sorted(sizes)
+    prefix = [0.0]
+    for size in sizes:
+        prefix.append(prefix[-1] + size)
+
+    def between(low, high):
+        '''count and sum of sizes in (low, high]'''
+        lo = bisect.bisect_right(sizes, low)
+        hi = bisect.bisect_right(sizes, high)
+        return hi - lo, prefix[hi] - prefix[lo]
+
+    def below(low, high):
+        '''count and sum of sizes in [low, high]'''
+        lo = bisect.bisect_left(sizes, low)
+        hi = bisect.bisect_right(sizes, high)
+        return hi - lo, prefix[hi] - prefix[lo]
+
+    half = capacity / 2
+    best = 0
+    for k in [0.0] + sorted({s for s in sizes if s <= half}):
+        big, _ = between(capacity - k, float('inf'))
+        mid, mid_sum = between(half, capacity - k)
+        _, small_sum = below(k, half)
+        spare = mid * capacity - mid_sum
+        extra = max(0, math.ceil((small_sum - spare) / capacity - 1e-9))
+        best = max(best, big + mid + extra)
+    return best
+
+
+def lower_bound(nodes, vms):
+    '''Lower bound on the nodes needed to place every placeable VM'''
+
+    caps = capacities(nodes)
+    if not caps or not vms:
+        return 0
+    sizes = demands(nodes, vms)
+
+    bound = 0
+    for dim in (0, 1):
+        dim_sizes = [s[dim] for s in sizes]
+        dim_caps = [c[dim] for c in caps if c[dim] > 0]
+        bound = max(bound,
+                    volume_bound(dim_sizes, dim_caps),
+                    l2_bound(dim_sizes, max(dim_caps, default=0)))
+
+    bound = min(bound, len(caps))
+    log.debug("Lower bound for %d VMs on %d online nodes: %d", len(sizes), len(caps), bound)
+    return bound
+
+
+def nodes_used(nodes):
+    return sum(1 for node in nodes if node.allocated_vms)
+
+
+def gap(used, bound):
+    '''Optimality gap, as a fraction of the bound'''
+    if not bound:
+        return 0.0
+    return (used - bound) / bound
@@ -0,0 +1,166 @@
+'''Content-addressed cache of packing results.  A packing only depends
+on a few things: node capacities and minfree reserves, VM sizes and
+where they are now, the scoring weights, biases and I/O rates, the
+strategy, its sort key and parameters, and any feasibility, constraint
+or storage settings.  Those are hashed into a
+key; cpu/mem usage, uptime and the I/O counters change on every poll and
+are left out (unless packing by usage).  A run over an unchanged cluster
+finds its placements already worked out (and graphics.py's own cache
+has their pictures).
+
+Strategies that draw random numbers (pack_random, pack_best_of), and
+anything polished by the time-budgeted local search, are not cached: a
+new run should be a new draw (see cacheable()).
+
+Entries are directories under the cache root (see cachedir.py), each
+holding a result.json; the least recently used are evicted beyond
+max_entries.'''
+
+# A placement is stored as the node names, in the order the packer
+# returned them, each with the indexes of its VMs in the input list,
+# in allocation order.  restore() replays that with forced allocations
+# onto a fresh pack_setup(), so constraint and storage state, free
+# resources and picture layouts all come out the same as the original.
+# The replay isn't counted in the allocation metrics.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+from cachedir import cache_dir
+
+log = logging.getLogger(__name__)
+
+# Bump when packing changes what it does with the same inputs, so cached
+# results are worked out again.
+RESULT_VERSION = 1
+
+# fields that change what a packing does (as in replay.py)
+NODE_FIELDS = ('name', 'status', 'maxcpu', 'maxmem', 'minfreecpu', 'minfreemem', 'bias')
+VM_FIELDS = ('vmid', 'name', 'status', 'maxcpu', 'maxmem', 'node', 'pool', 'bias', 'net_rate', 'disk_rate')
+USAGE_FIELDS = ('cpu', 'mem')
+
+# packers whose result changes from run to run
+STOCHASTIC = ('pack_random', 'pack_best_of')
+
+
+def cacheable(strategy, params=None):
+    '''False if a packing with strategy (and its params) isn't the same
+    every time, so replaying a cached one would freeze a random draw'''
+    return strategy not in STOCHASTIC and not (params or {}).get('vm_random')
+
+
+def fingerprint(nodes, vms, strategy, key='area', params=None, usage=False, extra=None):
+    '''Key for a packing of vms onto nodes.  params are the strategy's
+    own arguments; extra is anything else the result depends on
+    (JSON-able); usage includes the VMs' cpu/mem usage.'''
+
+    from Node import Node
+    from VM import VM
+
+    vm_fields = VM_FIELDS + USAGE_FIELDS if usage else VM_FIELDS
+    digest = hashlib.sha1()
+    # scores (key='score', pack_balance) weigh usage by the class weights
+    digest.update(json.dumps([RESULT_VERSION, strategy, key, params or {}, extra, Node.weight, VM.weight],
+                             sort_keys=True, default=repr).encode())
+    for items, fields in ((nodes, NODE_FIELDS), (vms, vm_fields)):
+        # order matters: it breaks ties when sorting
+        for item in items:
+            digest.update(json.dumps([getattr(item, f, None) for f in fields]).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def restore(orig_nodes, orig_vms, entry, constraints=None):
+    '''Rebuild a cached packing.  Returns (nodes, placed, unplaced),
+    as the packer did.'''
+
+    import packing
+
+    nodes, _ = packing.pack_setup(orig_nodes, orig_vms, constraints=constraints)
+    by_name = {node.name: node for node in nodes}
+
+    packed = []
+    for name, indexes in entry['placement']:
+        node = by_name[name]
+        for index in indexes:
+            node.allocate(orig_vms[index], force=True, record=False)
+        packed.append(node)
+
+    return packed, entry['placed'], entry['unplaced']
+
+
+
+class ResultCache:
+    '''Packing results on disk, LRU evicted.'''
+
+    def __init__(self, directory=None, max_entries=64):
+        self.directory = directory or cache_dir('results')
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+
+    def path(self, key, *parts):
+        return os.path.join(self.directory, key, *parts)
+
+
+    def get(self, key):
+        '''The cached entry for key, or None'''
+        filename = self.path(key, 'result.json')
+        try:
+            with open(filename) as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # the entry directory's mtime is its last use
+        os.utime(self.path(key))
+        self.hits += 1
+        return entry
+
+
+    def put(self, key, nodes, vms, placed, unplaced, info=None):
+        '''Store a packing of vms (the list the packer was given), and
+        anything else (JSON-able) about how it came out'''
+
+        # packers running in worker processes hand back copies of the
+        # VMs, so fall back on matching by vmid and name
+        index = {id(vm): i for i, vm in enumerate(vms)}
+        by_key = {}
+        for i, vm in enumerate(vms):
+            by_key.setdefault((vm.vmid, vm.name), []).append(i)
+
+        def position(vm):
+            i = index.get(id(vm))
+            return by_key[(vm.vmid, vm.name)].pop(0) if i is None else i
+
+        entry = {
+            'time': time.time(),
+            'placed': placed,
+            'unplaced': unplaced,
+            'info': info or {},
+            'placement': [(node.name, [position(vm) for vm in node.allocated_vms]) for node in nodes],
+        }
+
+        os.makedirs(self.path(key), exist_ok=True)
+        tmp = self.path(key, 'result.json.{}'.format(os.getpid()))
+        with open(tmp, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, self.path(key, 'result.json'))
+        self.evict()
+
+
+    def evict(self):
+        '''Drop the least recently used entries beyond max_entries'''
+        try:
+            entries = [(os.path.getmtime(self.path(name)), name) for name in os.listdir(self.directory)]
+        except OSError:
+            return
+        entries.sort(reverse=True)
+        for mtime, name in entries[self.max_entries:]:
+            log.debug("Evicting cached result %s", name)
+            shutil.rmtree(self.path(name), ignore_errors=True)
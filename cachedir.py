@@ -0,0 +1,18 @@
+'''Location of the on-disk caches shared by the various tools.'''
+
+import os
+
+
+def cache_dir(*parts):
+    '''Return (creating it if needed) a directory under the cache root.
+    The root is $PVE_BALANCE_CACHE if set, otherwise
+    $XDG_CACHE_HOME/pve-balance (~/.cache/pve-balance).'''
+
+    base = os.environ.get('PVE_BALANCE_CACHE')
+    if not base:
+        xdg = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        base = os.path.join(xdg, 'pve-balance')
+
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
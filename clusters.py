@@ -0,0 +1,180 @@
+'''Several Proxmox clusters at once.
+
+A clusters file lists each cluster with its own API host, credentials
+and client settings, or a pair of JSON dumps to read instead:
+
+    {"clusters": [
+        {"name": "ibbr", "host": "pve5.ad.ibbr.umd.edu", "user": "monitoring@pve",
+         "password_env": "PVE_IBBR_PASSWORD", "timeout": 10, "excludes": ["badnode"]},
+        {"name": "lab", "nodes": "nodes-lab.json", "vms": "vms-lab.json"}
+    ]}
+
+("password" works too, but keep it out of the file if you can.)  The
+clusters are fetched concurrently; one that can't be reached is logged
+and left out.  Every node and VM gets a .cluster attribute.
+
+Packing runs on each cluster separately, in parallel, or on all of them
+pooled together.  Pooled node and VM names are prefixed with their
+cluster ("ibbr/pve1"), since names repeat from cluster to cluster, and
+so are the names in the constraints (see prefix_constraints()).
+absorb() asks whether one cluster's nodes could take on another's VMs
+as well as their own.'''
+
+import os
+import copy
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import packing
+
+log = logging.getLogger(__name__)
+
+# settings passed through to PVEClient
+CLIENT_OPTIONS = ('port', 'scheme', 'verify', 'timeout', 'retries', 'backoff', 'max_concurrent', 'ticket_cache')
+
+
+def load_config(filename):
+    '''Read the list of cluster dicts from a clusters file'''
+    with open(filename) as fp:
+        clusters = json.load(fp)['clusters']
+    names = [cluster['name'] for cluster in clusters]
+    if len(set(names)) != len(names):
+        raise ValueError("Cluster names must be unique: {}".format(', '.join(names)))
+    return clusters
+
+
+def fetch_one(cluster):
+    '''(nodes, vms) for one cluster, tagged with its name'''
+
+    from Node import Node
+    from VM import VM
+
+    name = cluster['name']
+
+    if 'nodes' in cluster:
+        with open(cluster['nodes']) as fp:
+            nodes = [Node(data=n) for n in json.load(fp)['data']]
+        with open(cluster['vms']) as fp:
+            vms = [VM(data=v) for v in json.load(fp)['data']]
+    else:
+        from PVE import PVE
+        password = cluster.get('password')
+        if 'password_env' in cluster:
+            password = os.environ.get(cluster['password_env'], password)
+        options = {key: cluster[key] for key in CLIENT_OPTIONS if key in cluster}
+        P = PVE(host=cluster['host'], u=cluster.get('user', 'monitoring@pve'), pw=password,
+                excludes=cluster.get('excludes'), **options)
+        nodes = P.get_nodes(full=True)
+        vms = P.get_vms(full=True)
+        P.api.close()
+        # get_vms() fills in allocated_vms; packing starts from empty nodes
+        for node in nodes:
+            node.allocated_vms = []
+
+    for item in nodes + vms:
+        item.cluster = name
+
+    log.info("Cluster %s: %d nodes, %d VMs", name, len(nodes), len(vms))
+    return nodes, vms
+
+
+def fetch_all(clusters, workers=None):
+    '''Fetch every cluster concurrently.  Returns {name: (nodes, vms)}
+    in config order, without the ones that failed.'''
+
+    from PVEClient import APIError
+
+    def attempt(cluster):
+        try:
+            return fetch_one(cluster)
+        except SystemExit:
+            # PVE has already logged why it couldn't connect or log in
+            log.error("Can't fetch cluster %s (%s), leaving it out", cluster['name'], cluster.get('host'))
+        except (APIError, OSError, ValueError, KeyError) as exc:
+            # errors after login (a 5xx once the retries run out, say)
+            log.error("Can't fetch cluster %s, leaving it out: %s", cluster['name'], exc)
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers or len(clusters) or 1) as pool:
+        results = list(pool.map(attempt, clusters))
+
+    return {cluster['name']: result for cluster, result in zip(clusters, results) if result is not None}
+
+
+def combine(fetched, names=None):
+    '''Pool several clusters' nodes and VMs (copies), with prefixed names'''
+
+    nodes = []
+    vms = []
+    for name in names or fetched:
+        cluster_nodes, cluster_vms = copy.deepcopy(fetched[name])
+        for node in cluster_nodes:
+            node.name = node.node = '{}/{}'.format(name, node.name)
+            node.id = '{}/{}'.format(name, node.id)
+        for vm in cluster_vms:
+            vm.name = '{}/{}'.format(name, vm.name)
+            vm.node = '{}/{}'.format(name, vm.node)
+        nodes.extend(cluster_nodes)
+        vms.extend(cluster_vms)
+    return nodes, vms
+
+
+def prefix_constraints(constraints, names):
+    '''Constraints for pooled clusters: each group (and exclude_nodes)
+    applies within each cluster in names, by prefixed names.  VMs given
+    by vmid are left as they are, so match in every cluster.'''
+
+    if constraints is None:
+        return None
+
+    import constraints as constraints_module
+
+    def prefixed(name, items, vms=False):
+        return [item if vms and item.isdigit() else '{}/{}'.format(name, item) for item in items]
+
+    groups = []
+    exclude_nodes = []
+    for name in names:
+        exclude_nodes.extend(prefixed(name, constraints.exclude_nodes))
+        for group in constraints.groups:
+            groups.append(dict(group, name='{}/{}'.format(name, group['name']),
+                               vms=prefixed(name, group['vms'], vms=True), nodes=prefixed(name, group['nodes'])))
+    return constraints_module.Constraints(groups=groups, exclude_nodes=exclude_nodes)
+
+
+def pack_one(args):
+    '''Pack a single cluster.  Runs in the worker pool.'''
+    name, strategy, nodes, vms, key, constraints = args
+    return (name,) + getattr(packing, strategy)(nodes, vms, key=key, constraints=constraints)
+
+
+def pack_clusters(fetched, strategy='pack_size', key='area', constraints=None, workers=None):
+    '''Pack each cluster on its own, in parallel.  Returns
+    {name: (nodes, placed count, unplaced count)}.'''
+
+    jobs = [(name, strategy, nodes, vms, key, constraints) for name, (nodes, vms) in fetched.items()]
+
+    if workers == 1 or len(jobs) < 2:
+        results = [pack_one(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(pack_one, jobs))
+
+    return {result[0]: result[1:] for result in results}
+
+
+def absorb(fetched, source, target, strategy='pack_size', key='area', constraints=None):
+    '''What if target's nodes had to run source's VMs as well as their
+    own?  Returns (nodes, placed count, unplaced count).
+
+    Everything is repacked from scratch, except with pack_balance, which
+    leaves target's VMs where they are and only places source's.'''
+
+    nodes, _ = combine(fetched, [target])
+    _, vms = combine(fetched, [source, target])
+
+    options = {'current': True} if strategy == 'pack_balance' else {}
+    return getattr(packing, strategy)(nodes, vms, key=key, constraints=prefix_constraints(constraints, [source, target]),
+                                      **options)
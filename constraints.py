@@ -0,0 +1,208 @@
+'''Placement constraints for the packers: anti-affinity, affinity,
+all-or-nothing gangs, and pinning VMs to (or excluding them from) nodes.
+
+Constraints are read from a JSON file like:
+
+    {
+        "exclude_nodes": ["badnode"],
+        "groups": [
+            {"name": "ceph",  "type": "anti-affinity", "vms": ["cephtest1", "cephtest2", "cephtest3"]},
+            {"name": "db",    "type": "affinity",      "vms": ["CryoEM-DB", "CryoEM-web"]},
+            {"name": "sph",   "type": "gang",          "vms": ["sph-1", "sph-2"]},
+            {"name": "big",   "type": "pin",           "vms": ["CPUHOG-1"], "nodes": ["pve1", "pve2"]},
+            {"name": "small", "type": "exclude",       "vms": [113],        "nodes": ["pve3"]}
+        ]
+    }
+
+VMs may be given by name or vmid.  "exclude_nodes" keeps every VM off
+those nodes, like PVE's excludes but without hiding what already runs
+there.'''
+
+# Every node gets a bit.  Each VM has a mask of nodes it may use (pin
+# and exclude folded together), and each (anti-)affinity group keeps a
+# mask of the nodes its members currently occupy, so checking a
+# placement costs a few integer ANDs per group the VM is in, however
+# many VMs or nodes there are.
+
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+GROUP_TYPES = ('anti-affinity', 'affinity', 'gang', 'pin', 'exclude')
+
+
+class Constraints:
+    '''Constraint definitions, independent of any particular packing.'''
+
+    def __init__(self, groups=None, exclude_nodes=None):
+        self.groups = []
+        self.exclude_nodes = list(exclude_nodes or [])
+
+        for group in groups or []:
+            if group.get('type') not in GROUP_TYPES:
+                raise ValueError("Constraint group {} has unknown type {} (expected one of {})".format(
+                    group.get('name'), group.get('type'), ', '.join(GROUP_TYPES)))
+            if group['type'] in ('pin', 'exclude') and not group.get('nodes'):
+                raise ValueError("Constraint group {} needs a list of nodes".format(group.get('name')))
+
+            self.groups.append({
+                'name': group.get('name', 'group{}'.format(len(self.groups))),
+                'type': group['type'],
+                'vms': [str(v) for v in group.get('vms', [])],
+                'nodes': list(group.get('nodes', [])),
+            })
+
+        # vm name/vmid -> indexes of the groups it belongs to
+        self.membership = {}
+        for index, group in enumerate(self.groups):
+            for key in group['vms']:
+                self.membership.setdefault(key, []).append(index)
+
+
+    @classmethod
+    def load(cls, filename):
+        '''Read constraints from a JSON file'''
+        with open(filename) as fp:
+            config = json.load(fp)
+        return cls(groups=config.get('groups'), exclude_nodes=config.get('exclude_nodes'))
+
+
+    def groups_for(self, vm):
+        '''Indexes of the groups a VM belongs to'''
+        return self.membership.get(vm.name, []) + self.membership.get(str(vm.vmid), [])
+
+
+    def bind(self, nodes):
+        '''Fresh placement state for a packing run over these nodes'''
+        return ConstraintState(self, nodes)
+
+
+
+class ConstraintState:
+    '''Tracks which nodes each group occupies during one packing run.'''
+
+    def __init__(self, constraints, nodes):
+
+        self.constraints = constraints
+        self.groups = constraints.groups
+
+        self.bit = {node.name: 1 << index for index, node in enumerate(nodes)}
+        self.all_nodes = (1 << len(nodes)) - 1
+
+        self.default_mask = self.all_nodes & ~self.mask(constraints.exclude_nodes)
+
+        # per group: bitmask of occupied nodes, and members per node,
+        # so a bit can be cleared again when its last member leaves
+        self.used = [0] * len(self.groups)
+        self.count = [{} for group in self.groups]
+
+        # per VM (by vmid and name, dumps have been known to repeat
+        # vmids): (allowed node mask, groups that track placement)
+        self.vm_cache = {}
+
+
+    def mask(self, node_names):
+        bits = 0
+        for name in node_names:
+            bits |= self.bit.get(name, 0)
+        return bits
+
+
+    def vm_info(self, vm):
+        info = self.vm_cache.get((vm.vmid, vm.name))
+        if info is None:
+            allowed = self.default_mask
+            tracked = []
+            for index in self.constraints.groups_for(vm):
+                group = self.groups[index]
+                if group['type'] == 'pin':
+                    allowed &= self.mask(group['nodes'])
+                elif group['type'] == 'exclude':
+                    allowed &= ~self.mask(group['nodes'])
+                else:
+                    tracked.append(index)
+            info = (allowed, tracked)
+            self.vm_cache[(vm.vmid, vm.name)] = info
+        return info
+
+
+    def allows(self, vm, node):
+        '''True if placing vm on node breaks no constraint'''
+
+        bit = self.bit.get(node.name, 0)
+        allowed, tracked = self.vm_info(vm)
+
+        if not allowed & bit:
+            return False
+
+        for index in tracked:
+            kind = self.groups[index]['type']
+            used = self.used[index]
+            if kind == 'anti-affinity' and used & bit:
+                return False
+            if kind == 'affinity' and used and not used & bit:
+                return False
+
+        return True
+
+
+    def place(self, vm, node):
+        bit = self.bit.get(node.name, 0)
+        for index in self.vm_info(vm)[1]:
+            counts = self.count[index]
+            counts[bit] = counts.get(bit, 0) + 1
+            self.used[index] |= bit
+
+
+    def unplace(self, vm, node):
+        bit = self.bit.get(node.name, 0)
+        for index in self.vm_info(vm)[1]:
+            counts = self.count[index]
+            counts[bit] -= 1
+            if not counts[bit]:
+                del counts[bit]
+                self.used[index] &= ~bit
+
+
+    def incomplete_gangs(self, placed_vms, all_vms):
+        '''Gang groups with some, but not all, of their VMs placed.
+        Returns a list of (group name, placed members).'''
+
+        placed_ids = {(vm.vmid, vm.name) for vm in placed_vms}
+
+        incomplete = []
+        for index, group in enumerate(self.groups):
+            if group['type'] != 'gang':
+                continue
+            members = [vm for vm in all_vms if index in self.constraints.groups_for(vm)]
+            placed = [vm for vm in members if (vm.vmid, vm.name) in placed_ids]
+            if placed and len(placed) < len(members):
+                incomplete.append((group['name'], placed))
+        return incomplete
+
+
+    def violations(self, nodes):
+        '''Describe every constraint broken by the placement on nodes
+        (e.g. the current one, which is forced rather than checked).'''
+
+        problems = []
+        names = {bit: name for name, bit in self.bit.items()}
+
+        for node in nodes:
+            for vm in node.allocated_vms:
+                if not self.vm_info(vm)[0] & self.bit.get(node.name, 0):
+                    problems.append("{} is not allowed on {}".format(vm.name, node.name))
+
+        for index, group in enumerate(self.groups):
+            counts = self.count[index]
+            if group['type'] == 'anti-affinity':
+                for bit, count in counts.items():
+                    if count > 1:
+                        problems.append("anti-affinity group {} has {} VMs on {}".format(
+                            group['name'], count, names[bit]))
+            elif group['type'] == 'affinity' and len(counts) > 1:
+                problems.append("affinity group {} is split over {}".format(
+                    group['name'], ', '.join(sorted(names[bit] for bit in counts))))
+
+        return problems
@@ -3,7 +3,11 @@
 import json
 import logging
 import datetime
-import requests
+
+from PVEClient import PVEClient
+from Node import Node
+from VM import VM
+import storage
 
 LOG_LEVEL = 1
 logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=LOG_LEVEL)
@@ -13,51 +17,33 @@ H = 'pve5.ad.ibbr.umd.edu'
 U = 'monitoring@pve'
 P = 'monitoring'
 
-client=requests.session()
-
-URL="https://{}:8006/api2/json/access/ticket".format(H)
-auth_response = client.post(URL, data={'username':U, 'password':P})
 
-try:
-    r = json.loads(auth_response.text)
-except:
-    print("Aiiee")
+def dump(prefix, data, stamp):
+    '''Write one endpoint's data out as <prefix>-<stamp>.json, in the
+    same {"data": ...} shape the API returns.'''
 
+    fname = "{}-{}.json".format(prefix, stamp)
+    with open(fname, mode='w') as fp:
+        json.dump({'data': data}, fp, sort_keys=True, indent=4)
+    logging.info("Wrote %s", fname)
 
-ticket = r['data']['ticket']
-csrf   = r['data']['CSRFPreventionToken']
-
-cookies = {
-    'PVEAuthCookie': ticket,
-}
 
+# One timestamp for the whole dump, so the node and VM files pair up
+stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M')
 
+client = PVEClient(H, U, P)
 
 # GET NODES
-nodes = client.get('https://{}:8006/api2/json/nodes/'.format(H), cookies={'PVEAuthCookie': ticket})
-
-try:
-    fname = "nodes-{}.json".format(datetime.datetime.now().strftime('%Y%m%d-%H%M'))
-    fp = open(fname,mode='w')
-except:
-    print("Aiiee 2")
-
-fp.write(json.dumps(json.loads(nodes.text), sort_keys=True, indent=4 ))
-fp.close()
+node_list = client.get('nodes')
+dump('nodes', node_list, stamp)
 
 # GET VMs
-vms = client.get('https://{}:8006/api2/json/cluster/resources?type=vm'.format(H), cookies={'PVEAuthCookie': ticket})
-
-try:
-    fname = "vms-{}.json".format(datetime.datetime.now().strftime('%Y%m%d-%H%M'))
-    fp = open(fname,mode='w')
-except:
-    print("Aiiee 3")
-
-fp.write(json.dumps(json.loads(vms.text), sort_keys=True, indent=4 ))
-fp.close()
-
+vm_list = client.get('cluster/resources', type='vm')
+dump('vms', vm_list, stamp)
 
+# GET storages and VM disks, for balance.py --storage
+fname = "storage-{}.json".format(stamp)
+storage.StorageMap.collect(client, [Node(data=n) for n in node_list], [VM(data=v) for v in vm_list]).save(fname)
+logging.info("Wrote %s", fname)
 
-#print(response)
-#print(response.headers)
+client.close()
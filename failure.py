@@ -0,0 +1,214 @@
+'''N+1 / N+k failure analysis.  Starting from a placement (usually the
+current one from pack_null, or a packed one), knock out every node (or
+every combination of up to k nodes), and try to restart the failed
+nodes' VMs on the survivors without breaking the minfree limits,
+placement constraints or storage reachability.  Reports which failures
+strand VMs, and how much capacity is short: what the stranded VMs need
+beyond the headroom left on the survivors (fragmentation can strand VMs
+with no shortfall overall).'''
+
+# The base placement is boiled down once to a few flat lists: headroom
+# above minfree per node, and (name, mem, cpu, allowed, groups, disks)
+# per VM per node.  Each scenario copies just the two headroom lists and
+# re-places only the failed nodes' VMs, rather than deep-copying nodes
+# and VMs every time.  Scenarios are farmed out to a process pool, which
+# gets the base state once, when each worker starts.
+#
+# Where the placement has constraints or storage bound to it (see
+# packing.pack_setup), each VM carries a bitmask of the node indexes it
+# may use at all (pin/exclude, and the nodes that reach its disks), the
+# (anti-)affinity groups it is in, and its local disks; the state has
+# each group's occupied nodes and each node's local disk space, and
+# re-placement honours them as Node.allows() and has_space() would.
+
+import logging
+import itertools
+
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Base state in each worker process, see set_base()
+BASE = None
+
+
+def base_state(nodes, running_only=True):
+    '''Flatten a placement into the lists the scenarios work from.'''
+
+    state = {
+        'names': [node.name for node in nodes],
+        'free_mem': [],
+        'free_cpu': [],
+        'free_disk': [],
+        'vms': [],
+        'kinds': {},
+        'used': {},
+    }
+
+    constraints = nodes[0].constraints if nodes else None
+    storage_state = nodes[0].storage_state if nodes else None
+    everywhere = (1 << len(nodes)) - 1
+
+    if constraints is not None:
+        # occupied nodes per (anti-)affinity group, as our node indexes
+        for group, used in enumerate(constraints.used):
+            kind = constraints.groups[group]['type']
+            if kind in ('anti-affinity', 'affinity'):
+                state['kinds'][group] = kind
+                state['used'][group] = sum(1 << index for index, node in enumerate(nodes)
+                                             if used & constraints.bit.get(node.name, 0))
+
+    def allowed(vm):
+        mask = everywhere
+        for index, node in enumerate(nodes):
+            if constraints is not None and not constraints.vm_info(vm)[0] & constraints.bit.get(node.name, 0):
+                mask &= ~(1 << index)
+            elif storage_state is not None and not storage_state.allows(vm, node):
+                mask &= ~(1 << index)
+        return mask
+
+    for node in nodes:
+        state['free_mem'].append(node.freemem - node.minfreemem)
+        state['free_cpu'].append(node.freecpu - node.minfreecpu)
+        state['free_disk'].append(dict(storage_state.free.get(node.name, {})) if storage_state is not None else {})
+
+        # Stopped VMs don't need restarting; biggest first for placement
+        # (charged at their demand on their current node)
+        vms = []
+        for vm in node.allocated_vms:
+            if running_only and vm.status != 'running':
+                continue
+            groups = tuple(group for group in constraints.vm_info(vm)[1] if group in state['kinds']) \
+                if constraints is not None else ()
+            disks = tuple(storage_state.vm_info(vm)[1]) if storage_state is not None else ()
+            vms.append((vm.name,) + tuple(node.demand(vm)) + (allowed(vm), groups, disks))
+        vms.sort(key=lambda v: (v[1], v[2]), reverse=True)
+        state['vms'].append(vms)
+
+    return state
+
+
+def fits(state, used, free_disk, index, allowed, groups, disks):
+    '''True if a VM's constraints and local disks let it onto node index'''
+
+    bit = 1 << index
+    if not allowed & bit:
+        return False
+    for group in groups:
+        kind = state['kinds'][group]
+        if kind == 'anti-affinity' and used[group] & bit:
+            return False
+        if kind == 'affinity' and used[group] and not used[group] & bit:
+            return False
+    needed = {}
+    for storage, size in disks:
+        needed[storage] = needed.get(storage, 0) + size
+    return all(free_disk[index].get(storage, 0) >= size for storage, size in needed.items())
+
+
+def set_base(state):
+    global BASE    # pylint: disable=global-statement
+    BASE = state
+
+
+def scenario(failed, state=None):
+    '''Fail the nodes at the given indexes and re-place their VMs,
+    best fit by memory.  Returns a result dict.'''
+
+    state = state or BASE
+
+    free_mem = state['free_mem'][:]
+    free_cpu = state['free_cpu'][:]
+    free_disk = state['free_disk'][:]    # a node's dict is copied when first changed
+    used = dict(state['used'])
+
+    displaced = []
+    gone = 0
+    for index in failed:
+        displaced.extend(state['vms'][index])
+        free_mem[index] = free_cpu[index] = float('-inf')
+        gone |= 1 << index
+    for group in used:
+        used[group] &= ~gone
+
+    displaced.sort(key=lambda v: (v[1], v[2]), reverse=True)
+
+    stranded = []
+    moves = []
+    copied = set()
+    for name, mem, cpu, allowed, groups, disks in displaced:
+        best = None
+        for index, avail in enumerate(free_mem):
+            # same test as Node.has_space() and Node.allows()
+            if avail > mem and free_cpu[index] > cpu and (best is None or avail < free_mem[best]):
+                if fits(state, used, free_disk, index, allowed, groups, disks):
+                    best = index
+        if best is None:
+            stranded.append((name, mem, cpu))
+            continue
+
+        free_mem[best] -= mem
+        free_cpu[best] -= cpu
+        for group in groups:
+            used[group] |= 1 << best
+        if disks:
+            if best not in copied:
+                free_disk[best] = dict(free_disk[best])
+                copied.add(best)
+            for storage, size in disks:
+                free_disk[best][storage] = free_disk[best].get(storage, 0) - size
+        moves.append((name, state['names'][best]))
+
+    # what the stranded VMs need beyond the headroom the survivors have left
+    headroom_mem = sum(free for free in free_mem if free > 0)
+    headroom_cpu = sum(free for free in free_cpu if free > 0)
+
+    return {
+        'failed': [state['names'][index] for index in failed],
+        'displaced': len(displaced),
+        'stranded': [name for name, mem, cpu in stranded],
+        'short_mem_gb': max(0, sum(mem for name, mem, cpu in stranded) - headroom_mem) / 2**30 if stranded else 0.0,
+        'short_cpu': max(0, sum(cpu for name, mem, cpu in stranded) - headroom_cpu) if stranded else 0,
+        'moves': moves,
+    }
+
+
+def scenarios(num_nodes, max_failures=1, limit=None):
+    '''Every combination of 1..max_failures failed node indexes, up to limit'''
+    combos = itertools.chain.from_iterable(
+        itertools.combinations(range(num_nodes), k) for k in range(1, max_failures+1))
+    return itertools.islice(combos, limit)
+
+
+def simulate(nodes, max_failures=1, limit=10000, workers=None, running_only=True):
+    '''Run every failure scenario against a placement (a list of packed
+    nodes).  Returns the list of result dicts, worst first.'''
+
+    state = base_state(nodes, running_only=running_only)
+    combos = list(scenarios(len(nodes), max_failures, limit))
+
+    log.info("Simulating %d failure scenarios over %d nodes", len(combos), len(nodes))
+
+    if workers == 1 or len(combos) < 64:
+        results = [scenario(failed, state) for failed in combos]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_base, initargs=(state,)) as pool:
+            results = list(pool.map(scenario, combos, chunksize=max(1, len(combos) // 256)))
+
+    results.sort(key=lambda r: (len(r['stranded']), r['short_mem_gb'], r['short_cpu']), reverse=True)
+    return results
+
+
+def report(results, writer, show_ok=False):
+    '''Write the failure scenarios that strand VMs (all of them, with
+    show_ok) to a report.ReportWriter'''
+
+    bad = 0
+    for result in results:
+        if result['stranded']:
+            bad += 1
+        elif not show_ok:
+            continue
+        writer.failure(result)
+
+    writer.message("{} of {} failure scenarios strand VMs.".format(bad, len(results)))
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+'''A local stand-in for the parts of the Proxmox API this project uses,
+so the collectors can be exercised (and timed) without a live cluster.
+
+Serves plain HTTP on localhost.  Data comes from a pair of JSON dumps
+(nodes.json/vms.json, as written by dump_resources.py) or from a
+synthetic cluster of any size.  Latency, jitter and error injection are
+configurable per server.'''
+
+# Endpoints (all under /api2/json):
+#   POST access/ticket
+#   GET  nodes
+#   GET  cluster/resources[?type=vm]
+#   GET  nodes/{node}/status
+#   GET  nodes/{node}/storage
+#   GET  nodes/{node}/{qemu|lxc}/{vmid}/config
+#   GET  nodes/{node}/{qemu|lxc}/{vmid}/rrddata
+#   POST nodes/{node}/{qemu|lxc}/{vmid}/migrate
+#   GET  nodes/{node}/tasks/{upid}/status
+
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger(__name__)
+
+GB = 2**30
+
+# rrddata returns roughly this many points whatever the timeframe
+RRD_POINTS = 70
+RRD_STEP = {'hour': 60, 'day': 1800, 'week': 10800, 'month': 43200, 'year': 604800}
+
+
+
+def load_json(node_file, vm_file):
+    '''Read a pair of dumps, returning (node_list, vm_list) of API dicts.'''
+    with open(node_file) as fp:
+        node_list = json.load(fp)['data']
+    with open(vm_file) as fp:
+        vm_list = json.load(fp)['data']
+    return node_list, vm_list
+
+
+
+def synthetic_cluster(num_nodes=10, num_vms=100, seed=0):
+    '''Make up a plausible cluster, returned as (node_list, vm_list) of API dicts.'''
+
+    rnd = random.Random(seed)
+
+    node_shapes = [(24, 64), (32, 128), (40, 128), (48, 256), (64, 512)]
+    vm_cpus = [1, 1, 2, 2, 2, 4, 4, 8, 16]
+    vm_mems = [1, 2, 2, 4, 4, 8, 8, 16, 32, 64]
+    pools = ['ibbr', 'research', 'infra', 'web', None]
+
+    node_list = []
+    for i in range(num_nodes):
+        maxcpu, maxmem = rnd.choice(node_shapes)
+        node_list.append({
+            'node': 'pve{}'.format(i+1),
+            'id': 'node/pve{}'.format(i+1),
+            'type': 'node',
+            'status': 'online',
+            'level': '',
+            'maxcpu': maxcpu,
+            'cpu': rnd.uniform(0.01, 0.6),
+            'maxmem': maxmem * GB,
+            'mem': 0,
+            'maxdisk': 64 * GB,
+            'disk': rnd.randint(4, 40) * GB,
+            'uptime': rnd.randint(10**5, 10**7),
+            'ssl_fingerprint': '',
+        })
+
+    vm_list = []
+    for i in range(num_vms):
+        node = node_list[i % num_nodes]
+        vmid = 100 + i
+        maxmem = rnd.choice(vm_mems) * GB
+        uptime = rnd.randint(600, 10**7)
+        vm = {
+            'vmid': vmid,
+            'id': 'qemu/{}'.format(vmid),
+            'name': 'vm{}'.format(vmid),
+            'type': 'qemu',
+            'node': node['node'],
+            'status': 'running' if rnd.random() < 0.9 else 'stopped',
+            'template': 0,
+            'maxcpu': rnd.choice(vm_cpus),
+            'cpu': rnd.betavariate(1.2, 6),
+            'maxmem': maxmem,
+            'mem': int(maxmem * rnd.uniform(0.1, 0.95)),
+            'maxdisk': rnd.choice([16, 32, 64, 128]) * GB,
+            'disk': 0,
+            'uptime': uptime,
+            'netin': rnd.randint(0, 10**6) * uptime,
+            'netout': rnd.randint(0, 10**6) * uptime,
+            'diskread': rnd.randint(0, 10**6) * uptime,
+            'diskwrite': rnd.randint(0, 10**6) * uptime,
+        }
+        pool = rnd.choice(pools)
+        if pool:
+            vm['pool'] = pool
+        node['mem'] += vm['mem'] if vm['status'] == 'running' else 0
+        vm_list.append(vm)
+
+    return node_list, vm_list
+
+
+
+class FakePVE:
+    '''The fake API server.  start() runs it on a background thread;
+    port 0 picks a free port (see .port afterwards).  error_rate is the
+    share of API calls answered with a 503; logins are spared, since
+    PVEClient doesn't retry them.'''
+
+    def __init__(self, node_list, vm_list, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, migrate_seconds=2.0, user='monitoring@pve', password='monitoring', seed=None):
+
+        self.nodes = {n['node']: dict(n) for n in node_list}
+        self.vms = {str(v['vmid']): dict(v) for v in vm_list}
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.migrate_seconds = migrate_seconds
+        self.user = user
+        self.password = password
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tickets = set()
+        self.tasks = {}
+        self.requests = 0
+        self.logins = 0
+
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        log.info("Fake PVE API listening on http://%s:%d/api2/json", self.host, self.port)
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def client_options(self):
+        '''Keyword arguments for PVEClient/PVE pointing at this server.'''
+        return {'port': self.port, 'scheme': 'http', 'ticket_cache': False}
+
+
+    ####################################################################
+    # API implementation.  Each returns (status, data).
+
+    def login(self, form):
+        if form.get('username') != self.user or form.get('password') != self.password:
+            return 401, None
+
+        with self.lock:
+            self.logins += 1
+            ticket = 'PVE:{}:{:08X}'.format(self.user, self.random.getrandbits(32))
+            self.tickets.add(ticket)
+
+        return 200, {'ticket': ticket, 'CSRFPreventionToken': 'csrf-' + ticket, 'username': self.user}
+
+
+    def get_nodes(self):
+        return 200, list(self.nodes.values())
+
+
+    def get_resources(self, rtype=None):
+        with self.lock:
+            vms = [dict(v) for v in self.vms.values()]
+        if rtype in (None, 'vm'):
+            return 200, vms
+        if rtype == 'node':
+            return 200, list(self.nodes.values())
+        return 200, []
+
+
+    def get_node_status(self, node):
+        if node not in self.nodes:
+            return 404, None
+        n = self.nodes[node]
+        return 200, {
+            'cpu': n['cpu'],
+            'uptime': n['uptime'],
+            'cpuinfo': {'cpus': n['maxcpu']},
+            'memory': {'total': n['maxmem'], 'used': n['mem'], 'free': n['maxmem'] - n['mem']},
+            'rootfs': {'total': n['maxdisk'], 'used': n['disk']},
+        }
+
+
+    def get_node_storage(self, node):
+        if node not in self.nodes:
+            return 404, None
+
+        # Every node has local storage and the ceph pool; only some
+        # mount the NFS share.  Seeded per node, like rrddata.
+        rnd = random.Random(node)
+        storages = [
+            ('local', 'dir', 0, self.nodes[node]['maxdisk'], self.nodes[node]['disk']),
+            ('local-lvm', 'lvmthin', 0, 1024 * GB, rnd.randint(100, 900) * GB),
+            ('ceph', 'rbd', 1, 50 * 1024 * GB, 20 * 1024 * GB),
+        ]
+        if rnd.random() < 0.5:
+            storages.append(('nfs', 'nfs', 1, 10 * 1024 * GB, 3 * 1024 * GB))
+
+        return 200, [{'storage': name, 'type': stype, 'shared': shared, 'active': 1, 'enabled': 1,
+                      'total': total, 'used': used, 'avail': total - used}
+                     for name, stype, shared, total, used in storages]
+
+
+    def get_vm_config(self, node, vmid):
+        vm = self.vms.get(vmid)
+        if vm is None or vm['node'] != node:
+            return 404, None
+
+        # Most disks are on ceph, some local, a few on NFS
+        rnd = random.Random(vm['vmid'])
+        storage = rnd.choices(['ceph', 'local-lvm', 'nfs'], weights=[75, 15, 10])[0]
+        config = {
+            'name': vm['name'],
+            'cores': vm['maxcpu'],
+            'memory': vm['maxmem'] // 2**20,
+            'scsi0': '{}:vm-{}-disk-0,size={}G'.format(storage, vmid, vm['maxdisk'] // GB),
+            'ide2': 'none,media=cdrom',
+        }
+        if rnd.random() < 0.2:
+            config['scsi1'] = 'ceph:vm-{}-disk-1,size=100G'.format(vmid)
+        return 200, config
+
+
+    def get_rrddata(self, node, vmid, timeframe='hour'):
+        vm = self.vms.get(vmid)
+        if vm is None or vm['node'] != node:
+            return 404, None
+
+        # Noise around the current sample, seeded per VM so repeated
+        # fetches agree with each other.
+        rnd = random.Random(vm['vmid'])
+        step = RRD_STEP.get(timeframe, 60)
+        now = int(time.time()) // step * step
+
+        points = []
+        for i in range(RRD_POINTS):
+            points.append({
+                'time': now - (RRD_POINTS - i) * step,
+                'cpu': min(1.0, vm['cpu'] * rnd.lognormvariate(0, 0.5)),
+                'maxcpu': vm['maxcpu'],
+                'mem': min(vm['maxmem'], vm['mem'] * rnd.uniform(0.7, 1.1)),
+                'maxmem': vm['maxmem'],
+                'netin': rnd.uniform(0, 10**6),
+                'netout': rnd.uniform(0, 10**6),
+                'diskread': rnd.uniform(0, 10**6),
+                'diskwrite': rnd.uniform(0, 10**6),
+            })
+        return 200, points
+
+
+    def migrate(self, node, vmid, form):
+        vm = self.vms.get(vmid)
+        target = form.get('target')
+        if vm is None or vm['node'] != node:
+            return 404, None
+        if target not in self.nodes or target == node:
+            return 400, None
+
+        upid = 'UPID:{}:{:08X}:qmigrate:{}:{}:'.format(node, self.random.getrandbits(32), vmid, self.user)
+        with self.lock:
+            self.tasks[upid] = {'node': node, 'vmid': vmid, 'target': target,
+                                'start': time.time(), 'status': 'running'}
+        return 200, upid
+
+
+    def get_task_status(self, node, upid):
+        task = self.tasks.get(upid)
+        if task is None or task['node'] != node:
+            return 404, None
+
+        with self.lock:
+            if task['status'] == 'running' and time.time() - task['start'] >= self.migrate_seconds:
+                task['status'] = 'stopped'
+                self.vms[task['vmid']]['node'] = task['target']
+
+        data = {'upid': upid, 'node': node, 'type': 'qmigrate', 'status': task['status']}
+        if task['status'] == 'stopped':
+            data['exitstatus'] = 'OK'
+        return 200, data
+
+
+    def dispatch(self, method, path, query, form, cookie):
+        '''Route one request.'''
+
+        with self.lock:
+            self.requests += 1
+
+        if path == 'access/ticket' and method == 'POST':
+            return self.login(form)
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 503, None
+
+        ticket = re.search(r'PVEAuthCookie=([^;]+)', cookie or '')
+        if not ticket or ticket.group(1) not in self.tickets:
+            return 401, None
+
+        parts = path.split('/')
+
+        if method == 'GET':
+            if path == 'nodes':
+                return self.get_nodes()
+            if path == 'cluster/resources':
+                return self.get_resources(query.get('type'))
+            if len(parts) == 3 and parts[0] == 'nodes' and parts[2] == 'status':
+                return self.get_node_status(parts[1])
+            if len(parts) == 3 and parts[0] == 'nodes' and parts[2] == 'storage':
+                return self.get_node_storage(parts[1])
+            if len(parts) == 5 and parts[0] == 'nodes' and parts[4] == 'config':
+                return self.get_vm_config(parts[1], parts[3])
+            if len(parts) == 5 and parts[0] == 'nodes' and parts[4] == 'rrddata':
+                return self.get_rrddata(parts[1], parts[3], query.get('timeframe', 'hour'))
+            if len(parts) == 5 and parts[0] == 'nodes' and parts[2] == 'tasks' and parts[4] == 'status':
+                return self.get_task_status(parts[1], parts[3])
+
+        if method == 'POST':
+            if len(parts) == 5 and parts[0] == 'nodes' and parts[4] == 'migrate':
+                return self.migrate(parts[1], parts[3], form)
+
+        return 501, None
+
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            '''Glue between http.server and FakePVE.dispatch'''
+
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):    # pylint: disable=redefined-builtin
+                log.debug(format, *args)
+
+            def _serve(self, method):
+                url = urlsplit(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+                form = {}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    form = {k: v[-1] for k, v in parse_qs(body).items()}
+
+                delay = fake.latency + (fake.random.uniform(-fake.jitter, fake.jitter) if fake.jitter else 0)
+                if delay > 0:
+                    time.sleep(delay)
+
+                path = url.path
+                if path.startswith('/api2/json/'):
+                    path = path[len('/api2/json/'):]
+                status, data = fake.dispatch(method, path.strip('/'), query, form, self.headers.get('Cookie'))
+
+                body = json.dumps({'data': data}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json;charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._serve('GET')
+
+            def do_POST(self):
+                self._serve('POST')
+
+        return Handler
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve a fake Proxmox API for offline testing and benchmarks.')
+    parser.add_argument('json_files', nargs='*', help="nodes.json and vms.json to serve (default: synthetic cluster)")
+    parser.add_argument('--nodes', type=int, default=10, help="Nodes in the synthetic cluster")
+    parser.add_argument('--vms', type=int, default=100, help="VMs in the synthetic cluster")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic cluster and injected faults")
+    parser.add_argument('--port', type=int, default=8006)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random +/- seconds on top of --latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests (other than logins) answered with a 503")
+    parser.add_argument('--migrate-seconds', type=float, default=2.0, help="How long a migration task runs")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=max(1, 20 - options.verbose * 10))
+
+    if options.json_files:
+        if len(options.json_files) != 2:
+            parser.print_help()
+            sys.exit(1)
+        data = load_json(*options.json_files)
+    else:
+        data = synthetic_cluster(options.nodes, options.vms, seed=options.seed)
+
+    fake = FakePVE(*data, port=options.port, latency=options.latency, jitter=options.jitter,
+                   error_rate=options.error_rate, migrate_seconds=options.migrate_seconds, seed=options.seed)
+    fake.start()
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -1,17 +1,61 @@
 '''PICTUERS!'''
 
+# Rendering is split in two.  graphics() works out, for every node, the
+# image size, the minfree lines and the box for each VM (a "layout", a
+# plain dict).  Turning layouts into PNGs happens in save(), on a pool
+# of worker processes for big clusters.  The background of a node image
+# (tick marks and minfree lines) only depends on the node's shape, so it
+# is drawn once per shape and cached, both in memory and on disk.
+#
+# A layout says everything about its image (shape, and a box per VM in
+# allocation order, show_allocated's boxes included), so the image is
+# cached on disk under a hash of the layout.  save() only draws layouts
+# not in that cache; the rest are hard linked into place from it.  A
+# manifest next to the output files records the hash (and size and
+# mtime) each one was last written with, and files that still match
+# are not touched at all.  On a cluster whose placements haven't
+# changed, a run writes no image files.
+
+import os
+import json
+import shutil
+import time
+import zlib
+import struct
+import hashlib
 import logging
+import functools
+
+from concurrent.futures import ProcessPoolExecutor
+
 from PIL import Image, ImageDraw
 
+from cachedir import cache_dir
+
+log = logging.getLogger(__name__)
+
+# Below this many images, forking a pool costs more than it saves.
+POOL_THRESHOLD = 16
+
+# Bump when drawing changes, so cached images are redrawn.
+RENDER_VERSION = 1
+
+# Node images kept in the cache (least recently used go first)
+IMAGE_CACHE_SIZE = 4096
+
+MANIFEST = '.pve-balance-images.json'
+
+
 class graphics:
     '''Catch-all graphics class to draw the representations of VMs allocated to Hypervisors'''
 
-    def __init__(self, nodes, height=None, width=None, filename=None, show_allocated=False):
+    def __init__(self, nodes, height=None, width=None, filename=None, show_allocated=False, workers=None):
 
         self.log = logging.getLogger(__name__)
 
         self.height = height
         self.width = width
+        self.workers = workers
 
         # this shows the "used" values of the VMs, not just the allocoations
         self.show_allocated=show_allocated
@@ -30,184 +74,462 @@ class graphics:
         self.log.debug("{}: X={}".format(self.x_max, str(xs)))
         self.log.debug("{}: Y={}".format(self.y_max, str(ys)))
 
-        # One image per node
-        self.image = {}
-
         self.px_per_mem_gb = width  / self.x_max
         self.px_per_cpu    = height / self.y_max
 
         self.log.debug("MaximumX: {:>.1f}/{:>.1f}px MaximumY: {}/{:>.1f}px".format(self.x_max, self.px_per_mem_gb, self.y_max, self.px_per_cpu))
 
-        for node in nodes:
+        # One layout per node
+        self.layouts = [self.layout(node, filename) for node in nodes]
+
+
+    def layout(self, node, filename=None):
+        '''Work out everything needed to draw one node: the image size,
+        the minfree lines and a box per allocated VM.'''
 
-            # width and height in px of the image for this node.
-            w = int(node.maxmem_gb / self.x_max * width)
-            h = int(node.maxcpu / self.y_max * height)
+        # width and height in px of the image for this node.
+        w = int(node.maxmem_gb / self.x_max * self.width)
+        h = int(node.maxcpu / self.y_max * self.height)
 
-            # minfree lines for CPU (Y-axis, so horiz. line) and MEM (X-axis, so vert. line)
-            cpu_y = node.minfreecpu * self.px_per_cpu
-            mem_x = node.minfreemem/2**30 * self.px_per_mem_gb
-            #cpu_y = int(node.minfreecpu/node.maxcpu * height)
-            #mem_x = int(node.minfreemem/2**30/node.maxmem_gb * width)
+        # minfree lines for CPU (Y-axis, so horiz. line) and MEM (X-axis, so vert. line)
+        cpu_y = node.minfreecpu * self.px_per_cpu
+        mem_x = node.minfreemem/2**30 * self.px_per_mem_gb
 
-            self.log.info("Scaling Mem({:.1f})/CPU({}) -> {}x{} (of {}x{})".format(
-                node.maxmem_gb, node.maxcpu, w, h, width, height))
-            self.log.info("  Thresholds at mem:({}-{})={} cpu:({}-{})={}".format(w, mem_x, w-mem_x, h,cpu_y, h-cpu_y))
-            self.log.info("1xCPU={} 1xMemGB={}".format(self.px_per_cpu, self.px_per_mem_gb))
+        self.log.info("Scaling Mem({:.1f})/CPU({}) -> {}x{} (of {}x{})".format(
+            node.maxmem_gb, node.maxcpu, w, h, self.width, self.height))
+        self.log.info("  Thresholds at mem:({}-{})={} cpu:({}-{})={}".format(w, mem_x, w-mem_x, h,cpu_y, h-cpu_y))
+        self.log.info("1xCPU={} 1xMemGB={}".format(self.px_per_cpu, self.px_per_mem_gb))
 
-            self.image_setup(node, w, h, mem_x, cpu_y, filename=filename)
+        layout = {
+            'node': node.name,
+            'filename': image_filename(filename, node.name),
+            # everything the background depends on
+            'shape': (w, h, mem_x, cpu_y, node.maxmem_gb, node.maxcpu, self.px_per_mem_gb, self.px_per_cpu),
+            'boxes': [],
+        }
+
+        px = 0
+        py = 0
+
+        # Loop over all of the VMs that have been allocated to this node.
+        for vm in node.allocated_vms:
+
+            # Note:  we cannot use "vm.node" to get the name of the node we are dealing with,
+            # since that's the "old" placement, not the new packed one one
+
+            # Old bottom-right corners become new top-left corners
+            ox = px
+            oy = py
+
+            # New bottom-right corners are the px_per_metric * the_metrics.
+            # The metrics are what the VM costs this node, which is less
+            # than its allocation when overcommitting (see overcommit.py)
+            mem, cpu = node.demand(vm)
+            px += mem/2**30 * self.px_per_mem_gb
+            py += cpu       * self.px_per_cpu
 
+            self.log.debug("Drawing {} on {} ({}x{})+({}x{})".format(vm.name, node.name, ox, oy, px, py))
+            self.log.debug("        {} area={} area_perc={:.3f} score={}".format(vm.name, vm.area(), vm.area_perc(), vm.score()))
 
-            # Loop over all of the VMs that have been allocated to this node.
+            # A box for the VM In question, and its label.
+            layout['boxes'].append((vm.name, ox, oy, px, py, (0,0,0), (0,0,0,255)))
+
+        if self.show_allocated:
+
+            px = 0
+            py = 0
+
+            # Loop over the VMs AGAIN, to show the acutal "used" amounts
             for vm in node.allocated_vms:
 
-                # Note:  we cannot use "vm.node" to get the name of the node we are dealing with,
-                # since that's the "old" placement, not the new packed one one
+                ox = px
+                oy = py
 
-                # Old bottom-right corners become new top-left corners
-                ox = self.image[node.name]['px']
-                oy = self.image[node.name]['py']
+                px += vm.mem_gb * self.px_per_mem_gb
+                py += max(10, vm.cpu    * self.px_per_cpu * 8)
 
-                # New bottom-right corners are the px_per_metric * the_metrics
-                self.image[node.name]['px'] += vm.maxmem_gb * self.px_per_mem_gb
-                self.image[node.name]['py'] += vm.maxcpu   * self.px_per_cpu
+                self.log.debug("Drawing>{} on {} ({}x{})+({}x{})".format(vm.name, node.name, ox, oy, px, py))
+                self.log.debug("       >{} area={} area_perc={:.3f} score={}".format(vm.name, vm.area(), vm.area_perc(), vm.score()))
 
-                # update shorthand variables.
-                px = self.image[node.name]['px']
-                py = self.image[node.name]['py']
+                layout['boxes'].append((vm.name, ox, oy, px, py, (0,128,0), (128,0,0)))
 
-                self.log.debug("Drawing {} on {} ({}x{})+({}x{})".format(vm.name, node.name, ox, oy, px, py))
-                self.log.debug("        {} area={} area_perc={:.3f} score={}".format(vm.name, vm.area(), vm.area_perc(), vm.score()))
+        return layout
 
-                # Draw a box for the VM In question, and label it.
-                self.draw_vm(node.name, vm.name, ox, oy, px, py)
 
-            if self.show_allocated:
+    def save(self):
+        '''Save the image files, drawing only the ones not already
+        drawn, in parallel if there are many.'''
+
+        workers = self.workers or os.cpu_count() or 1
+        images = cache_dir('images')
+
+        manifests = {}
+        stale = []
+        for layout in self.layouts:
+            layout['hash'] = layout_hash(layout)
+            layout['cached'] = os.path.join(images, '{}.png'.format(layout['hash']))
+            directory, name = os.path.split(os.path.abspath(layout['filename']))
+            if directory not in manifests:
+                manifests[directory] = load_manifest(directory)
+            entry = manifests[directory].get(name)
+            if entry is None or entry['hash'] != layout['hash'] or entry['stat'] != file_stat(layout['filename']) \
+                    or not os.path.exists(layout['cached']):
+                # (an evicted or cleared cache image is drawn again, so
+                # the output goes on sharing it)
+                stale.append(layout)
+
+        missing = [layout for layout in {l['hash']: l for l in stale}.values() if not os.path.exists(layout['cached'])]
+        self.log.info("Images: %d unchanged, %d from cache, %d to draw",
+                      len(self.layouts) - len(stale), len(stale) - len(missing), len(missing))
+
+        if workers == 1 or len(missing) < POOL_THRESHOLD:
+            for layout in missing:
+                render_to_file(layout, layout['cached'])
+        else:
+            # Draw each distinct background before forking, so the workers
+            # all start with a warm template cache.
+            for shape in {layout['shape'] for layout in missing}:
+                template(*shape)
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for fname in pool.map(render_to_file, missing, [l['cached'] for l in missing], chunksize=4):
+                    self.log.debug("Drew %s", fname)
+
+        for layout in stale:
+            link_image(layout['cached'], layout['filename'])
+            directory, name = os.path.split(os.path.abspath(layout['filename']))
+            manifests[directory][name] = {'hash': layout['hash'], 'stat': file_stat(layout['filename'])}
+
+        # mark every image used this run as recently used.  That's the
+        # access time: the output files are links to the same inode, and
+        # their mtimes are in the manifest.
+        now = time.time_ns()
+        for cached in {layout['cached'] for layout in self.layouts}:
+            try:
+                os.utime(cached, ns=(now, os.stat(cached).st_mtime_ns))
+            except FileNotFoundError:
+                # evicted by another run in the meantime
+                pass
+
+        if stale:
+            for directory, manifest in manifests.items():
+                save_manifest(directory, manifest)
+            evict_images(images)
+
+
+
+def layout_hash(layout):
+    '''Hash of everything a node's image depends on'''
+    return hashlib.sha1(json.dumps([RENDER_VERSION, layout['shape'], layout['boxes']]).encode()).hexdigest()
+
+
+def file_stat(filename):
+    '''[size, mtime] of a file, or None if it isn't there'''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
 
-                self.image[node.name]['px'] = 0
-                self.image[node.name]['py'] = 0
 
-                # Loop over the VMs AGAIN, to show the acutal "used" amounts
-                for vm in node.allocated_vms:
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
 
-                    # Note:  we cannot use "vm.node" to get the name of the node we are dealing with,
-                    # since that's the "old" placement, not the new packed one one
 
-                    # Old bottom-right corners become new top-left corners
-                    ox = self.image[node.name]['px']
-                    oy = self.image[node.name]['py']
+def save_manifest(directory, manifest):
+    filename = os.path.join(directory, MANIFEST)
+    tmp = '{}.{}'.format(filename, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp, sort_keys=True)
+    os.replace(tmp, filename)
 
-                    # New bottom-right corners are the px_per_metric * the_metrics
-                    self.image[node.name]['px'] += vm.mem_gb * self.px_per_mem_gb
-                    self.image[node.name]['py'] += max(10, vm.cpu    * self.px_per_cpu * 8)
 
-                    # update shorthand variables.
-                    px = self.image[node.name]['px']
-                    py = self.image[node.name]['py']
+def link_image(source, target):
+    '''Hard link a cached image into place (copy if linking fails),
+    replacing target'''
+    if os.path.exists(target) and os.path.samefile(source, target):
+        # rename() onto another link to the same file does nothing
+        return
+    tmp = '{}.{}'.format(target, os.getpid())
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
 
-                    self.log.debug("Drawing>{} on {} ({}x{})+({}x{})".format(vm.name, node.name, ox, oy, px, py))
-                    self.log.debug("       >{} area={} area_perc={:.3f} score={}".format(vm.name, vm.area(), vm.area_perc(), vm.score()))
 
-                    # Draw a box for the VM In question, and label it.
-                    self.draw_vm(node.name, vm.name, ox, oy, px, py, box_color=(0,128,0), text_color=(128,0,0))
+def evict_images(directory, keep=IMAGE_CACHE_SIZE):
+    '''Drop the least recently used cached images beyond keep'''
+    try:
+        files = [(os.path.getatime(os.path.join(directory, name)), name)
+                 for name in os.listdir(directory) if name.endswith('.png')]
+    except OSError:
+        return
+    files.sort(reverse=True)
+    for atime, name in files[keep:]:
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            pass
 
 
-    def draw_vm(self, node_name, vm_name, ox, oy, px, py, box_color=(0,0,0), text_color=(0,0,0,255)):
-        '''Draw a little box representing a VM'''
-        self.image[node_name]['draw'].rectangle(
-            [(ox, oy), (px, py)],
-            outline=box_color,
-            fill=None
-        )
-        self.image[node_name]['draw'].text((ox+2, oy+1), vm_name, fill=text_color)
 
+def image_filename(filename, node_name):
+    '''Output file name for a node's image: "<filename>-<node>.png", or
+    "<node>.png" without a filename.  Anything but letters, digits, "_",
+    "." and "-" (e.g. the ":" and "/" in cluster strategy names) becomes
+    "-", so the name stays a plain file in the current directory.'''
 
+    import re
 
-    def image_setup(self, node, w, h, mem_x, cpu_y, cpu_ticks=5, mem_gb_ticks=5, filename=None):
-        '''Basic image creation and setup.  Place small and medium tick marks periodically.'''
+    def clean(text):
+        return re.sub(r'[^A-Za-z0-9_.-]+', '-', str(text)).strip('-.') or '-'
 
-        import re
+    if filename is None or not str(filename).strip():
+        return '{}.png'.format(clean(node_name))
 
-        filename = str(filename)
+    filename = str(filename)
+    if filename.endswith('.png'):
+        filename = filename[:-4]
+    return '{}-{}.png'.format(clean(filename), clean(node_name))
 
-        if re.match('^[a-z0-9_.-]+$', filename):
-            if re.match(r'\.png$', filename):
-                fname = '{}-{}'.format(filename, node.name)
-            else:
-                fname = '{}-{}.png'.format(filename, node.name)
 
-        else:
-            fname = '{}.png'.format(node.name)
-
-        filename = node.name
-        # Create a new image
-        self.image[node.name] = {
-            'img': Image.new('RGB', (w, h), (255,255,255)),
-            'filename': fname,
-            'px': 0,
-            'py': 0,
-            'draw': None,
-        }
 
-        # Make a drawing canvas
-        self.image[node.name]['draw'] = ImageDraw.Draw(self.image[node.name]['img'])
+@functools.lru_cache(maxsize=64)
+def template(w, h, mem_x, cpu_y, maxmem_gb, maxcpu, px_per_mem_gb, px_per_cpu):
+    '''Background image for a node of the given shape, with the tick
+    marks and minimum lines.  Cached here and on disk; callers must
+    copy() it before drawing on it.'''
 
-        # tick marks
-        base_tick_length_px = 10
+    key = hashlib.sha1(repr((w, h, mem_x, cpu_y, maxmem_gb, maxcpu, px_per_mem_gb, px_per_cpu)).encode()).hexdigest()
+    cached = os.path.join(cache_dir('templates'), '{}.png'.format(key))
 
-        gb = 0
-        while gb < node.maxmem_gb:
-            x = gb * self.px_per_mem_gb
-            tick_len = base_tick_length_px
+    try:
+        with Image.open(cached) as img:
+            img.load()
+            return img.convert('RGB')
+    except (OSError, ValueError):
+        pass
 
-            if (gb % (mem_gb_ticks * 2)) == 0:
-                tick_len *= 3
-            elif (gb % mem_gb_ticks) == 0:
-                tick_len *= 2
+    img = draw_template(w, h, mem_x, cpu_y, maxmem_gb, maxcpu, px_per_mem_gb, px_per_cpu)
 
-            self.image[node.name]['draw'].line((x, 0, x, tick_len), fill='#00a')   # MEM tickmark, top
-            self.image[node.name]['draw'].line((x, h, x, h-tick_len), fill='#00a') # MEM tickmark, bottom
+    tmp = '{}.{}'.format(cached, os.getpid())
+    img.save(tmp, 'PNG')
+    os.replace(tmp, cached)
 
-            gb += 1
+    return img
 
-        cpu = 0
-        while cpu < node.maxcpu:
-            y = cpu * self.px_per_cpu
-            tick_len = base_tick_length_px
 
-            if (cpu % (cpu_ticks * 2)) == 0:
-                tick_len *= 3
-            elif (cpu % cpu_ticks) == 0:
-                tick_len *= 2
 
-            self.image[node.name]['draw'].line((0,y, tick_len, y), fill='#00a')   # CPU tickmark, left
-            self.image[node.name]['draw'].line((w,y, w-tick_len, y), fill='#00a') # CPU tickmark, right
+def draw_template(w, h, mem_x, cpu_y, maxmem_gb, maxcpu, px_per_mem_gb, px_per_cpu, cpu_ticks=5, mem_gb_ticks=5):
+    '''Basic image creation and setup.  Place small and medium tick marks periodically.'''
 
-            cpu += 1
+    # Create a new image, and a drawing canvas
+    img = Image.new('RGB', (w, h), (255,255,255))
+    draw = ImageDraw.Draw(img)
 
+    # tick marks
+    base_tick_length_px = 10
 
+    gb = 0
+    while gb < maxmem_gb:
+        x = gb * px_per_mem_gb
+        tick_len = base_tick_length_px
 
+        if (gb % (mem_gb_ticks * 2)) == 0:
+            tick_len *= 3
+        elif (gb % mem_gb_ticks) == 0:
+            tick_len *= 2
 
-        # minimum lines
-        self.image[node.name]['draw'].line((0,h-cpu_y,   w,h-cpu_y), fill='#a00')  # min CPU line
-        self.image[node.name]['draw'].line((0,h-cpu_y+1, w,h-cpu_y+1), fill='#a00')  # min CPU line
+        draw.line((x, 0, x, tick_len), fill='#00a')   # MEM tickmark, top
+        draw.line((x, h, x, h-tick_len), fill='#00a') # MEM tickmark, bottom
 
-        self.image[node.name]['draw'].line((w-mem_x,0,   w-mem_x,h), fill='#00a')  # min MEM line
-        self.image[node.name]['draw'].line((w-mem_x+1,0, w-mem_x+1,h), fill='#00a')  # min MEM line
+        gb += 1
 
-        # labels for minimum lines
-        self.image[node.name]['draw'].text((int(w/2), h-cpu_y+1), "Min CPU Limit", align="center", directon='ttb', fill=(0,0,0,255))
-        self.image[node.name]['draw'].text((w-mem_x+3, int(h/2)), "Min MEM", align="left", directon='ltr', fill=(0,0,0,255))
-        self.image[node.name]['draw'].text((w-mem_x+3, int(h/2)+10), "Limit", align="left", directon='ltr', fill=(0,0,0,255))
+    cpu = 0
+    while cpu < maxcpu:
+        y = cpu * px_per_cpu
+        tick_len = base_tick_length_px
 
-        self.log.debug("{}: {}x{}".format(self.image[node.name]['filename'], w, h))
+        if (cpu % (cpu_ticks * 2)) == 0:
+            tick_len *= 3
+        elif (cpu % cpu_ticks) == 0:
+            tick_len *= 2
 
+        draw.line((0,y, tick_len, y), fill='#00a')   # CPU tickmark, left
+        draw.line((w,y, w-tick_len, y), fill='#00a') # CPU tickmark, right
 
+        cpu += 1
 
 
+    # minimum lines
+    draw.line((0,h-cpu_y,   w,h-cpu_y), fill='#a00')  # min CPU line
+    draw.line((0,h-cpu_y+1, w,h-cpu_y+1), fill='#a00')  # min CPU line
 
-    def save(self):
-        '''Save the image file.'''
-        for node in self.image:
-            fname = self.image[node]['filename']
-            self.image[node]['img'].save(fname, 'PNG')
+    draw.line((w-mem_x,0,   w-mem_x,h), fill='#00a')  # min MEM line
+    draw.line((w-mem_x+1,0, w-mem_x+1,h), fill='#00a')  # min MEM line
+
+    # labels for minimum lines
+    draw.text((int(w/2), h-cpu_y+1), "Min CPU Limit", align="center", directon='ttb', fill=(0,0,0,255))
+    draw.text((w-mem_x+3, int(h/2)), "Min MEM", align="left", directon='ltr', fill=(0,0,0,255))
+    draw.text((w-mem_x+3, int(h/2)+10), "Limit", align="left", directon='ltr', fill=(0,0,0,255))
+
+    log.debug("template: {}x{}".format(w, h))
+
+    return img
+
+
+
+def render(layout):
+    '''Draw a node's image from its layout.'''
+
+    img = template(*layout['shape']).copy()
+    draw = ImageDraw.Draw(img)
+
+    for vm_name, ox, oy, px, py, box_color, text_color in layout['boxes']:
+        draw_vm(draw, vm_name, ox, oy, px, py, box_color=box_color, text_color=text_color)
+
+    return img
+
+
+
+def draw_vm(draw, vm_name, ox, oy, px, py, box_color=(0,0,0), text_color=(0,0,0,255)):
+    '''Draw a little box representing a VM'''
+    draw.rectangle(
+        [(ox, oy), (px, py)],
+        outline=box_color,
+        fill=None
+    )
+    draw.text((ox+2, oy+1), vm_name, fill=text_color)
+
+
+
+def render_to_file(layout, filename=None):
+    '''Render a layout and write it out as PNG, to filename (default
+    the layout's own).  Runs in the worker pool.'''
+    filename = filename or layout['filename']
+    img = render(layout)
+    # written under another name and renamed into place, since the old
+    # file may be a hard link into the image cache (see link_image())
+    tmp = '{}.{}.png'.format(filename, os.getpid())
+    img.save(tmp, 'PNG')
+    os.replace(tmp, filename)
+    return filename
+
+
+
+class PNGStream:
+    '''Write an RGB PNG a band of rows at a time, so the whole image
+    never has to exist in memory at once.'''
+
+    def __init__(self, filename, width, height):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.fp = open(filename, 'wb')
+        self.compressor = zlib.compressobj(6)
+        self.pending = []
+        self.pending_len = 0
+
+        self.fp.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+
+    def _chunk(self, kind, data):
+        self.fp.write(struct.pack('>I', len(data)))
+        self.fp.write(kind)
+        self.fp.write(data)
+        self.fp.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+    def _compressed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_len += len(data)
+        if self.pending_len >= 1 << 16:
+            self._chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_len = 0
+
+
+    def write_band(self, band):
+        '''Append an RGB image band, exactly self.width wide.'''
+
+        raw = band.tobytes()
+        stride = self.width * 3
+
+        # each scanline is prefixed with filter type 0 (none)
+        for row in range(band.height):
+            self._compressed(self.compressor.compress(b'\x00' + raw[row*stride:(row+1)*stride]))
+
+        self.rows += band.height
+
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError("PNG declared {} rows but {} were written".format(self.height, self.rows))
+        self._compressed(self.compressor.flush())
+        if self.pending:
+            self._chunk(b'IDAT', b''.join(self.pending))
+        self._chunk(b'IEND', b'')
+        self.fp.close()
+
+
+
+def save_atlas(views, filename, labels=None, columns=None, padding=4, label_height=12):
+    '''Tile the node images of one or more graphics() views into a
+    single PNG.  With one view, nodes are laid out in a grid (columns
+    defaults to roughly square); with several (e.g. one per strategy),
+    each row is a node and each column a view.  Tiles are rendered and
+    written one band of rows at a time, so memory use does not grow
+    with the number of nodes.'''
+
+    import math
+
+    if labels is None:
+        labels = ['' for view in views]
+
+    # list of rows, each a list of (label, layout-or-None)
+    if len(views) == 1:
+        layouts = views[0].layouts
+        columns = columns or max(1, int(math.ceil(math.sqrt(len(layouts)))))
+        rows = [[('{} {}'.format(labels[0], layout['node']).strip(), layout) for layout in layouts[i:i+columns]]
+                for i in range(0, len(layouts), columns)]
+    else:
+        columns = len(views)
+        by_name = [{layout['node']: layout for layout in view.layouts} for view in views]
+        names = []
+        for view in views:
+            for layout in view.layouts:
+                if layout['node'] not in names:
+                    names.append(layout['node'])
+        rows = [[('{} {}'.format(label, name).strip(), index.get(name)) for label, index in zip(labels, by_name)]
+                for name in names]
+
+    all_layouts = [layout for view in views for layout in view.layouts]
+    tile_w = max(layout['shape'][0] for layout in all_layouts) + padding
+    tile_h = max(layout['shape'][1] for layout in all_layouts) + padding + label_height
+
+    stream = PNGStream(filename, columns * tile_w, len(rows) * tile_h)
+
+    for row in rows:
+        band = Image.new('RGB', (columns * tile_w, tile_h), (224,224,224))
+        draw = ImageDraw.Draw(band)
+
+        for column, (label, layout) in enumerate(row):
+            x = column * tile_w
+            draw.text((x+2, 0), label, fill=(0,0,0))
+            if layout is not None:
+                tile = render(layout)
+                band.paste(tile, (x, label_height))
+                tile.close()
+
+        stream.write_band(band)
+        band.close()
+
+    stream.close()
+    log.info("Wrote %dx%d atlas of %d rows to %s", columns * tile_w, len(rows) * tile_h, len(rows), filename)
@@ -0,0 +1,262 @@
+'''Anytime local search to polish a packing.  Takes the nodes returned
+by any pack_* routine and runs simulated annealing over two kinds of
+step: move one VM to another node, or swap two VMs between nodes.
+Every step keeps each node above its minfree limits (and within any
+placement constraints, storage reachability and local disk space).
+Runs until the time budget is spent, the target node count is reached,
+or it is interrupted, and leaves the nodes holding the best layout it
+found.'''
+
+# Objectives, over u = mean of a node's memory and CPU utilisation
+# (of the space above minfree):
+#   nodes    maximise sum(u^2).  Rewards full nodes and empty ones, so
+#            lightly loaded nodes get drained; ties in node count are
+#            broken by it.
+#   balance  minimise sum(u^2), spreading load evenly.
+#
+# A step only changes the utilisation of the two nodes involved, so the
+# objective delta is computed from those two terms alone, O(1) per step.
+
+import math
+import time
+import random
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Layout:
+    '''Flat, mutable copy of a placement that steps work on.'''
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        # placement states to keep in step: constraints, and storage
+        self.states = [state for state in (nodes[0].constraints, nodes[0].storage_state)
+                       if state is not None] if nodes else []
+
+        self.cap_mem = [max(1.0, n.maxmem - n.minfreemem) for n in nodes]
+        self.cap_cpu = [max(1.0, n.maxcpu - n.minfreecpu) for n in nodes]
+        self.free_mem = [n.freemem - n.minfreemem for n in nodes]
+        self.free_cpu = [n.freecpu - n.minfreecpu for n in nodes]
+
+        self.vms = []
+        self.where = []
+        self.count = [0] * len(nodes)
+        for index, node in enumerate(nodes):
+            for vm in node.allocated_vms:
+                self.vms.append(vm)
+                self.where.append(index)
+                self.count[index] += 1
+
+        self.used = sum(1 for c in self.count if c)
+
+
+    def util(self, i, mem_delta=0.0, cpu_delta=0.0):
+        '''Utilisation of node i, optionally after adding the deltas'''
+        used_mem = self.cap_mem[i] - self.free_mem[i] + mem_delta
+        used_cpu = self.cap_cpu[i] - self.free_cpu[i] + cpu_delta
+        return (used_mem / self.cap_mem[i] + used_cpu / self.cap_cpu[i]) / 2
+
+
+    def fits(self, vm, i, mem, cpu, freed_mem=0.0, freed_cpu=0.0):
+        # same test as Node.has_space()
+        return self.free_mem[i] + freed_mem > mem and self.free_cpu[i] + freed_cpu > cpu
+
+
+    def allowed(self, v, i, away=()):
+        '''Constraint and storage check for VM v going to node i, with
+        the VMs in away (indexes) temporarily lifted off their nodes.'''
+
+        if not self.states:
+            return True
+
+        vm, node = self.vms[v], self.nodes[i]
+        lifted = [(w, self.nodes[self.where[w]]) for w in (v,) + tuple(away)]
+        ok = True
+        for state in self.states:
+            for w, lifted_node in lifted:
+                state.unplace(self.vms[w], lifted_node)
+            ok = ok and state.allows(vm, node) and (not hasattr(state, 'has_space') or state.has_space(vm, node))
+            for w, lifted_node in lifted:
+                state.place(self.vms[w], lifted_node)
+        return ok
+
+
+    def move(self, v, i, mem_out, cpu_out, mem_in, cpu_in):
+        '''Move VM v to node i, given its demand on the old and new node'''
+        j = self.where[v]
+        self.free_mem[j] += mem_out
+        self.free_cpu[j] += cpu_out
+        self.free_mem[i] -= mem_in
+        self.free_cpu[i] -= cpu_in
+
+        self.count[j] -= 1
+        if not self.count[j]:
+            self.used -= 1
+        if not self.count[i]:
+            self.used += 1
+        self.count[i] += 1
+
+        for state in self.states:
+            state.unplace(self.vms[v], self.nodes[j])
+            state.place(self.vms[v], self.nodes[i])
+
+        self.where[v] = i
+
+
+    def release(self, where):
+        '''Put the placement states back as they were for where, ready
+        for the Node objects to be rearranged'''
+
+        for state in self.states:
+            for v, (now, then) in enumerate(zip(self.where, where)):
+                if now != then:
+                    state.unplace(self.vms[v], self.nodes[now])
+                    state.place(self.vms[v], self.nodes[then])
+
+
+
+def improve(nodes, budget=5.0, objective='nodes', target=None, seed=None, swap_rate=0.3):
+    '''Polish a packing in place, within budget seconds.  target is a
+    node count to stop at; for the nodes objective it defaults to the
+    lower bound from bounds.py.  Returns a dict of statistics.'''
+
+    if objective not in ('nodes', 'balance'):
+        raise NotImplementedError("Unknown objective {}".format(objective))
+
+    layout = Layout(nodes)
+    rnd = random.Random(seed)
+    sign = -1.0 if objective == 'nodes' else 1.0
+
+    stats = {'iterations': 0, 'accepted': 0, 'nodes_before': layout.used, 'seconds': 0.0}
+
+    if objective == 'nodes' and target is None:
+        import bounds
+        target = bounds.lower_bound(nodes, layout.vms)
+
+    if len(nodes) < 2 or not layout.vms or (target is not None and layout.used <= target):
+        stats['nodes_after'] = layout.used
+        return stats
+
+    def cost():
+        return sign * sum(layout.util(i)**2 for i in range(len(nodes)))
+
+    current = cost()
+    best = (layout.used if objective == 'nodes' else 0, current)
+    start_where = best_where = layout.where[:]
+
+    # Start warm enough to accept a typical uphill step about half the
+    # time, cool geometrically to a thousandth of that by the deadline.
+    t_start = 0.05
+    t_end = t_start / 1000
+
+    start = time.monotonic()
+    deadline = start + budget
+
+    try:
+        while True:
+            stats['iterations'] += 1
+
+            if stats['iterations'] % 256 == 0:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if target is not None and layout.used <= target:
+                    log.info("Reached target of %d nodes", target)
+                    break
+                temperature = t_start * (t_end / t_start) ** ((now - start) / budget)
+            elif stats['iterations'] == 1:
+                temperature = t_start
+
+            v = rnd.randrange(len(layout.vms))
+            a = layout.where[v]
+            vm = layout.vms[v]
+            mem_out, cpu_out = nodes[a].demand(vm)
+
+            if rnd.random() < swap_rate:
+                w = rnd.randrange(len(layout.vms))
+                b = layout.where[w]
+                if b == a:
+                    continue
+                other = layout.vms[w]
+                mem_in, cpu_in = nodes[b].demand(vm)
+                other_out_mem, other_out_cpu = nodes[b].demand(other)
+                other_in_mem, other_in_cpu = nodes[a].demand(other)
+
+                if not (layout.fits(vm, b, mem_in, cpu_in, other_out_mem, other_out_cpu) and
+                        layout.fits(other, a, other_in_mem, other_in_cpu, mem_out, cpu_out)):
+                    continue
+
+                delta = sign * (
+                    layout.util(a, other_in_mem - mem_out, other_in_cpu - cpu_out)**2 - layout.util(a)**2 +
+                    layout.util(b, mem_in - other_out_mem, cpu_in - other_out_cpu)**2 - layout.util(b)**2)
+
+                if delta > 0 and rnd.random() >= math.exp(-delta / temperature):
+                    continue
+                if not (layout.allowed(v, b, (w,)) and layout.allowed(w, a, (v,))):
+                    continue
+
+                # the free lists go briefly negative between the two moves
+                layout.move(v, b, mem_out, cpu_out, mem_in, cpu_in)
+                layout.move(w, a, other_out_mem, other_out_cpu, other_in_mem, other_in_cpu)
+
+            else:
+                b = rnd.randrange(len(nodes))
+                if b == a:
+                    continue
+                mem_in, cpu_in = nodes[b].demand(vm)
+                if not layout.fits(vm, b, mem_in, cpu_in):
+                    continue
+
+                delta = sign * (
+                    layout.util(a, -mem_out, -cpu_out)**2 - layout.util(a)**2 +
+                    layout.util(b, mem_in, cpu_in)**2 - layout.util(b)**2)
+
+                # emptying a node is always worth it when consolidating
+                uphill = delta
+                if objective == 'nodes' and layout.count[a] == 1 and layout.count[b]:
+                    uphill = min(delta, 0.0)
+
+                if uphill > 0 and rnd.random() >= math.exp(-uphill / temperature):
+                    continue
+                if not layout.allowed(v, b):
+                    continue
+
+                layout.move(v, b, mem_out, cpu_out, mem_in, cpu_in)
+
+            stats['accepted'] += 1
+            current += delta
+
+            score = (layout.used if objective == 'nodes' else 0, current)
+            if score < best:
+                best = score
+                best_where = layout.where[:]
+
+    except KeyboardInterrupt:
+        log.warning("Local search interrupted, keeping best layout so far")
+
+    layout.release(start_where)
+    apply(nodes, layout.vms, best_where)
+
+    stats['seconds'] = time.monotonic() - start
+    stats['nodes_after'] = best[0] if objective == 'nodes' else sum(1 for n in nodes if n.allocated_vms)
+    log.info("Local search: %(iterations)d steps, %(accepted)d accepted, nodes %(nodes_before)d -> %(nodes_after)d", stats)
+    return stats
+
+
+def apply(nodes, vms, where):
+    '''Rearrange the Node objects to match a layout'''
+
+    current = {}
+    for index, node in enumerate(nodes):
+        for vm in node.allocated_vms:
+            current[id(vm)] = index
+
+    moves = [(vm, current[id(vm)], target) for vm, target in zip(vms, where) if current[id(vm)] != target]
+
+    for vm, source, target in moves:
+        nodes[source].deallocate(vm)
+    for vm, source, target in moves:
+        nodes[target].allocate(vm, force=True)
+
+    log.debug("Applied %d moves", len(moves))
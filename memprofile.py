@@ -0,0 +1,124 @@
+'''Opt-in memory profiling by pipeline stage: JSON parsing, building
+Node/VM objects, the deep copies, each packer, each set of pictures.
+
+For every stage a MemoryProfiler records, from tracemalloc, the memory
+the stage left allocated (retained) and the most it had allocated at
+once (peak), plus the process RSS afterwards and its high-water mark,
+and the allocation sites (file:line) that grew the most.  write() saves
+it all as JSON, with the cluster size, so footprint can be tracked
+against cluster size from run to run.
+
+A disabled profiler (the default) makes stage() a no-op, so callers
+wrap their stages unconditionally.  tracemalloc slows Python down a
+good deal while it's on, so timings from a profiled run are not
+representative.'''
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import contextlib
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+
+def rss():
+    '''(current, peak) resident set size in bytes.  Current needs
+    /proc; where there is none it is reported as the peak.'''
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = usage if sys.platform == 'darwin' else usage * 1024
+    try:
+        with open('/proc/self/statm') as fp:
+            current = int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        current = peak
+    return current, peak
+
+
+
+class MemoryProfiler:
+    '''Memory use per named stage.'''
+
+    def __init__(self, enabled=False, top=10, frames=1):
+        self.enabled = enabled
+        self.top = top
+        self.frames = frames
+        self.stages = []
+        self.info = {}
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+
+    def note(self, **info):
+        '''Extra facts for the report, e.g. nodes=..., vms=...'''
+        self.info.update(info)
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Profile the code run inside the with block as one stage'''
+
+        if not self.enabled:
+            yield
+            return
+
+        before = tracemalloc.take_snapshot()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            traced_after, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            current_rss, peak_rss = rss()
+
+            # leave out tracemalloc's own bookkeeping
+            ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            after = after.filter_traces(ignore)
+            before = before.filter_traces(ignore)
+
+            top = []
+            for diff in after.compare_to(before, 'lineno')[:self.top]:
+                frame = diff.traceback[0]
+                top.append({'site': '{}:{}'.format(frame.filename, frame.lineno),
+                            'size': diff.size_diff, 'count': diff.count_diff})
+
+            record = {
+                'stage': name,
+                'seconds': round(elapsed, 4),
+                'traced_before': traced_before,
+                'retained': traced_after - traced_before,
+                'peak': peak - traced_before,
+                'rss': current_rss,
+                'rss_peak': peak_rss,
+                'top': top,
+            }
+            self.stages.append(record)
+            log.info("Memory %s: retained %.1fMB, peak +%.1fMB, RSS %.1fMB", name,
+                     record['retained'] / 2**20, record['peak'] / 2**20, current_rss / 2**20)
+
+
+    def report(self):
+        return dict(self.info, stages=self.stages,
+                    peak=max((s['traced_before'] + s['peak'] for s in self.stages), default=0),
+                    rss_peak=rss()[1])
+
+
+    def write(self, filename):
+        '''Save the report as JSON ('-' for stdout)'''
+        if not self.enabled:
+            return
+        if filename == '-':
+            json.dump(self.report(), sys.stdout, indent=2)
+            sys.stdout.write('\n')
+            return
+        with open(filename, 'w') as fp:
+            json.dump(self.report(), fp, indent=2)
+        log.info("Wrote memory profile to %s", filename)
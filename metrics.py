@@ -0,0 +1,318 @@
+'''Prometheus metrics for the balancer: node and cluster health as the
+packings see it, and how long collection and packing take.
+
+Metrics live in a Registry and are rendered in the Prometheus text
+exposition format, either served over HTTP (serve(), GET /metrics, on a
+background thread) or written to a file for node_exporter's textfile
+collector (write_textfile()).
+
+Recording a value is a dict update under a per-metric lock, so it can
+sit in hot paths (Node.allocate() counts every attempt); rendering
+copies each metric's values under the same lock and formats outside it,
+so a scrape never holds up collection or packing for longer than that.'''
+
+# Metric names follow the Prometheus conventions: a pve_balance_ prefix,
+# base units (seconds, bytes), _total on counters.  Histograms render as
+# cumulative _bucket{le=...} series plus _sum and _count.
+#
+# Worker processes (sweep.py, replay.py, --partition) have their own
+# registries, and what they record stays there.
+
+import os
+import math
+import time
+import logging
+import threading
+import functools
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+
+class Metric:
+    '''One metric family: a counter, gauge or histogram, with labels.'''
+
+    def __init__(self, name, help_text, kind, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("{} takes labels {}, got {}".format(self.name, self.labels, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+    def observe(self, value, **labels):
+        '''Add a histogram observation'''
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+
+    def time(self, **labels):
+        '''Context manager observing (or, for a gauge, setting) the seconds taken'''
+        return Timer(self, labels)
+
+
+    def clear(self):
+        '''Forget all label sets, e.g. nodes that have gone away'''
+        with self.lock:
+            self.values = {}
+
+
+    def render(self):
+        with self.lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for key in sorted(values):
+            value = values[key]
+            if self.kind == 'histogram':
+                for bound, count in zip(self.buckets + (math.inf,), value[:-2] + [value[-2]]):
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, format_labels(self.labels, key, [('le', format_value(float(bound)))]), count))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, key), format_value(value[-1])))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), value[-2]))
+            else:
+                lines.append('{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value)))
+        return lines
+
+
+
+class Timer:
+
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.metric.kind == 'histogram':
+            self.metric.observe(elapsed, **self.labels)
+        else:
+            self.metric.set(elapsed, **self.labels)
+
+
+
+class Registry:
+    '''A set of metrics, rendered together.'''
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.add(Metric(name, help_text, 'counter', labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self.add(Metric(name, help_text, 'gauge', labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Metric(name, help_text, 'histogram', labels, buckets))
+
+    def render(self):
+        '''The whole registry in the text exposition format'''
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+
+REGISTRY = Registry()
+
+# runtime
+ALLOCATIONS = REGISTRY.counter('pve_balance_allocations_total',
+                               "VM placement attempts on a node, by result (placed, rejected, forced)", ['result'])
+API_SECONDS = REGISTRY.histogram('pve_balance_api_request_seconds', "Proxmox API request latency", ['method'])
+COLLECT_SECONDS = REGISTRY.gauge('pve_balance_collect_seconds', "Time taken to collect cluster data", ['what'])
+PACK_SECONDS = REGISTRY.histogram('pve_balance_pack_seconds', "Time taken by a packing run", ['strategy'])
+
+# per node, for each placement (current, or a strategy's plan)
+NODE_UTILISATION = REGISTRY.gauge('pve_balance_node_utilisation_ratio',
+                                  "Share of a node's CPUs or memory allocated to VMs", ['strategy', 'node', 'resource'])
+NODE_EFFICIENCY = REGISTRY.gauge('pve_balance_node_efficiency_ratio',
+                                 "Packing efficiency of a node (Node.efficency)", ['strategy', 'node'])
+NODE_HEADROOM = REGISTRY.gauge('pve_balance_node_headroom',
+                               "Free CPUs or memory bytes above a node's minfree reserve", ['strategy', 'node', 'resource'])
+
+# cluster wide
+STRANDED = REGISTRY.gauge('pve_balance_stranded',
+                          "Headroom (CPUs, memory bytes) on nodes with too little of the other resource to take "
+                          "the smallest VM", ['strategy', 'resource'])
+PLACEABLE = REGISTRY.gauge('pve_balance_placeable_vms',
+                           "How many more median sized VMs would fit in the headroom", ['strategy'])
+VMS = REGISTRY.gauge('pve_balance_vms', "VMs placed and left unplaced", ['strategy', 'state'])
+NODES_USED = REGISTRY.gauge('pve_balance_nodes_used', "Nodes with VMs on them", ['strategy'])
+NODES_BOUND = REGISTRY.gauge('pve_balance_nodes_lower_bound', "Fewest nodes that could hold every VM", ['strategy'])
+GAP = REGISTRY.gauge('pve_balance_optimality_gap_ratio', "Nodes used over the lower bound, less one", ['strategy'])
+
+
+def timed(metric, label='strategy'):
+    '''Decorator timing each call into metric, labelled with the function name'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metric.time(**{label: function.__name__}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def headroom(node):
+    '''(memory bytes, cpus) free above minfree'''
+    return node.freemem - node.minfreemem, node.freecpu - node.minfreecpu
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+def observe_nodes(strategy, nodes, vms=()):
+    '''Record per node figures for one placement, and the stranded and
+    placeable capacity.  vms gives the VM sizes to judge those by.'''
+
+    online = [node for node in nodes if node.status == 'online']
+    for node in online:
+        mem, cpu = headroom(node)
+        NODE_UTILISATION.set((node.maxcpu - node.freecpu) / node.maxcpu, strategy=strategy, node=node.name, resource='cpu')
+        NODE_UTILISATION.set((node.maxmem - node.freemem) / node.maxmem, strategy=strategy, node=node.name, resource='mem')
+        NODE_EFFICIENCY.set(node.efficency(report=False), strategy=strategy, node=node.name)
+        NODE_HEADROOM.set(cpu, strategy=strategy, node=node.name, resource='cpu')
+        NODE_HEADROOM.set(mem, strategy=strategy, node=node.name, resource='mem')
+
+    if not vms:
+        return
+
+    # as in Node.has_space(), a VM needs strictly more than it takes
+    small_mem = min(vm.maxmem for vm in vms)
+    small_cpu = min(vm.maxcpu for vm in vms)
+    mid_mem = median(vm.maxmem for vm in vms) or 1
+    mid_cpu = median(vm.maxcpu for vm in vms) or 1
+
+    stranded_mem = stranded_cpu = placeable = 0
+    for node in online:
+        mem, cpu = headroom(node)
+        if cpu <= small_cpu and mem > 0:
+            stranded_mem += mem
+        if mem <= small_mem and cpu > 0:
+            stranded_cpu += cpu
+        placeable += max(0, min(math.ceil(mem / mid_mem) - 1, math.ceil(cpu / mid_cpu) - 1))
+
+    STRANDED.set(stranded_mem, strategy=strategy, resource='mem')
+    STRANDED.set(stranded_cpu, strategy=strategy, resource='cpu')
+    PLACEABLE.set(placeable, strategy=strategy)
+
+
+def observe_summary(strategy, nodes, placed, unplaced, bound=None):
+    '''Record how a packing came out'''
+
+    import bounds
+
+    used = bounds.nodes_used(nodes)
+    VMS.set(placed, strategy=strategy, state='placed')
+    VMS.set(unplaced, strategy=strategy, state='unplaced')
+    NODES_USED.set(used, strategy=strategy)
+    if bound is not None:
+        NODES_BOUND.set(bound, strategy=strategy)
+        if not unplaced:
+            GAP.set(bounds.gap(used, bound), strategy=strategy)
+
+
+def serve(port, addr='', registry=REGISTRY):
+    '''Serve GET /metrics on a daemon thread.  Returns the server
+    (shutdown() it to stop).'''
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):    # pylint: disable=redefined-builtin
+            log.debug("%s - %s", self.address_string(), format % args)
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving metrics on http://%s:%d/metrics", addr or '0.0.0.0', server.server_address[1])
+    return server
+
+
+def write_textfile(filename, registry=REGISTRY):
+    '''Write the registry out for the textfile collector.  The file is
+    replaced in one go, so the collector never reads half of it.'''
+
+    tmp = '{}.{}'.format(filename, os.getpid())
+    with open(tmp, 'w') as fp:
+        fp.write(registry.render())
+    os.replace(tmp, filename)
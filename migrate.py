@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+'''Carry out a placement plan: migrate every VM that the plan puts on a
+different node, through the Proxmox API, several at a time.
+
+The plan is a packing run here against the live cluster (by default
+pack_balance rebalancing the current placement, which only moves what
+it must; other strategies repack from scratch, and move most VMs) or
+the placement records of a balance.py JSON/JSONL report
+(--format json/jsonl).  plan() diffs it against where the VMs are now,
+and an Executor works through the moves:
+
+  - at most max_concurrent migrations at once, per_node on any one node
+    (as source or target), and per_link between any pair of nodes
+  - a move only starts once its target has room for the VM, counting
+    migrations already headed there, so moves that make room go first
+  - running tasks are polled together every poll_interval seconds, on
+    a thread pool; the answers are dealt with on the calling thread
+  - every so often the VM list is fetched again, and moves whose VM is
+    already on its target (or went elsewhere) are dropped
+  - pause() stops new moves starting, resume() carries on, and abort()
+    lets the running ones finish and starts no more.  From the command
+    line: SIGUSR1 pauses, SIGUSR2 resumes, Ctrl-C aborts.  Ctrl-C is
+    held off while moves are being started and while outcomes are being
+    recorded, so every migration that was asked for keeps its task id
+    and is waited for.
+
+A dry run schedules the moves in waves as if every migration took the
+same time, without touching the cluster, to show the order and how much
+runs in parallel.
+
+Moves that can never start (the plan needs room that only another
+blocked move would free, a cycle) are reported as blocked.'''
+
+import sys
+import time
+import json
+import signal
+import logging
+import argparse
+import threading
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Move.status values
+PENDING, RUNNING, DONE, FAILED, SKIPPED, BLOCKED, ABORTED = \
+    'pending', 'running', 'done', 'failed', 'skipped', 'blocked', 'aborted'
+
+
+@contextmanager
+def holding_interrupts():
+    '''Hold SIGINT off until the end of the block, then deliver it.
+    Does nothing off the main thread, where signals can't be handled.'''
+
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    held = []
+    previous = signal.signal(signal.SIGINT, lambda signum, frame: held.append(signum))
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+        if held:
+            signal.raise_signal(signal.SIGINT)
+
+
+
+class Move:
+    '''One VM migration, and how it went.'''
+
+    def __init__(self, vm, source, target):
+        self.vm = vm
+        self.source = source
+        self.target = target
+        self.status = PENDING
+        self.upid = None
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.wave = None
+
+    def __str__(self):
+        return '{} {} -> {}'.format(self.vm.name, self.source, self.target)
+
+    @property
+    def seconds(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.monotonic()) - self.started
+
+    def row(self):
+        '''The move as a flat dict, for reports'''
+        return {
+            'vmid': self.vm.vmid,
+            'name': self.vm.name,
+            'source': self.source,
+            'target': self.target,
+            'status': self.status,
+            'seconds': None if self.seconds is None else round(self.seconds, 1),
+            'wave': self.wave,
+            'error': self.error,
+        }
+
+
+def plan(packed_nodes, vms):
+    '''Moves taking each VM in vms from its current node (vm.node) to the
+    node packed_nodes put it on.  Bigger VMs first.'''
+
+    current = {str(vm.vmid): vm for vm in vms}
+    moves = []
+    for node in packed_nodes:
+        for packed in node.allocated_vms:
+            vm = current.get(str(packed.vmid))
+            if vm is not None and vm.node != node.name:
+                moves.append(Move(vm, vm.node, node.name))
+    moves.sort(key=lambda m: m.vm.area(), reverse=True)
+    return moves
+
+
+def plan_from_report(filename, vms, strategy):
+    '''Moves for one strategy's placement records in a balance.py JSON
+    or JSON lines report'''
+
+    with open(filename) as fp:
+        text = fp.read()
+    try:
+        records = json.loads(text)
+    except ValueError:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    current = {str(vm.vmid): vm for vm in vms}
+    moves = []
+    for record in records:
+        if record.get('type') != 'placement' or record.get('strategy') != strategy:
+            continue
+        vm = current.get(str(record['vmid']))
+        if vm is None:
+            log.warning("%s (%s) is in the plan but not in the cluster, skipping", record['name'], record['vmid'])
+        elif vm.node != record['node']:
+            moves.append(Move(vm, vm.node, record['node']))
+    moves.sort(key=lambda m: m.vm.area(), reverse=True)
+    return moves
+
+
+
+class Ledger:
+    '''Room left on each node, above minfree, as migrations come and go.
+    A migration holds its VM's room on both nodes until it's done.'''
+
+    def __init__(self, nodes, vms):
+        self.nodes = {node.name: node for node in nodes}
+        self.free = {}
+        for node in nodes:
+            self.free[node.name] = [node.maxmem - node.minfreemem, node.maxcpu - node.minfreecpu]
+        for vm in vms:
+            if vm.node in self.nodes:
+                self.take(vm, vm.node)
+
+    def take(self, vm, node_name):
+        mem, cpu = self.nodes[node_name].demand(vm)
+        self.free[node_name][0] -= mem
+        self.free[node_name][1] -= cpu
+
+    def give(self, vm, node_name):
+        mem, cpu = self.nodes[node_name].demand(vm)
+        self.free[node_name][0] += mem
+        self.free[node_name][1] += cpu
+
+    def fits(self, vm, node_name):
+        # strictly more than the VM takes, as Node.has_space()
+        node = self.nodes.get(node_name)
+        if node is None or node.status != 'online':
+            return False
+        mem, cpu = node.demand(vm)
+        return self.free[node_name][0] > mem and self.free[node_name][1] > cpu
+
+
+
+class Executor:
+    '''Runs a list of Moves against the API (a PVE).'''
+
+    def __init__(self, pve, nodes, vms, moves, max_concurrent=4, per_node=2, per_link=1, poll_interval=2.0,
+                 refresh=30.0, timeout=3600.0, with_local_disks=False, progress=None):
+
+        self.pve = pve
+        self.nodes = nodes
+        self.vms = vms
+        self.moves = moves
+        self.max_concurrent = max_concurrent
+        self.per_node = per_node
+        self.per_link = per_link
+        self.poll_interval = poll_interval
+        self.refresh_interval = refresh
+        self.timeout = timeout
+        self.with_local_disks = with_local_disks
+        self.progress = progress or (lambda move, done, total: None)
+
+        self.ledger = Ledger(nodes, vms)
+        self.running = []
+        self.finished = 0
+
+        self.unpaused = threading.Event()
+        self.unpaused.set()
+        self.aborted = threading.Event()
+
+
+    def pause(self):
+        log.warning("Pausing: no new migrations will start")
+        self.unpaused.clear()
+
+    def resume(self):
+        log.warning("Resuming")
+        self.unpaused.set()
+
+    def abort(self):
+        log.warning("Aborting: waiting for %d running migrations, starting no more", len(self.running))
+        self.aborted.set()
+        self.unpaused.set()
+
+
+    def busy(self, move):
+        '''Would starting move go over a concurrency limit?'''
+        if len(self.running) >= self.max_concurrent:
+            return True
+        link = frozenset((move.source, move.target))
+        per_node = {move.source: 0, move.target: 0}
+        per_link = 0
+        for other in self.running:
+            for name in (other.source, other.target):
+                if name in per_node:
+                    per_node[name] += 1
+            if frozenset((other.source, other.target)) == link:
+                per_link += 1
+        return max(per_node.values()) >= self.per_node or per_link >= self.per_link
+
+
+    def startable(self):
+        '''Pending moves that may start now, in plan order'''
+        chosen = []
+        for move in self.moves:
+            if move.status != PENDING:
+                continue
+            if len(self.running) + len(chosen) >= self.max_concurrent:
+                break
+            if self.busy(move) or not self.ledger.fits(move.vm, move.target):
+                continue
+            chosen.append(move)
+            # hold its room now, so the next one sees it gone
+            self.ledger.take(move.vm, move.target)
+            move.status = RUNNING
+            self.running.append(move)
+        return chosen
+
+
+    def start(self, move):
+        '''Ask for a migration.  Runs in the thread pool, so it only
+        talks to the API; the outcome is handled by started().'''
+        move.started = time.monotonic()
+        try:
+            # recorded straight away: a move with a task id is polled to
+            # the end, whatever happens to this run
+            move.upid = self.pve.migrate(move.vm, move.target, with_local_disks=self.with_local_disks)
+            return move.upid, None
+        except Exception as exc:    # pylint: disable=broad-except
+            return None, exc
+
+
+    def started(self, move, upid, error):
+        if error is not None:
+            self.fail(move, "can't start: {}".format(error))
+            return
+        log.info("Started %s (%s)", move, upid)
+
+
+    def unstarted(self):
+        '''Put back moves that were chosen but never asked for (a run
+        cut short between startable() and start()), giving back the
+        room held for them'''
+        for move in list(self.running):
+            if move.upid is None:
+                log.info("%s was never started", move)
+                self.ledger.give(move.vm, move.target)
+                self.running.remove(move)
+                move.status = PENDING
+                move.started = None
+
+
+    def poll(self, move):
+        '''Fetch a running move's task status.  Runs in the thread pool,
+        like start(); checked() deals with the answer.'''
+        try:
+            return self.pve.task_status(move.source, move.upid)
+        except Exception as exc:    # pylint: disable=broad-except
+            log.warning("Can't check on %s: %s", move, exc)
+            return {'status': 'running'}
+
+
+    def checked(self, move, task):
+        if task.get('status') == 'stopped':
+            if task.get('exitstatus') == 'OK':
+                self.succeed(move)
+            else:
+                self.fail(move, task.get('exitstatus', 'failed'))
+        elif move.seconds > self.timeout:
+            # outcome unknown: keep its room held on both nodes
+            move.status = FAILED
+            move.error = 'timed out'
+            move.finished = time.monotonic()
+            self.done(move)
+
+
+    def succeed(self, move):
+        move.status = DONE
+        move.finished = time.monotonic()
+        self.ledger.give(move.vm, move.source)
+        move.vm.node = move.target
+        self.done(move)
+
+
+    def fail(self, move, error):
+        move.status = FAILED
+        move.error = error
+        move.finished = time.monotonic()
+        self.ledger.give(move.vm, move.target)
+        self.done(move)
+
+
+    def done(self, move):
+        if move in self.running:
+            self.running.remove(move)
+        self.finished += 1
+        self.progress(move, self.finished, len(self.moves))
+
+
+    def refresh(self):
+        '''Drop pending moves that the cluster has overtaken, and bring
+        the ledger up to date with where VMs really are'''
+
+        try:
+            current = {str(v['vmid']): v['node'] for v in self.pve.api.get('cluster/resources', type='vm')}
+        except Exception as exc:    # pylint: disable=broad-except
+            log.warning("Can't refresh the VM list: %s", exc)
+            return
+
+        for vm in self.vms:
+            node = current.get(str(vm.vmid), vm.node)
+            if node == vm.node or any(m.vm is vm for m in self.running):
+                continue
+            log.info("%s has moved from %s to %s by itself", vm.name, vm.node, node)
+            if vm.node in self.ledger.nodes:
+                self.ledger.give(vm, vm.node)
+            if node in self.ledger.nodes:
+                self.ledger.take(vm, node)
+            vm.node = node
+
+        for move in self.moves:
+            if move.status == PENDING and move.vm.node != move.source:
+                move.status = SKIPPED
+                move.error = 'already on {}'.format(move.vm.node)
+                self.done(move)
+
+
+    def run(self):
+        '''Carry out the moves.  Returns them, with their outcomes.'''
+
+        log.info("Migrating %d VMs, up to %d at once (%d per node, %d per link)",
+                 len(self.moves), self.max_concurrent, self.per_node, self.per_link)
+
+        self.unstarted()
+
+        last_refresh = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_concurrent)) as pool:
+            while True:
+                if time.monotonic() - last_refresh >= self.refresh_interval:
+                    self.refresh()
+                    last_refresh = time.monotonic()
+
+                # the pool only makes the API calls; results are dealt
+                # with here, so the ledger and progress have one writer
+                starting = []
+                if self.unpaused.is_set() and not self.aborted.is_set():
+                    with holding_interrupts():
+                        starting = self.startable()
+                        for move, (upid, error) in zip(starting, pool.map(self.start, starting)):
+                            self.started(move, upid, error)
+
+                if not self.running:
+                    pending = any(m.status == PENDING for m in self.moves)
+                    if self.aborted.is_set() or not pending:
+                        break
+                    if self.unpaused.is_set():
+                        if starting:
+                            # they all failed straight away; try the rest
+                            continue
+                        # nothing running, and what's left can't start
+                        break
+                    self.unpaused.wait(self.poll_interval)
+                    continue
+
+                time.sleep(self.poll_interval)
+                running = list(self.running)
+                with holding_interrupts():
+                    for move, task in zip(running, pool.map(self.poll, running)):
+                        self.checked(move, task)
+
+        for move in self.moves:
+            if move.status == PENDING:
+                move.status = ABORTED if self.aborted.is_set() else BLOCKED
+        return self.moves
+
+
+    def dry_run(self):
+        '''Schedule the moves in waves, as if every migration took as
+        long as every other, without touching the cluster'''
+
+        wave = 0
+        while True:
+            started = self.startable()
+            if not started:
+                break
+            wave += 1
+            for move in started:
+                move.wave = wave
+            for move in started:
+                self.succeed(move)
+
+        for move in self.moves:
+            if move.status == PENDING:
+                move.status = BLOCKED
+        return self.moves
+
+
+def summary(moves):
+    counts = {}
+    for move in moves:
+        counts[move.status] = counts.get(move.status, 0) + 1
+    return ', '.join('{} {}'.format(count, status) for status, count in sorted(counts.items()))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--strategy', default='pack_balance',
+                        help="Packing routine to plan with (pack_balance rebalances the current placement; "
+                             "anything else repacks from scratch)")
+    parser.add_argument('--plan', metavar='FILE', help="Use a balance.py JSON/JSONL report's placement instead")
+    parser.add_argument('--plan-strategy', default='packed_balance', help="Which strategy's placement to use from --plan")
+    parser.add_argument('--from-scratch', action='store_true',
+                        help="With pack_balance, plan from scratch rather than rebalance the current placement "
+                             "(which moves most VMs)")
+    parser.add_argument('--max-moves', type=int, default=None, help="With pack_balance, move at most this many VMs")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="Show the order moves would run in, and do nothing")
+    parser.add_argument('-c', '--max-concurrent', type=int, default=4, help="Migrations at once")
+    parser.add_argument('--per-node', type=int, default=2, help="Migrations at once involving any one node")
+    parser.add_argument('--per-link', type=int, default=1, help="Migrations at once between any pair of nodes")
+    parser.add_argument('--poll', type=float, default=2.0, help="Seconds between task status checks")
+    parser.add_argument('--refresh', type=float, default=30.0, help="Seconds between VM list refreshes")
+    parser.add_argument('--timeout', type=float, default=3600.0, help="Give up on a migration after this many seconds")
+    parser.add_argument('--with-local-disks', action='store_true', help="Allow migrations that copy local disks")
+    parser.add_argument('-H', '--host', default='pve5.ad.ibbr.umd.edu', help="Hostname to connect to proxmox API endpoint")
+    parser.add_argument('-u', '--username', default='monitoring@pve', help="Proxmox API username")
+    parser.add_argument('-p', '--password', default='monitoring', help="Proxmox API password")
+    parser.add_argument('--port', type=int, default=8006)
+    parser.add_argument('--scheme', default='https')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=max(1, 30 - options.verbose * 10))
+
+    from PVE import PVE
+    import packing
+
+    P = PVE(host=options.host, u=options.username, pw=options.password, port=options.port, scheme=options.scheme)
+    nodes = P.get_nodes(full=True)
+    vms = P.get_vms(full=True)
+
+    if options.plan:
+        moves = plan_from_report(options.plan, vms, options.plan_strategy)
+    else:
+        params = {'current': not options.from_scratch, 'moves': options.max_moves} if options.strategy == 'pack_balance' else {}
+        packed_nodes, placed, unplaced = getattr(packing, options.strategy)(nodes, vms, key='area', **params)
+        moves = plan(packed_nodes, vms)
+
+    def progress(move, done, total):
+        print('[{}/{}] {:30} {:8} {}'.format(done, total, str(move), move.status,
+                                             move.error or '{:.0f}s'.format(move.seconds or 0)), flush=True)
+
+    executor = Executor(P, nodes, vms, moves, max_concurrent=options.max_concurrent, per_node=options.per_node,
+                        per_link=options.per_link, poll_interval=options.poll, refresh=options.refresh,
+                        timeout=options.timeout, with_local_disks=options.with_local_disks, progress=progress)
+
+    if options.dry_run:
+        executor.progress = lambda move, done, total: None
+        for move in sorted(executor.dry_run(), key=lambda m: m.wave or len(moves) + 1):
+            print('{:>4} {:30} {}'.format(move.wave or '-', str(move), move.status))
+        print("{} moves in {} waves ({})".format(len(moves), max((m.wave or 0 for m in moves), default=0), summary(moves)))
+        sys.exit(0)
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: executor.pause())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: executor.resume())
+
+    start = time.monotonic()
+    try:
+        executor.run()
+    except KeyboardInterrupt:
+        executor.abort()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        executor.run()
+
+    print("{} moves in {:.0f}s: {}".format(len(moves), time.monotonic() - start, summary(moves)))
+    sys.exit(0 if all(m.status in (DONE, SKIPPED) for m in moves) else 1)
@@ -0,0 +1,81 @@
+'''How much of a node a VM is taken to occupy when packing.
+
+The default ("allocated") model charges a VM its full maxcpu/maxmem,
+divided by an overcommit ratio: with a CPU ratio of 4, four vCPUs cost
+one physical core.  Ratios can be set cluster wide, per node, or per
+pool (a pool's ratio wins over its node's).
+
+The "usage" model charges a running VM what it is actually using
+(cpu and mem from cluster/resources, or a percentile of its history,
+see usage.py), plus a safety margin, never more than its allocation.
+Stopped VMs are still charged their allocation, since they will want
+it back when started.
+
+Config file (JSON):
+
+    {
+        "model": "allocated",
+        "margin": 0.25,
+        "default": {"cpu": 4.0, "mem": 1.0},
+        "nodes":   {"pve3": {"cpu": 2.0}},
+        "pools":   {"ibbr": {"cpu": 8.0, "mem": 1.2}}
+    }
+
+Install one with Node.feasibility = Feasibility(...); Node.has_space(),
+allocate() and the graphics all go through Node.demand().'''
+
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+MODELS = ('allocated', 'usage')
+
+
+class Feasibility:
+    '''Demand model plus overcommit ratios.'''
+
+    def __init__(self, model='allocated', margin=0.25, cpu_ratio=1.0, mem_ratio=1.0, nodes=None, pools=None):
+
+        if model not in MODELS:
+            raise ValueError("Unknown feasibility model {} (expected one of {})".format(model, ', '.join(MODELS)))
+
+        self.model = model
+        self.margin = margin
+        self.default = {'cpu': cpu_ratio, 'mem': mem_ratio}
+        self.nodes = nodes or {}
+        self.pools = pools or {}
+
+
+    @classmethod
+    def load(cls, filename):
+        '''Read a feasibility/overcommit config from a JSON file'''
+        with open(filename) as fp:
+            config = json.load(fp)
+        default = config.get('default', {})
+        return cls(model=config.get('model', 'allocated'), margin=config.get('margin', 0.25),
+                   cpu_ratio=default.get('cpu', 1.0), mem_ratio=default.get('mem', 1.0),
+                   nodes=config.get('nodes'), pools=config.get('pools'))
+
+
+    def ratio(self, vm, node, resource):
+        '''Overcommit ratio for one resource ('cpu' or 'mem')'''
+
+        pool = getattr(vm, 'pool', None)
+        if pool in self.pools and resource in self.pools[pool]:
+            return self.pools[pool][resource]
+        if node.name in self.nodes and resource in self.nodes[node.name]:
+            return self.nodes[node.name][resource]
+        return self.default[resource]
+
+
+    def demand(self, vm, node):
+        '''(memory bytes, cpus) the vm takes from node'''
+
+        if self.model == 'usage' and vm.status == 'running':
+            scale = 1.0 + self.margin
+            return (min(vm.maxmem, vm.mem * scale),
+                    min(vm.maxcpu, vm.cpu * vm.maxcpu * scale))
+
+        return (vm.maxmem / self.ratio(vm, node, 'mem'),
+                vm.maxcpu / self.ratio(vm, node, 'cpu'))
@@ -45,20 +45,35 @@ import logging
 import copy
 import random
 
+import metrics
+import scoring
+
 log = logging.getLogger(__name__)
 
-def pack_setup(orig_nodes, orig_vms, vm_sort_key='area', vm_reverse=True, vm_random=False):
-    '''makes master lists of nodes and vms for packing'''
+def pack_setup(orig_nodes, orig_vms, vm_sort_key='area', vm_reverse=True, vm_random=False, constraints=None):
+    '''makes master lists of nodes and vms for packing.  If constraints
+    (a constraints.Constraints) are given, a fresh placement state is
+    attached to the new nodes, and Node.allocate() honours it.  The same
+    goes for Node.storage (a storage.StorageMap), if set.'''
 
     nodes = copy.deepcopy(orig_nodes)
     nodes.sort(key=lambda n: n.area(), reverse=True)
     logging.debug("Sorted node order (by area): {}".format(list(map(str,nodes))))
 
+    state = constraints.bind(nodes) if constraints is not None else None
+
     for node in nodes:
         node.allocated_vms = []
+        node.constraints = state
+
+    storage_map = nodes[0].storage if nodes else None
+    storage_state = storage_map.bind(nodes, orig_vms) if storage_map is not None else None
+    for node in nodes:
+        node.storage_state = storage_state
 
     try:
-        getattr(orig_vms[0], vm_sort_key)
+        if orig_vms:
+            getattr(orig_vms[0], vm_sort_key)
     except AttributeError:
         raise NotImplementedError("The vm class does not have {} a method".format(vm_sort_key))
 
@@ -68,6 +83,10 @@ def pack_setup(orig_nodes, orig_vms, vm_sort_key='area', vm_reverse=True, vm_ran
 
     if vm_random:
         random.shuffle(vms)
+    elif vm_sort_key == 'score':
+        # one batch through scoring.py rather than a call per VM
+        scores = dict(zip(map(id, vms), scoring.score_vms(vms)))
+        vms.sort(key=lambda v: scores[id(v)], reverse=vm_reverse)
     else:
         vms.sort(key=lambda v: getattr(v, vm_sort_key)(), reverse=vm_reverse)
 
@@ -77,7 +96,28 @@ def pack_setup(orig_nodes, orig_vms, vm_sort_key='area', vm_reverse=True, vm_ran
     return nodes, vms
 
 
-def pack_size(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False):
+def release_gangs(nodes, allocated_vms, vms):
+    '''All-or-nothing gang groups: if only part of a gang got placed,
+    take the placed members back off their nodes and return them to
+    the unplaced list.'''
+
+    state = nodes[0].constraints if nodes else None
+    if state is None:
+        return
+
+    for group, placed in state.incomplete_gangs(allocated_vms, allocated_vms + vms):
+        log.info("Gang %s only partly placed, releasing %s", group, list(map(str, placed)))
+        for vm in placed:
+            for node in nodes:
+                if vm in node.allocated_vms:
+                    node.deallocate(vm)
+                    break
+            allocated_vms.remove(vm)
+            vms.append(vm)
+
+
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_size(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None):
     '''A naive packing routine that only allocates by "size" of
     a VM, filling a single node to capacity, then moving along
     to the next node.  Returns a list of *NEW* nodes with the new packing
@@ -85,7 +125,7 @@ def pack_size(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False
 
     log.info("Packing by size")
 
-    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random)
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
 
 #    vm_metrics = {}
 #
@@ -135,30 +175,26 @@ def pack_size(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False
         if allocations == 0:
             break
 
+    release_gangs(nodes, allocated_vms, vms)
+
     if vms:
         log.error("Failed to place %d VMs! %s", len(vms), list(map(str, vms)))
     else:
         log.info("Successfully packed all %d VMs", len(orig_vms))
 
 
-    # Print vms by node
-    for node in sorted(nodes):
-        print(node.name)
-        for vm in sorted(node.allocated_vms):
-            print('  {}'.format(vm))
-
-
     return nodes, len(allocated_vms), len(vms)
 
 
-def pack_size_rr(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False):
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_size_rr(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None):
     '''a slightly less naive packing routine that only allocates nodes,
     but rotates round-robin style over the nodes to attempt a more
     balanced allocation.'''
 
     log.info("Packing by size, RR")
 
-    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random)
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
     allocated_vms = []
 
     while vms:
@@ -197,19 +233,14 @@ def pack_size_rr(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=Fa
         if allocations == 0:
             break
 
+    release_gangs(nodes, allocated_vms, vms)
+
     if vms:
         log.error("Failed to place %d VMs! %s", len(vms), list(map(str, vms)))
     else:
         log.info("Successfully packed all %d VMs", len(orig_vms))
 
 
-    # Print vms by node
-    for node in sorted(nodes):
-        print(node.name)
-        for vm in sorted(node.allocated_vms):
-            print('  {}'.format(vm))
-
-
     return nodes, len(allocated_vms), len(vms)
 
 
@@ -218,7 +249,8 @@ def pack_size_rr(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=Fa
 # Try to allocate VMs to nodes based on similarities of node
 # to hypervisors, based on dot-products of the (normalized)
 # dimensions of the nodes and VMs.
-def pack_size_df(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False):
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_size_df(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None):
     '''Pack by dot product comparison'''
 
     import balance_math
@@ -226,7 +258,7 @@ def pack_size_df(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=Fa
     log.info("Packing by dot-product in closet.")
 
     # Basic sorting and setup
-    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random)
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
 
 
 
@@ -294,20 +326,224 @@ def pack_size_df(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=Fa
         if allocations == 0:
             break
 
+    release_gangs(nodes, allocated_vms, vms)
+
+
+    return nodes, len(allocated_vms), len(vms)
+
+
+############################################################################3
+# balanced packing
+#
+# Spread the load instead of consolidating it.  A node's load is its
+# "allocated" score (weighted share of CPU and memory handed out, plus
+# bias, see scoring.py), and a VM adds its weighted share of the node to
+# that.  Nodes sit in a heap keyed by load; for each VM, nodes are
+# popped least loaded first, and once a node's load is already past the
+# best projected load seen, nothing further up the heap can do better.
+# With very mixed node sizes that can still be most of the nodes, so the
+# search also stops after a few feasible candidates: each placement then
+# costs O(log n).
+#
+# objective='max' minimises the highest node load: each VM goes where
+# the projected load is lowest.  objective='variance' minimises the sum
+# of squared loads: each VM goes where the increase in it is smallest.
+#
+# With current=True, VMs start where they are running now (as pack_null),
+# anything not on a known node is placed as above, and then VMs are moved
+# off the most loaded node, one at a time, while that improves the
+# objective (at most `moves` of them).
+
+def vm_load(node, vm):
+    '''Weighted share of node that vm takes up (same scale as the
+    node's "allocated" score)'''
+
+    from Node import Node
+    mem, cpu = node.demand(vm)
+    return cpu/node.maxcpu * Node.weight['cpu'] + mem/node.maxmem * Node.weight['mem']
+
+
+def balance_gain(objective, load, share, mean=0.0):
+    '''Cost of adding share to a node at load, with mean the average
+    node load; lower is better'''
+    if objective == 'max':
+        return load + share
+    # change in the sum of squared deviations from the mean (near enough:
+    # the mean itself moves by share/len(nodes), which is left out)
+    return share * (2 * (load - mean) + share)
+
+
+def balance_target(heap, versions, vm, objective, mean=0.0, exclude=None, candidates=16):
+    '''Pop nodes off the heap, least loaded first, and return the
+    cheapest of the first candidates nodes that can take vm, as
+    (cost, node) or None.  This is a heuristic: a node further down the
+    heap may be cheaper.  Out of date entries (see versions) are
+    dropped, every other node popped goes back on.'''
+
+    import heapq
+
+    popped = []
+    best = None
+    best_load = None
+    feasible = 0
+
+    while heap:
+        entry = heapq.heappop(heap)
+        load, index, version, node = entry
+        if version != versions[index]:
+            continue
+        popped.append(entry)
+
+        if feasible >= candidates:
+            break
+        # For 'max' the cost is the new load, so nothing loaded at least
+        # as much as the best so far can beat it.  The 'variance' cost
+        # also depends on the vm's share of each node, so no such cut-off.
+        if objective == 'max' and best_load is not None and load >= best_load:
+            break
+        if node is exclude or not node.allows(vm) or not node.has_space(vm, quiet=True):
+            continue
+        feasible += 1
+
+        share = vm_load(node, vm)
+        cost = balance_gain(objective, load, share, mean)
+        if best is None or cost < best[0]:
+            best = (cost, node)
+            best_load = load + share
+
+    for entry in popped:
+        heapq.heappush(heap, entry)
+
+    return best
+
+
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_balance(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None,
+                 objective='max', current=False, moves=None):
+    '''Balance the load over all the nodes, rather than filling them.
+    objective is 'max' or 'variance'; current=True starts from (and
+    rebalances) the running placement instead of from scratch.'''
+
+    import heapq
+
+    if objective not in ('max', 'variance'):
+        raise NotImplementedError("Unknown balance objective {}".format(objective))
+
+    log.info("Packing for balance (%s)", objective)
+
+    # Basic sorting and setup
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
+
+    # initially empty list of VMs that have been placed somewhere.
+    # if it isn't in this list, it wasn't placed.
+    allocated_vms = []
+
+    if current:
+        by_name = {node.name: node for node in nodes}
+        for vm in vms:
+            node = by_name.get(vm.node)
+            if node is not None and node.allocate(vm, force=True):
+                allocated_vms.append(vm)
+        for vm in allocated_vms:
+            vms.remove(vm)
+
+    def load(node):
+        return node.score(mode='allocated')
+
+    # (load, node index, version, node).  When a node's load changes a
+    # new entry goes on with the next version, and the old one is dropped
+    # when it reaches the top.
+    online = [node for node in nodes if node.status == 'online']
+    versions = [0] * len(online)
+    index_of = {id(node): index for index, node in enumerate(online)}
+    heap = [(load(node), index, 0, node) for index, node in enumerate(online)]
+    heapq.heapify(heap)
+    total = sum(entry[0] for entry in heap)
+
+    def reload(node):
+        index = index_of[id(node)]
+        versions[index] += 1
+        heapq.heappush(heap, (load(node), index, versions[index], node))
+
+    for vm in vms:
+        log.info("Attempt placing %s(%.1fGB, %d cpu) = %.4f", vm, vm.maxmem/2**30, vm.maxcpu, vm.area())
+
+        found = balance_target(heap, versions, vm, objective, total/max(1, len(online)))
+        if found is None:
+            log.info("  Failed to place %s", vm)
+            continue
+
+        cost, node = found
+        node.allocate(vm)
+        log.info("  Placed %s on %s", vm, node)
+        allocated_vms.append(vm)
+        total += vm_load(node, vm)
+
+        reload(node)
+
+    for vm in allocated_vms:
+        if vm in vms:
+            vms.remove(vm)
+
+    if current:
+        moved = 0
+        while moves is None or moved < moves:
+            hot = max(online, key=load)
+            hot_load = load(hot)
+
+            best = None
+            for vm in sorted(hot.allocated_vms, key=lambda v: vm_load(hot, v), reverse=True):
+                mean = total/max(1, len(online))
+                found = balance_target(heap, versions, vm, objective, mean, exclude=hot)
+                if found is None:
+                    continue
+                cost, node = found
+                share = vm_load(hot, vm)
+                if objective == 'max':
+                    # the hot node must end up cooler, and the target must not end up hotter
+                    better = max(hot_load - share, cost) < hot_load
+                else:
+                    better = cost + balance_gain(objective, hot_load, -share, mean) < 0
+                if better:
+                    best = (vm, node)
+                    break
+
+            if best is None:
+                break
+
+            vm, node = best
+            log.info("  Moving %s from %s to %s", vm, hot, node)
+            total -= vm_load(hot, vm)
+            hot.deallocate(vm)
+            node.allocate(vm, force=True)
+            total += vm_load(node, vm)
+            reload(hot)
+            reload(node)
+            moved += 1
+
+        log.info("Rebalanced with %d moves", moved)
+
+    release_gangs(nodes, allocated_vms, vms)
+
+    if vms:
+        log.error("Failed to place %d VMs! %s", len(vms), list(map(str, vms)))
+    else:
+        log.info("Successfully packed all %d VMs", len(orig_vms))
 
     return nodes, len(allocated_vms), len(vms)
 
 
 ############################################################################3
 # random packing
-def pack_random(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False):
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_random(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None):
     '''Do it randomly, every time'''
 
 
     log.info("Random packing")
 
     # Basic sorting and setup
-    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random)
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
 
     # initially empty list of VMs that have been placed somewhere.
     # if it isn't in this list, it wasn't placed.
@@ -352,19 +588,55 @@ def pack_random(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=Fal
         if allocations == 0:
             break
 
+    # This is the placement as it is, partial gangs and all: nothing gets
+    # released here (constraints.violations() reports what's broken).
+
     return nodes, len(allocated_vms), len(vms)
 
 
+############################################################################3
+# randomized trials
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_best_of(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=True, constraints=None,
+                 strategy=pack_size, trials=20):
+    '''Run strategy trials times over shuffled VM orders, and keep the
+    packing that places the most VMs on the fewest nodes.  Stops early
+    once a packing places everything on as few nodes as the lower bound
+    from bounds.py, since no later trial can beat it.'''
+
+    import bounds
+
+    log.info("Best of %d %s trials", trials, strategy.__name__)
+
+    bound = bounds.lower_bound(orig_nodes, orig_vms)
+
+    best = None
+    for trial in range(trials):
+        nodes, placed, unplaced = strategy(orig_nodes, orig_vms, key=key, vm_reverse=vm_reverse,
+                                           vm_random=vm_random or trial > 0, constraints=constraints)
+        used = bounds.nodes_used(nodes)
+
+        if best is None or (placed, -used) > (best[1], -best[3]):
+            best = (nodes, placed, unplaced, used)
+
+        if not unplaced and used <= bound:
+            log.info("Trial %d reached the lower bound of %d nodes", trial+1, bound)
+            break
+
+    return best[0], best[1], best[2]
+
+
 ############################################################################3
 ############################################################################3
 # No-pack method
-def pack_null(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False):
+@metrics.timed(metrics.PACK_SECONDS)
+def pack_null(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None):
     '''No-packing, mostly for displaying current status'''
 
     log.info("Packing skeletons in closet.")
 
     # Basic sorting and setup
-    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random)
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
 
     # initially empty list of VMs that have been placed somewhere.
     # if it isn't in this list, it wasn't placed.
@@ -404,6 +676,9 @@ def pack_null(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False
         if allocations == 0:
             break
 
+    # This is the placement as it is, partial gangs and all: nothing gets
+    # released here (constraints.violations() reports what's broken).
+
     return nodes, len(allocated_vms), len(vms)
 
 
@@ -411,13 +686,13 @@ def pack_null(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False
 ############################################################################3
 ############################################################################3
 # boilerplate for other packing methods
-def pack_skeleton(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False):
+def pack_skeleton(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None):
     '''Skeleton text about the packing routine.'''
 
     log.info("Packing skeletons in closet.")
 
     # Basic sorting and setup
-    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random)
+    nodes, vms = pack_setup(orig_nodes, orig_vms, vm_sort_key=key, vm_reverse=vm_reverse, vm_random=vm_random, constraints=constraints)
 
     # initially empty list of VMs that have been placed somewhere.
     # if it isn't in this list, it wasn't placed.
@@ -450,4 +725,7 @@ def pack_skeleton(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=F
         if allocations == 0:
             break
 
+    # This is the placement as it is, partial gangs and all: nothing gets
+    # released here (constraints.violations() reports what's broken).
+
     return nodes, len(allocated_vms), len(vms)
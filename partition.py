@@ -0,0 +1,193 @@
+'''Partitioned packing: split the cluster into independent pieces (by
+pool, by a node-group config, or into even shards), pack each piece in
+its own process with any of the pack_* strategies, then merge them.
+VMs that did not fit in their own piece get a second chance anywhere
+in a final cross-partition pass.'''
+
+# Node-group config (JSON) for by='groups':
+#
+#   {
+#       "ceph":     {"nodes": ["pve1", "pve2"], "pools": ["ibbr"]},
+#       "research": {"nodes": ["pve3", "pve4"], "vms": ["CryoEM-DB", 117]}
+#   }
+#
+# VMs matching no group, and nodes in no group, only take part in the
+# cross-partition pass.
+
+import json
+import logging
+import operator
+
+from concurrent.futures import ProcessPoolExecutor
+
+import packing
+
+log = logging.getLogger(__name__)
+
+
+def by_pool(nodes, vms):
+    '''One partition per pool.  Each node goes to the pool that has the
+    most memory allocated on it now; empty nodes are then handed out
+    one at a time to whichever partition is most oversubscribed.'''
+
+    pools = {}
+    for vm in vms:
+        pools.setdefault(getattr(vm, 'pool', '') or '', []).append(vm)
+
+    partitions = {pool: {'nodes': [], 'vms': pool_vms} for pool, pool_vms in pools.items()}
+
+    # memory allocated per (node, pool) in the current placement
+    usage = {}
+    for vm in vms:
+        per_pool = usage.setdefault(vm.node, {})
+        pool = getattr(vm, 'pool', '') or ''
+        per_pool[pool] = per_pool.get(pool, 0) + vm.maxmem
+
+    spare = []
+    for node in nodes:
+        per_pool = usage.get(node.name)
+        if per_pool:
+            partitions[max(per_pool, key=per_pool.get)]['nodes'].append(node)
+        else:
+            spare.append(node)
+
+    def pressure(part):
+        capacity = sum(n.maxmem - n.minfreemem for n in part['nodes'])
+        demand = sum(v.maxmem for v in part['vms'])
+        return demand / capacity if capacity > 0 else float('inf')
+
+    for node in sorted(spare, key=lambda n: n.area(), reverse=True):
+        busiest = max(partitions.values(), key=pressure)
+        busiest['nodes'].append(node)
+
+    return [(pool or 'no-pool', part['nodes'], part['vms']) for pool, part in sorted(partitions.items())]
+
+
+def by_groups(nodes, vms, node_groups):
+    '''Partitions from a node-group config (see above).  A node or VM
+    that falls in two groups would be packed (and counted) twice, so
+    that's an error.'''
+
+    node_owner = {}
+    vm_owner = {}
+    partitions = []
+    for name, group in node_groups.items():
+        names = set(group.get('nodes', []))
+        pools = set(group.get('pools', []))
+        members = {str(v) for v in group.get('vms', [])}
+
+        group_nodes = [n for n in nodes if n.name in names]
+        group_vms = [v for v in vms
+                     if getattr(v, 'pool', None) in pools or v.name in members or str(v.vmid) in members]
+
+        for node in group_nodes:
+            if node.name in node_owner:
+                raise ValueError("Node {} is in node groups {} and {}".format(node.name, node_owner[node.name], name))
+            node_owner[node.name] = name
+        for vm in group_vms:
+            if id(vm) in vm_owner:
+                raise ValueError("VM {} ({}) is in node groups {} and {}".format(vm.name, vm.vmid, vm_owner[id(vm)], name))
+            vm_owner[id(vm)] = name
+
+        partitions.append((name, group_nodes, group_vms))
+
+    return partitions
+
+
+def by_shard(nodes, vms, shards):
+    '''Split into shards of similar size, dealing nodes and VMs out
+    largest first, snake-wise, so each shard gets a similar mix.'''
+
+    shards = max(1, min(shards, len(nodes)))
+    parts = [(str(i), [], []) for i in range(shards)]
+
+    def deal(items, slot):
+        for index, item in enumerate(sorted(items, key=lambda x: x.area(), reverse=True)):
+            lap, offset = divmod(index, shards)
+            parts[offset if lap % 2 == 0 else shards - 1 - offset][slot].append(item)
+
+    deal(nodes, 1)
+    deal(vms, 2)
+
+    return parts
+
+
+def pack_one(args):
+    '''Pack a single partition.  Runs in the worker pool.'''
+    strategy, nodes, vms, key, constraints = args
+    if not nodes or not vms:
+        return packing.pack_setup(nodes, [], vm_sort_key=key)[0]
+    return getattr(packing, strategy)(nodes, vms, key=key, constraints=constraints)[0]
+
+
+def pack_partitioned(orig_nodes, orig_vms, strategy='pack_size', by='pool', node_groups=None, shards=4,
+                     workers=None, cross_pass=True, key='area', constraints=None):
+    '''Pack each partition independently, in parallel, then merge.
+    Returns (nodes, placed count, unplaced count) like the pack_* routines.'''
+
+    if by == 'pool':
+        partitions = by_pool(orig_nodes, orig_vms)
+    elif by == 'groups':
+        if isinstance(node_groups, str):
+            with open(node_groups) as fp:
+                node_groups = json.load(fp)
+        partitions = by_groups(orig_nodes, orig_vms, node_groups or {})
+    elif by == 'shards':
+        partitions = by_shard(orig_nodes, orig_vms, shards)
+    else:
+        raise NotImplementedError("Unknown partitioning {}".format(by))
+
+    for name, part_nodes, part_vms in partitions:
+        log.info("Partition %s: %d nodes, %d VMs", name, len(part_nodes), len(part_vms))
+
+    jobs = [(strategy, part_nodes, part_vms, key, constraints) for name, part_nodes, part_vms in partitions]
+
+    if workers == 1 or len(jobs) < 2:
+        results = [pack_one(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(pack_one, jobs))
+
+    # Merge.  Nodes that belonged to no partition come along empty.
+    nodes = [node for result in results for node in result]
+    seen = {node.name for node in nodes}
+    nodes += packing.pack_setup([n for n in orig_nodes if n.name not in seen], [], vm_sort_key=key)[0]
+
+    state = constraints.bind(nodes) if constraints is not None else None
+
+    # Partitions enforced their constraints separately; replay every
+    # placement against one cluster-wide state and evict anything that
+    # only worked because its group spanned partitions.
+    allocated_vms = []
+    for node in nodes:
+        node.constraints = None
+        for vm in list(node.allocated_vms):
+            if state is None or state.allows(vm, node):
+                if state is not None:
+                    state.place(vm, node)
+                allocated_vms.append(vm)
+            else:
+                log.info("Evicting %s from %s, breaks a cross-partition constraint", vm, node)
+                node.deallocate(vm)
+        node.constraints = state
+
+    placed = {(vm.vmid, vm.name) for vm in allocated_vms}
+    vms = [vm for vm in orig_vms if (vm.vmid, vm.name) not in placed]
+
+    if cross_pass and vms:
+        log.info("Cross-partition pass for %d VMs", len(vms))
+        nodes.sort(key=lambda n: n.area(), reverse=True)
+        for vm in sorted(vms, key=operator.methodcaller(key), reverse=True):
+            for node in nodes:
+                if node.allocate(vm):
+                    log.info("  Placed %s on %s", vm, node)
+                    allocated_vms.append(vm)
+                    vms.remove(vm)
+                    break
+
+    packing.release_gangs(nodes, allocated_vms, vms)
+
+    if vms:
+        log.error("Failed to place %d VMs! %s", len(vms), list(map(str, vms)))
+
+    return nodes, len(allocated_vms), len(vms)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+'''Portfolio packing: which first-fit-decreasing variant packs a 2-D
+(memory x CPU) instance best depends on the instance, so try many at
+once and keep the winner.  A recipe is a VM ordering plus a node
+policy:
+
+  orderings  area (maxmem x maxcpu, as pack_size), mem, cpu, and, with
+             each dimension scaled by the largest node's capacity,
+             max (the larger share), sum and l2 (Euclidean norm)
+  policies   first  first node (by area, as pack_size) with room
+             best   the node left with the least room, scaled
+             worst  the node left with the most room, scaled
+             dot    the node whose free room lines up best with the VM
+                    (largest dot product of demand and free room)
+
+Each recipe is one greedy pass.  Recipes run in parallel worker
+processes, sharing the lower bound from bounds.py and the fewest nodes
+any complete packing has used so far: a run gives up once it needs
+more nodes than that, and as soon as one run places everything on as
+few nodes as the bound, the rest are called off.'''
+
+# The shared "best so far" and "done" flags are multiprocessing.Values
+# handed to each worker when the pool starts, so checking them is a
+# read of shared memory, not a round trip to the parent.  Ties go to
+# the recipe listed first, so results don't depend on timing... except
+# through cancellation, which only ever drops runs that can't win.
+
+import math
+import time
+import logging
+import argparse
+import itertools
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import packing
+import bounds
+
+log = logging.getLogger(__name__)
+
+ORDERINGS = ('area', 'mem', 'cpu', 'max', 'sum', 'l2')
+POLICIES = ('first', 'best', 'worst', 'dot')
+
+# shared between the runs in one process pool (see init_worker)
+shared = {'best': None, 'done': None}
+
+
+class Flag:
+    '''Stand-in for a multiprocessing.Value when running in-process'''
+    def __init__(self, value):
+        self.value = value
+
+
+def init_worker(best, done):
+    shared['best'] = best
+    shared['done'] = done
+
+
+def scales(nodes):
+    '''(memory, cpus) of the largest node, to put both dimensions on one scale'''
+    return max(n.maxmem for n in nodes) or 1, max(n.maxcpu for n in nodes) or 1
+
+
+def order_key(order, mem_scale, cpu_scale):
+    '''Sort key (largest first) for an ordering'''
+
+    if order == 'area':
+        return lambda vm: vm.area()
+    if order == 'mem':
+        return lambda vm: (vm.maxmem, vm.maxcpu)
+    if order == 'cpu':
+        return lambda vm: (vm.maxcpu, vm.maxmem)
+
+    def shares(vm):
+        return vm.maxmem / mem_scale, vm.maxcpu / cpu_scale
+
+    if order == 'max':
+        return lambda vm: max(shares(vm))
+    if order == 'sum':
+        return lambda vm: sum(shares(vm))
+    if order == 'l2':
+        return lambda vm: math.hypot(*shares(vm))
+    raise ValueError("Unknown ordering {} (expected one of {})".format(order, ', '.join(ORDERINGS)))
+
+
+def choose(policy, vm, nodes, mem_scale, cpu_scale):
+    '''The node policy picks a node for vm, or None'''
+
+    best = None
+    best_value = None
+    for node in nodes:
+        if not (node.allows(vm) and node.has_space(vm, quiet=True)):
+            continue
+        if policy == 'first':
+            return node
+
+        mem, cpu = node.demand(vm)
+        room_mem = (node.freemem - node.minfreemem) / mem_scale
+        room_cpu = (node.freecpu - node.minfreecpu) / cpu_scale
+        if policy == 'dot':
+            value = -(mem / mem_scale * room_mem + cpu / cpu_scale * room_cpu)
+        else:
+            left = room_mem - mem / mem_scale + room_cpu - cpu / cpu_scale
+            value = left if policy == 'best' else -left
+
+        if best_value is None or value < best_value:
+            best, best_value = node, value
+
+    return best
+
+
+def pack_recipe(orig_nodes, orig_vms, order='area', policy='first', constraints=None):
+    '''One greedy pass with a recipe.  Returns (nodes, placed, unplaced),
+    or None if called off because it can't win.'''
+
+    if policy not in POLICIES:
+        raise ValueError("Unknown node policy {} (expected one of {})".format(policy, ', '.join(POLICIES)))
+
+    nodes, vms = packing.pack_setup(orig_nodes, orig_vms, constraints=constraints)
+    mem_scale, cpu_scale = scales(nodes)
+    vms.sort(key=order_key(order, mem_scale, cpu_scale), reverse=True)
+
+    best, done = shared['best'], shared['done']
+    used = 0
+    allocated_vms = []
+    unplaced = []
+
+    for count, vm in enumerate(vms):
+        node = choose(policy, vm, nodes, mem_scale, cpu_scale)
+        if node is None:
+            unplaced.append(vm)
+            continue
+        if not node.allocated_vms:
+            used += 1
+        node.allocate(vm)
+        allocated_vms.append(vm)
+
+        # check in with the other runs now and then
+        if count % 32 == 0 and best is not None and (done.value or used > best.value):
+            log.debug("%s/%s called off at %d nodes", order, policy, used)
+            return None
+
+    packing.release_gangs(nodes, allocated_vms, unplaced)
+    return nodes, len(allocated_vms), len(unplaced)
+
+
+def run_one(args):
+    '''Run one recipe and tell the others how it went.  Runs in the worker pool.'''
+
+    index, order, policy, orig_nodes, orig_vms, constraints, bound = args
+
+    start = time.perf_counter()
+    result = pack_recipe(orig_nodes, orig_vms, order=order, policy=policy, constraints=constraints)
+    elapsed = time.perf_counter() - start
+    if result is None:
+        return index, None, elapsed
+
+    nodes, placed, unplaced = result
+    used = bounds.nodes_used(nodes)
+    best, done = shared['best'], shared['done']
+    if best is not None and not unplaced:
+        # a lost update only makes the others stop a little later
+        if used < best.value:
+            best.value = used
+        if used <= bound:
+            done.value = 1
+    return index, result, elapsed
+
+
+def solve(orig_nodes, orig_vms, orders=ORDERINGS, policies=POLICIES, constraints=None, workers=None):
+    '''Race every ordering x policy.  Returns (nodes, placed, unplaced,
+    recipe), recipe being a dict of the winner's order and policy, its
+    nodes used and the lower bound, and per-recipe run stats.'''
+
+    bound = bounds.lower_bound(orig_nodes, orig_vms)
+    recipes = list(itertools.product(orders, policies))
+    jobs = [(index, order, policy, orig_nodes, orig_vms, constraints, bound)
+            for index, (order, policy) in enumerate(recipes)]
+
+    results = {}
+    timings = {}
+
+    if workers == 1:
+        init_worker(Flag(len(orig_nodes) + 1), Flag(0))
+        for job in jobs:
+            index, result, elapsed = run_one(job)
+            results[index], timings[index] = result, elapsed
+            if shared['done'].value:
+                break
+    else:
+        best = multiprocessing.Value('i', len(orig_nodes) + 1, lock=False)
+        done = multiprocessing.Value('b', 0, lock=False)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(best, done)) as pool:
+            futures = [pool.submit(run_one, job) for job in jobs]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                index, result, elapsed = future.result()
+                results[index], timings[index] = result, elapsed
+                if done.value:
+                    for other in futures:
+                        other.cancel()
+        shared['best'] = shared['done'] = None
+
+    def rank(index):
+        nodes, placed, unplaced = results[index]
+        return -placed, bounds.nodes_used(nodes), index
+
+    finished = [index for index, result in results.items() if result is not None]
+    winner = min(finished, key=rank)
+    nodes, placed, unplaced = results[winner]
+
+    recipe = {
+        'order': recipes[winner][0],
+        'policy': recipes[winner][1],
+        'nodes_used': bounds.nodes_used(nodes),
+        'nodes_bound': bound,
+        'runs': [{'order': order, 'policy': policy,
+                  'status': 'cancelled' if index not in results else 'called off' if results[index] is None else 'done',
+                  'nodes_used': bounds.nodes_used(results[index][0]) if results.get(index) else None,
+                  'placed': results[index][1] if results.get(index) else None,
+                  'seconds': round(timings[index], 4) if index in timings else None}
+                 for index, (order, policy) in enumerate(recipes)],
+    }
+    log.info("Portfolio winner %s/%s: %d placed on %d nodes (bound %d), %d of %d recipes run to the end",
+             recipe['order'], recipe['policy'], placed, recipe['nodes_used'], bound, len(finished), len(recipes))
+    return nodes, placed, unplaced, recipe
+
+
+def pack_portfolio(orig_nodes, orig_vms, key='area', vm_reverse=True, vm_random=False, constraints=None,
+                   orders=ORDERINGS, policies=POLICIES, workers=None, info=None):
+    '''solve() with the usual packer signature.  The recipe is logged,
+    and the winning order and policy go in the info dict, if given.'''
+    nodes, placed, unplaced, recipe = solve(orig_nodes, orig_vms, orders=orders, policies=policies,
+                                            constraints=constraints, workers=workers)
+    if info is not None:
+        info.update(order=recipe['order'], policy=recipe['policy'])
+    return nodes, placed, unplaced
+
+
+if __name__ == '__main__':
+
+    import json
+    from Node import Node
+    from VM import VM
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('nodes', help="nodes JSON dump")
+    parser.add_argument('vms', help="vms JSON dump")
+    parser.add_argument('--orders', default=','.join(ORDERINGS), help="Comma separated VM orderings")
+    parser.add_argument('--policies', default=','.join(POLICIES), help="Comma separated node policies")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Worker processes")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=max(1, 30 - options.verbose * 10))
+
+    with open(options.nodes) as fp:
+        node_objs = [Node(data=n) for n in json.load(fp)['data']]
+    with open(options.vms) as fp:
+        vm_objs = [VM(data=v) for v in json.load(fp)['data']]
+
+    start = time.perf_counter()
+    packed, placed, unplaced, recipe = solve(node_objs, vm_objs, orders=options.orders.split(','),
+                                             policies=options.policies.split(','), workers=options.jobs)
+
+    fmt = '{:6} {:6} {:>10} {:>7} {:>6} {:>8}'
+    print(fmt.format('order', 'policy', 'status', 'placed', 'nodes', 'seconds'))
+    for run in recipe['runs']:
+        print(fmt.format(run['order'], run['policy'], run['status'],
+                         '' if run['placed'] is None else run['placed'],
+                         '' if run['nodes_used'] is None else run['nodes_used'],
+                         '' if run['seconds'] is None else run['seconds']))
+    print("Winner {order}/{policy}: {nodes_used} nodes (lower bound {nodes_bound})".format(**recipe),
+          "{}/{} VMs placed in {:.2f}s".format(placed, placed + unplaced, time.perf_counter() - start))
@@ -0,0 +1,115 @@
+'''Network and disk I/O rates for VMs.  cluster/resources reports
+netin/netout/diskread/diskwrite as byte counters since the VM booted;
+a RateTracker keeps the previous sample of each VM, turns consecutive
+samples into bytes/sec, and smooths them, so they can be weighed in
+scores (VM.net_rate and VM.disk_rate).
+
+State is kept on disk between runs, like the usage cache, so each poll
+(each balance.py run, say) moves the estimate along.'''
+
+# Samples are keyed by the VM's id, and the uptime says whether it is
+# the same boot: uptime going backwards, or a counter going backwards,
+# means the VM restarted (or was migrated, which restarts the counters
+# too), and its counters start again from zero.  With no usable previous
+# sample, the rate is the average since boot, counter / uptime.
+#
+# Smoothing is an exponentially weighted moving average with a half-life
+# in seconds, not samples, so irregular polling doesn't skew it:
+#     alpha = 1 - 2^(-dt / halflife)
+#     rate  = rate + alpha * (sample_rate - rate)
+# That's O(1) time and space per VM per sample.
+
+import os
+import json
+import math
+import time
+import logging
+
+from cachedir import cache_dir
+
+log = logging.getLogger(__name__)
+
+COUNTERS = ('netin', 'netout', 'diskread', 'diskwrite')
+
+
+class RateTracker:
+    '''Previous samples and smoothed rates per VM, stored on disk.'''
+
+    def __init__(self, filename=None, halflife=300.0, expire=7*86400):
+        self.filename = filename or os.path.join(cache_dir(), 'rates.json')
+        self.halflife = halflife
+        self.expire = expire
+        self.dirty = False
+
+        try:
+            with open(self.filename) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = {}
+
+
+    def update(self, vm, now=None):
+        '''Take in a VM's counters, and set its rates.  Returns the
+        smoothed {counter: bytes/sec}.'''
+
+        now = time.time() if now is None else now
+        uptime = getattr(vm, 'uptime', 0) or 0
+        counters = {name: getattr(vm, name, 0) or 0 for name in COUNTERS}
+
+        entry = self.entries.get(vm.id)
+        rates = None
+
+        if entry is not None and uptime >= entry['uptime'] and \
+           all(counters[name] >= entry['counters'][name] for name in COUNTERS):
+            # same boot: the counters' own clock is the uptime.  A running
+            # VM whose uptime hasn't moved is the same sample again (a
+            # re-read dump, say), which says nothing new about its rates;
+            # a stopped VM's clock is the wall clock, and its rates decay.
+            if uptime > entry['uptime']:
+                elapsed = uptime - entry['uptime']
+            elif getattr(vm, 'status', 'running') != 'running':
+                elapsed = now - entry['time']
+            else:
+                elapsed = 0
+            if elapsed > 0:
+                alpha = 1 - math.pow(2, -elapsed / self.halflife)
+                rates = {}
+                for name in COUNTERS:
+                    sample = (counters[name] - entry['counters'][name]) / elapsed
+                    rates[name] = entry['rates'][name] + alpha * (sample - entry['rates'][name])
+            else:
+                rates = entry['rates']
+        elif entry is not None:
+            log.debug("%s restarted, rates start over", vm.name)
+
+        if rates is None:
+            rates = {name: counters[name] / uptime if uptime > 0 else 0.0 for name in COUNTERS}
+
+        self.entries[vm.id] = {'time': now, 'uptime': uptime, 'counters': counters, 'rates': rates}
+        self.dirty = True
+
+        vm.set_rates(rates['netin'] + rates['netout'], rates['diskread'] + rates['diskwrite'])
+        return rates
+
+
+    def update_all(self, vms, now=None):
+        '''update() every VM with the same sample time, and save'''
+        now = time.time() if now is None else now
+        for vm in vms:
+            self.update(vm, now=now)
+        self.save()
+
+
+    def save(self):
+        '''Write the state back out, dropping VMs not seen for a while.'''
+        if not self.dirty:
+            return
+
+        now = time.time()
+        self.entries = {k: e for k, e in self.entries.items() if now - e['time'] <= self.expire}
+
+        tmp = '{}.{}'.format(self.filename, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp, self.filename)
+        self.dirty = False
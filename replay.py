@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+'''Replay packing strategies over historical cluster dumps.  Finds the
+nodes-<stamp>.json / vms-<stamp>.json pairs written by dump_resources.py
+(in any number of directories, optionally gzipped), runs each packing
+strategy over every snapshot, and writes a time series (table or CSV)
+of VMs placed, nodes used and packing efficiency per strategy.'''
+
+# Each snapshot is parsed once, in this process, and fingerprinted on
+# the fields packing looks at (node capacity and status; VM size, status
+# and node).  A snapshot whose fingerprint matches the one before it
+# gives the same answers, so its rows are copied rather than recomputed
+# (reused=1); strategies that draw at random (see cache.cacheable()) are
+# run again regardless, so each snapshot gets its own draw.  Usage figures change in every dump, so they are only part
+# of the fingerprint with --exact, for runs that pack by usage.
+#
+# Changed snapshots go to a process pool, a few at a time so years of
+# dumps never sit in memory at once.  A worker builds the Node and VM
+# objects once and runs every strategy over them; the packers copy the
+# nodes, and don't change the VMs.
+
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import time
+import hashlib
+import logging
+import argparse
+import collections
+
+from concurrent.futures import ProcessPoolExecutor
+
+import cache
+import packing
+import bounds
+from Node import Node
+from VM import VM
+
+log = logging.getLogger(__name__)
+
+STRATEGIES = ('pack_size', 'pack_size_rr', 'pack_size_df', 'pack_balance', 'pack_random')
+
+COLUMNS = ['stamp', 'strategy', 'vms_placed', 'vms_total', 'nodes_used', 'nodes_bound', 'nodes_total',
+           'efficiency', 'seconds', 'reused']
+
+SNAPSHOT_RE = re.compile(r'^(nodes|vms)-(.+)\.json(\.gz)?$')
+
+# fields that change what a packing does
+NODE_FIELDS = ('node', 'status', 'maxcpu', 'maxmem')
+VM_FIELDS = ('vmid', 'name', 'status', 'maxcpu', 'maxmem', 'node', 'pool')
+USAGE_FIELDS = ('cpu', 'mem')
+
+
+def find_snapshots(paths):
+    '''Pair up nodes/vms dumps by stamp.  Returns a list of
+    (stamp, nodes file, vms file), oldest first.'''
+
+    found = collections.defaultdict(dict)
+    for path in paths:
+        names = os.listdir(path) if os.path.isdir(path) else [os.path.basename(path)]
+        base = path if os.path.isdir(path) else os.path.dirname(path)
+        for name in names:
+            match = SNAPSHOT_RE.match(name)
+            if match:
+                found[match.group(2)][match.group(1)] = os.path.join(base, name)
+
+    snapshots = []
+    for stamp in sorted(found):
+        if 'nodes' in found[stamp] and 'vms' in found[stamp]:
+            snapshots.append((stamp, found[stamp]['nodes'], found[stamp]['vms']))
+        else:
+            log.warning("Snapshot %s is missing its %s dump, skipping", stamp,
+                        'vms' if 'nodes' in found[stamp] else 'nodes')
+    return snapshots
+
+
+def load(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as fp:
+        return json.load(fp)['data']
+
+
+def fingerprint(node_list, vm_list, exact=False):
+    '''Hash of the parts of a snapshot that packing depends on'''
+
+    vm_fields = VM_FIELDS + USAGE_FIELDS if exact else VM_FIELDS
+    digest = hashlib.sha1()
+    for items, fields in ((node_list, NODE_FIELDS), (vm_list, vm_fields)):
+        rows = sorted(json.dumps([item.get(f) for f in fields]) for item in items)
+        digest.update('\n'.join(rows).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def replay_one(args):
+    '''Run every strategy over one snapshot.  Runs in the worker pool.'''
+
+    stamp, node_list, vm_list, strategies, key = args
+
+    nodes = [Node(data=n) for n in node_list]
+    vms = [VM(data=v) for v in vm_list]
+    bound = bounds.lower_bound(nodes, vms)
+
+    rows = []
+    for strategy in strategies:
+        start = time.perf_counter()
+        packed, placed, unplaced = getattr(packing, strategy)(nodes, vms, key=key)
+        elapsed = time.perf_counter() - start
+
+        used = [node for node in packed if node.allocated_vms]
+        efficiency = sum(node.efficency(report=False) for node in used) / len(used) if used else 0.0
+
+        rows.append({
+            'stamp': stamp,
+            'strategy': strategy,
+            'vms_placed': placed,
+            'vms_total': placed + unplaced,
+            'nodes_used': len(used),
+            'nodes_bound': bound,
+            'nodes_total': len(packed),
+            'efficiency': round(efficiency, 4),
+            'seconds': round(elapsed, 3),
+            'reused': 0,
+        })
+    return rows
+
+
+def replay(snapshots, strategies=STRATEGIES, key='area', workers=None, exact=False):
+    '''Yield time series rows for every snapshot, in order'''
+
+    pending = collections.deque()
+    previous = None
+    window = 2 * (workers or os.cpu_count() or 1)
+
+    # strategies to run again even on an unchanged snapshot
+    rerun = [strategy for strategy in strategies if not cache.cacheable(strategy)]
+
+    def finish(stamp, future, reuse):
+        if not reuse:
+            return future.result()
+        fresh = {row['strategy']: row for row in future.result()} if future is not None else {}
+        return [fresh.get(row['strategy']) or dict(row, stamp=stamp, reused=1, seconds=0.0) for row in last_rows]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        last_rows = None
+        for stamp, nodes_file, vms_file in snapshots:
+            try:
+                node_list, vm_list = load(nodes_file), load(vms_file)
+            except (OSError, ValueError, KeyError) as exc:
+                log.warning("Can't read snapshot %s: %s", stamp, exc)
+                continue
+
+            current = fingerprint(node_list, vm_list, exact)
+            reuse = current == previous
+            if reuse:
+                log.info("Snapshot %s unchanged, reusing results", stamp)
+            run = rerun if reuse else strategies
+            future = pool.submit(replay_one, (stamp, node_list, vm_list, run, key)) if run else None
+            pending.append((stamp, future, reuse))
+            previous = current
+
+            # hand back finished results in order, keeping the window full
+            while len(pending) > window or (pending and (pending[0][1] is None or pending[0][1].done())):
+                last_rows = finish(*pending.popleft())
+                yield from last_rows
+
+        while pending:
+            last_rows = finish(*pending.popleft())
+            yield from last_rows
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('paths', nargs='+', help="Directories (or files) of nodes-*.json / vms-*.json dumps")
+    parser.add_argument('--strategies', default=','.join(STRATEGIES), help="Comma separated packing routines")
+    parser.add_argument('--key', default='area', help="VM sort key")
+    parser.add_argument('--exact', action='store_true', help="Only reuse results when usage figures are unchanged too")
+    parser.add_argument('--csv', metavar='FILE', help="Write results as CSV ('-' for stdout)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Worker processes")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=max(1, 30 - options.verbose * 10))
+
+    snapshots = find_snapshots(options.paths)
+    log.info("Replaying %d snapshots", len(snapshots))
+
+    rows = replay(snapshots, strategies=options.strategies.split(','), key=options.key,
+                  workers=options.jobs, exact=options.exact)
+
+    if options.csv:
+        fp = sys.stdout if options.csv == '-' else open(options.csv, 'w', newline='')
+        writer = csv.DictWriter(fp, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        if fp is not sys.stdout:
+            fp.close()
+    else:
+        fmt = '{:16} {:14} {:>9} {:>6} {:>5} {:>6} {:>8} {:>6}'
+        print(fmt.format('stamp', 'strategy', 'placed', 'nodes', 'bound', 'eff', 'seconds', 'reused'))
+        for row in rows:
+            print(fmt.format(row['stamp'], row['strategy'],
+                             '{}/{}'.format(row['vms_placed'], row['vms_total']),
+                             '{}/{}'.format(row['nodes_used'], row['nodes_total']),
+                             row['nodes_bound'], row['efficiency'], row['seconds'], row['reused'] and 'yes' or ''))
@@ -0,0 +1,238 @@
+'''Report output: node and VM status, placement plans and packing
+summaries, as a human readable table (the traditional output), JSON,
+JSON lines or CSV.
+
+Every record is a flat dict with a "type" (node, vm, placement,
+summary or failure) and is written out as soon as it is made, so a big
+cluster streams through without being held in memory; JSON output is
+one array written record by record.  Free text (progress messages and the like)
+only appears in table output; other formats send it to the log.
+
+quiet leaves out the node, VM and placement records, and keeps the
+summaries and failure scenarios.'''
+
+import sys
+import csv
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('table', 'json', 'jsonl', 'csv')
+
+# CSV columns: every field any record type has, blank where it has none
+COLUMNS = ['type', 'strategy', 'node', 'vmid', 'name', 'status', 'cpu', 'maxcpu', 'mem_gb', 'maxmem_gb',
+           'score', 'placed', 'unplaced', 'nodes_used', 'nodes_total', 'nodes_bound', 'gap', 'local_moves',
+           'failed', 'displaced', 'stranded', 'short_mem_gb', 'short_cpu', 'stranded_vms']
+
+DETAIL = ('node', 'vm', 'placement')
+
+
+def dashes(count, dash='-'):
+    return dash*count
+
+
+def node_header():
+    from Node import Node
+    return Node.fmt.format(name=dashes(25), cpu=dashes(3), maxcpu=dashes(2), cpu_perc=dashes(2),
+                           maxmem=dashes(3), mem_perc=dashes(2), score=dashes(15))
+
+
+def node_line(node):
+    '''Table line for a node'''
+    from Node import Node
+    return Node.fmt.format(
+        name     = node.id,
+        cpu      = '{:>02.1f}'.format(node.cpu),
+        maxcpu   = '{:>2}'.format(node.maxcpu),
+        cpu_perc = '{:>2.0f}'.format(float( float(node.cpu)/float(node.maxcpu)*100)),
+        maxmem   = '{:>3.0f}'.format(int(node.maxmem_gb)),
+        mem_perc = '{:>2.0f}'.format(float( float(node.mem)/float(node.maxmem)*100)),
+        score    = node.score_str(full=True),
+    )
+
+
+def vm_line(vm):
+    '''Table line for a VM'''
+    from VM import VM
+    return VM.fmt.format(
+        vmid     = vm.vmid,
+        name     = vm.name,
+        state    = ' ' if vm.status == 'running' else '*',
+        cpu      = '{:>03.1f}'.format(vm.cpu),
+        maxcpu   = '{:>2}'.format(vm.maxcpu),
+        node     = '{:8}'.format(vm.node),
+        cpu_perc = '{:>2.0f}'.format(float( float(vm.cpu)/float(vm.maxcpu)*100)),
+        maxmem   = '{:>3.0f}'.format(vm.maxmem_gb),
+        score    = vm.score_str(full=True),
+    )
+
+
+def summary_lines(row):
+    '''Table lines for a packing summary'''
+
+    total = row['placed'] + row['unplaced']
+    lines = ["Packed {}/{} nodes. ({:.0f}%)".format(row['placed'], total, 100*row['placed']/total if total else 100)]
+
+    if row.get('nodes_bound') is not None:
+        if row['unplaced']:
+            # the bound is for placing everything
+            lines.append("Nodes used {}, lower bound {} for all VMs".format(row['nodes_used'], row['nodes_bound']))
+        else:
+            lines.append("Nodes used {}, lower bound {} (gap {:.0f}%)".format(
+                row['nodes_used'], row['nodes_bound'], 100*row['gap']))
+    if row.get('local_moves'):
+        lines.append("Moves copying local disks: {}".format(row['local_moves']))
+    return lines
+
+
+FAILURE_FMT = '{failed:30} {displaced:>9} {stranded:>8} {short_mem:>10} {short_cpu:>9}  {names}'
+
+
+def failure_header():
+    return FAILURE_FMT.format(failed='failed nodes', displaced='displaced', stranded='stranded',
+                              short_mem='short(GB)', short_cpu='short(cpu)', names='')
+
+
+def failure_line(row):
+    '''Table line for a failure scenario'''
+    return FAILURE_FMT.format(
+        failed    = row['failed'],
+        displaced = row['displaced'],
+        stranded  = row['stranded'],
+        short_mem = '{:.1f}'.format(row['short_mem_gb']),
+        short_cpu = '{:.4g}'.format(row['short_cpu']),
+        names     = row['stranded_vms'],
+    )
+
+
+class ReportWriter:
+    '''Writes report records to a file (default stdout) in one format.'''
+
+    def __init__(self, fmt='table', output=None, quiet=False):
+
+        if fmt not in FORMATS:
+            raise ValueError("Unknown report format {} (expected one of {})".format(fmt, ', '.join(FORMATS)))
+
+        self.fmt = fmt
+        self.quiet = quiet
+        self.fp = open(output, 'w', newline='') if output and output != '-' else sys.stdout
+        self.count = 0
+        self.headers = set()
+
+        self.csv = None
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(self.fp, fieldnames=COLUMNS, extrasaction='ignore')
+            self.csv.writeheader()
+        elif fmt == 'json':
+            self.fp.write('[')
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def write(self, kind, row, lines=None):
+        '''Write one record; lines is its table form'''
+
+        if self.quiet and kind in DETAIL:
+            return
+
+        if self.fmt == 'table':
+            for line in lines or []:
+                self.fp.write(line + '\n')
+            return
+
+        record = dict({'type': kind}, **row)
+        if self.fmt == 'csv':
+            self.csv.writerow(record)
+        elif self.fmt == 'jsonl':
+            self.fp.write(json.dumps(record) + '\n')
+        else:
+            self.fp.write((',\n' if self.count else '\n') + json.dumps(record))
+        self.count += 1
+
+
+    def message(self, text):
+        '''Free text: printed in table output, logged otherwise'''
+        if self.fmt == 'table':
+            if not self.quiet:
+                self.fp.write(text + '\n')
+        else:
+            log.info(text)
+
+
+    def nodes(self, nodes):
+        '''Status of each node'''
+        for node in nodes:
+            lines = [node_line(node)]
+            if 'node' not in self.headers:
+                self.headers.add('node')
+                lines.insert(0, node_header())
+            self.write('node', node.row(), lines)
+
+
+    def vms(self, vms):
+        '''Status of each VM'''
+        for vm in vms:
+            self.write('vm', vm.row(), [vm_line(vm)])
+
+
+    def placement(self, strategy, nodes):
+        '''The plan: which VMs each node ends up with'''
+        if self.quiet:
+            return
+        for node in sorted(nodes):
+            if self.fmt == 'table':
+                self.fp.write(node.name + '\n')
+            for vm in sorted(node.allocated_vms):
+                self.write('placement', {'strategy': strategy, 'node': node.name, 'vmid': vm.vmid, 'name': vm.name},
+                           ['  {}'.format(vm)])
+
+
+    def summary(self, strategy, nodes, placed, unplaced, bound=None, **extra):
+        '''How a packing came out.  extra fields go into the record
+        (and not the table).'''
+
+        import bounds
+
+        used = bounds.nodes_used(nodes)
+        row = {
+            'strategy': strategy,
+            'placed': placed,
+            'unplaced': unplaced,
+            'nodes_used': used,
+            'nodes_total': len(nodes),
+            'nodes_bound': bound,
+            'gap': bounds.gap(used, bound) if bound is not None and not unplaced else None,
+        }
+        row.update(extra)
+        self.write('summary', row, summary_lines(row))
+
+
+    def failure(self, result):
+        '''One failure scenario (a failure.scenario() result)'''
+        row = {
+            'failed': ','.join(result['failed']),
+            'displaced': result['displaced'],
+            'stranded': len(result['stranded']),
+            'short_mem_gb': round(result['short_mem_gb'], 3),
+            'short_cpu': result['short_cpu'],
+            'stranded_vms': ' '.join(result['stranded']),
+        }
+        lines = [failure_line(row)]
+        if 'failure' not in self.headers:
+            self.headers.add('failure')
+            lines.insert(0, failure_header())
+        self.write('failure', row, lines)
+
+
+    def close(self):
+        if self.fmt == 'json':
+            self.fp.write('\n]\n')
+        self.fp.flush()
+        if self.fp is not sys.stdout:
+            self.fp.close()
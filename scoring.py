@@ -0,0 +1,124 @@
+'''Numeric scores for nodes and VMs.
+
+Scores are plain floats, built from weighted components (a dict of
+cpu/mem/net/disk/bias parts), using Node.weight and VM.weight.  They
+are cached on each object, keyed by mode and weights, so changing the
+weights (as sweep.py does) never serves a stale value.  Node.allocate()
+and deallocate() drop a node's cache, as do VM.set_usage() and
+VM.set_rates() for a VM.  A VM doesn't know its host's Node object, so
+the 'usage' node mode, which sums what the allocated VMs use, is never
+cached and always reflects their current figures.
+
+Turning scores into text is format_parts()' job, for the show()
+tables only.'''
+
+# Node modes:
+#   total/node  measured utilisation of the node itself (cpu, mem)
+#   allocated   share of the node handed out to its allocated VMs,
+#               which is what packing moves around
+#   usage       projected utilisation: what its allocated VMs use
+
+NODE_MODES = ('total', 'node', 'allocated', 'usage')
+
+# Modes that depend on the VMs' own figures, which can change without
+# the node hearing about it
+UNCACHED_MODES = ('usage',)
+
+
+def weights_key(weight):
+    return tuple(sorted(weight.items()))
+
+
+def node_parts(node, mode='total', biased=True, weight=None):
+    '''Weighted score components for a node'''
+
+    from Node import Node
+    weight = weight or Node.weight
+
+    parts = {
+        'cpu': 0.0,
+        'mem': 0.0,
+        'net': 0.0,
+        'disk': 0.0,
+        'vm': 0.0,
+        'bias': node.bias if biased else 0.0,
+    }
+
+    if mode in ['total', 'node']:
+        # metrics we care about
+        parts['cpu'] = node.cpu/node.maxcpu * weight['cpu']
+        parts['mem'] = node.mem/node.maxmem * weight['mem']
+
+    elif mode == 'allocated':
+        parts['cpu'] = (node.maxcpu - node.freecpu)/node.maxcpu * weight['cpu']
+        parts['mem'] = (node.maxmem - node.freemem)/node.maxmem * weight['mem']
+
+    elif mode == 'usage':
+        cpu = sum(vm.cpu * vm.maxcpu for vm in node.allocated_vms)
+        mem = sum(vm.mem for vm in node.allocated_vms)
+        parts['cpu'] = cpu/node.maxcpu * weight['cpu']
+        parts['mem'] = mem/node.maxmem * weight['mem']
+
+    else:
+        raise NotImplementedError("Unknown node score mode {}".format(mode))
+
+    return parts
+
+
+def vm_parts(vm, biased=True, weight=None):
+    '''Weighted score components for a VM'''
+
+    from VM import VM
+    weight = weight or VM.weight
+
+    return {
+        'cpu':  vm.cpu                          * weight['cpu'],
+        'mem':  vm.maxmem_gb                    * weight['mem'],
+        'net':  vm.net_rate/2**20               * weight['net'],    # MB/sec
+        'disk': vm.disk_rate/2**20              * weight['disk'],   # MB/sec
+        'bias': vm.bias if biased else 0.0,
+    }
+
+
+def cached(obj, key, compute):
+    '''Look key up in obj's score cache, computing it if missing'''
+    cache = obj.__dict__.setdefault('score_cache', {})
+    value = cache.get(key)
+    if value is None:
+        parts = compute()
+        value = cache[key] = (sum(parts.values()), parts)
+    return value
+
+
+def node_score(node, mode='total', biased=True):
+    '''(score, parts) for a node, cached unless the mode is in UNCACHED_MODES'''
+    from Node import Node
+    weight = Node.weight
+    if mode in UNCACHED_MODES:
+        parts = node_parts(node, mode, biased, weight)
+        return sum(parts.values()), parts
+    key = (mode, biased, weights_key(weight))
+    return cached(node, key, lambda: node_parts(node, mode, biased, weight))
+
+
+def score_nodes(nodes, mode='total', biased=True):
+    '''Scores for a whole list of nodes at once.  Returns a list of floats.'''
+    return [node_score(node, mode, biased)[0] for node in nodes]
+
+
+def score_vms(vms, biased=True):
+    '''Scores for a whole list of VMs at once.  Returns a list of floats.'''
+    from VM import VM
+    weight = VM.weight
+    key = (biased, weights_key(weight))
+    return [cached(vm, key, lambda v=vm: vm_parts(v, biased, weight))[0] for vm in vms]
+
+
+def invalidate(obj):
+    '''Forget obj's cached scores; call whenever its inputs change.'''
+    obj.__dict__.pop('score_cache', None)
+
+
+def format_parts(score, parts, fmt='{: 6.3f} = {: 5.3f} + {: 5.3f} + {:3.1f}'):
+    '''Display form of a score and its main components'''
+    return fmt.format(score, parts['cpu'], parts['mem'], parts['bias'])
@@ -0,0 +1,213 @@
+'''Storage awareness for packing: which nodes can reach a VM's disks,
+and how much local disk space each node has for VMs that bring local
+disks with them.
+
+A StorageMap holds, per node, the storages it has (shared or local,
+free space), and per VM, the storages its disks live on and their sizes.
+It is collected from the API (nodes/{node}/storage and each VM's config)
+or loaded from a JSON dump of the same (dump_resources.py writes one):
+
+    {
+        "nodes": {"pve1": {"ceph": {"shared": true, "active": true, "avail": ..., "total": ...},
+                           "local-lvm": {"shared": false, "active": true, "avail": ..., "total": ...}}},
+        "vms":   {"113": [["ceph", 34359738368], ["local-lvm", 8589934592]]}
+    }
+
+Rules, per VM:
+  - a node must have every shared storage the VM's disks are on
+  - disks on local storage tie the VM to the node it's on now, unless
+    allow_local_migration is set; then the VM may go to any node with a
+    local storage of the same name and room for the disks
+  - VMs we know nothing about may go anywhere
+
+Install one with Node.storage = StorageMap(...), as for Node.feasibility.
+pack_setup() then binds a fresh StorageState to the nodes for each run,
+which Node.allows(), has_space() and allocate() consult.'''
+
+# As in constraints.py, every node gets a bit, and each VM's reachable
+# nodes are worked out once per run as a mask, so the check while packing
+# is a single AND.  Local disk space is a resource like memory: each node
+# starts with its free space plus what its own VMs' local disks use
+# (packing starts from empty nodes), and every VM placed takes its local
+# disks' sizes from the storages they are on.
+
+import re
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# config keys that hold disks (unusedN are detached, but still on storage)
+DISK_KEY_RE = re.compile(r'^(ide|sata|scsi|virtio|efidisk|tpmstate|unused|rootfs|mp)\d*$')
+SIZE_RE = re.compile(r'(?:^|,)size=(\d+(?:\.\d+)?)([KMGT]?)')
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_disks(config):
+    '''[(storage, size bytes)] for the disks in a VM config dict'''
+
+    disks = []
+    for key, value in config.items():
+        if not DISK_KEY_RE.match(key) or not isinstance(value, str) or ':' not in value:
+            continue
+        volume = value.split(',', 1)[0]
+        if volume == 'none' or volume.startswith('/'):
+            # empty drive, or a passed through device/path
+            continue
+        size = SIZE_RE.search(value)
+        if 'media=cdrom' in value:
+            size = None
+        disks.append((volume.split(':', 1)[0], int(float(size.group(1)) * UNITS[size.group(2)]) if size else 0))
+    return disks
+
+
+class StorageMap:
+    '''Storages per node, and disks per VM.'''
+
+    def __init__(self, nodes=None, vms=None, allow_local_migration=False):
+        self.nodes = nodes or {}
+        self.vms = {str(vmid): [tuple(disk) for disk in disks] for vmid, disks in (vms or {}).items()}
+        self.allow_local_migration = allow_local_migration
+
+
+    @classmethod
+    def load(cls, filename, allow_local_migration=False):
+        with open(filename) as fp:
+            data = json.load(fp)
+        return cls(data.get('nodes'), data.get('vms'), allow_local_migration=allow_local_migration)
+
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump({'nodes': self.nodes, 'vms': self.vms}, fp, sort_keys=True, indent=4)
+
+
+    @classmethod
+    def collect(cls, api, nodes, vms, workers=8, allow_local_migration=False):
+        '''Fetch node storages and VM disks through a PVEClient'''
+
+        def node_storage(node):
+            storages = {}
+            for entry in api.get('nodes/{}/storage'.format(node.name)):
+                storages[entry['storage']] = {
+                    'shared': bool(entry.get('shared')),
+                    'active': bool(entry.get('active', 1)),
+                    'avail': entry.get('avail', 0),
+                    'total': entry.get('total', 0),
+                }
+            return node.name, storages
+
+        def vm_disks(vm):
+            config = api.get('nodes/{}/{}/{}/config'.format(vm.node, getattr(vm, 'type', 'qemu'), vm.vmid))
+            return str(vm.vmid), parse_disks(config)
+
+        online = [node for node in nodes if node.status == 'online']
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            node_map = dict(pool.map(node_storage, online))
+            vm_map = dict(pool.map(vm_disks, [vm for vm in vms if vm.node in node_map]))
+
+        log.info("Collected storage for %d nodes, disks for %d VMs", len(node_map), len(vm_map))
+        return cls(node_map, vm_map, allow_local_migration=allow_local_migration)
+
+
+    def shared(self, node_name, storage):
+        '''Is storage shared, going by node_name's view (or anyone's)?'''
+        entry = self.nodes.get(node_name, {}).get(storage)
+        if entry is None:
+            entry = next((n[storage] for n in self.nodes.values() if storage in n), {'shared': False})
+        return entry['shared']
+
+
+    def has(self, node_name, storage):
+        entry = self.nodes.get(node_name, {}).get(storage)
+        return entry is not None and entry['active']
+
+
+    def bind(self, nodes, vms):
+        '''Fresh placement state for packing vms onto these nodes'''
+        return StorageState(self, nodes, vms)
+
+
+
+class StorageState:
+    '''Local disk space left per node during one packing run.'''
+
+    def __init__(self, storage_map, nodes, vms):
+
+        self.map = storage_map
+        self.nodes = nodes
+        self.bit = {node.name: 1 << index for index, node in enumerate(nodes)}
+        self.all_nodes = (1 << len(nodes)) - 1
+
+        # node -> local storage -> bytes free, with the node's own VMs' local disks handed back
+        self.free = {}
+        for name, storages in storage_map.nodes.items():
+            self.free[name] = {storage: entry['avail'] for storage, entry in storages.items() if not entry['shared']}
+        for vm in vms:
+            for storage, size in self.local_disks(vm):
+                if storage in self.free.get(vm.node, {}):
+                    self.free[vm.node][storage] += size
+
+        # vmid -> (reachable node mask, local disks)
+        self.vm_cache = {}
+
+
+    def local_disks(self, vm):
+        return [(storage, size) for storage, size in self.map.vms.get(str(vm.vmid), [])
+                if not self.map.shared(vm.node, storage)]
+
+
+    def vm_info(self, vm):
+        info = self.vm_cache.get(str(vm.vmid))
+        if info is None:
+            disks = self.map.vms.get(str(vm.vmid))
+            if disks is None:
+                info = (self.all_nodes, [])
+            else:
+                local = self.local_disks(vm)
+                needed = {storage for storage, size in disks}
+                mask = 0
+                for node in self.nodes:
+                    if not all(self.map.has(node.name, storage) for storage in needed):
+                        continue
+                    if local and node.name != vm.node and not self.map.allow_local_migration:
+                        continue
+                    mask |= self.bit[node.name]
+                info = (mask, local)
+            self.vm_cache[str(vm.vmid)] = info
+        return info
+
+
+    def allows(self, vm, node):
+        '''True if node can reach all of vm's disks'''
+        return bool(self.vm_info(vm)[0] & self.bit.get(node.name, 0))
+
+
+    def has_space(self, vm, node):
+        '''True if node's local storages have room for vm's local disks'''
+        free = self.free.get(node.name, {})
+        needed = {}
+        for storage, size in self.vm_info(vm)[1]:
+            needed[storage] = needed.get(storage, 0) + size
+        return all(free.get(storage, 0) >= size for storage, size in needed.items())
+
+
+    def place(self, vm, node):
+        free = self.free.setdefault(node.name, {})
+        for storage, size in self.vm_info(vm)[1]:
+            free[storage] = free.get(storage, 0) - size
+
+
+    def unplace(self, vm, node):
+        free = self.free.setdefault(node.name, {})
+        for storage, size in self.vm_info(vm)[1]:
+            free[storage] = free.get(storage, 0) + size
+
+
+    def local_moves(self, nodes):
+        '''(vm, from, to) for every VM on nodes that would need its local
+        disks copied: plans with these need allow_local_migration'''
+        return [(vm, vm.node, node.name) for node in nodes for vm in node.allocated_vms
+                if node.name != vm.node and self.vm_info(vm)[1]]
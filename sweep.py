@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+'''What-if capacity planning.  Packs a cluster dump under every
+combination of tuning knobs, hypothetical node changes and VM growth,
+and writes a table (or CSV) of how each combination came out.'''
+
+# Knobs swept:
+#   minfree CPU and memory reservations (Node.__init__)
+#   cpu/mem scoring weights (Node.weight / VM.weight, only matter for --key score)
+#   node variants: "+name:cpus:memGB[xcount]" adds nodes, "-name" removes one
+#   VM growth: 1.25 means 25% more VMs, cloned from the existing ones;
+#   0.8 means 20% fewer, dropped evenly through the list
+#   packing strategy and VM sort key
+#
+# Combinations run in a process pool.  Each worker memoises the node
+# and VM lists it builds, so combinations sharing a node setup or a
+# growth factor only build them once.
+
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import functools
+import itertools
+
+from concurrent.futures import ProcessPoolExecutor
+
+import packing
+import bounds
+from Node import Node
+from VM import VM
+
+log = logging.getLogger(__name__)
+
+# raw (node_list, vm_list) in each worker, see set_data()
+DATA = None
+
+COLUMNS = ['minfreecpu', 'minfreemem_perc', 'cpu_weight', 'mem_weight', 'variant', 'growth',
+           'strategy', 'key', 'vms_placed', 'vms_total', 'nodes_used', 'nodes_bound', 'nodes_total',
+           'headroom_mem_gb', 'headroom_cpu', 'seconds']
+
+
+def set_data(data):
+    global DATA    # pylint: disable=global-statement
+    DATA = data
+    # what was built from the old data is stale now
+    build_nodes.cache_clear()
+    build_vms.cache_clear()
+
+
+def parse_variant(variant):
+    '''Turn "+big:64:512x2,-pve3" into (additions, removals)'''
+
+    adds = []
+    removes = []
+    for change in filter(None, (variant or '').split(',')):
+        if change.startswith('-'):
+            removes.append(change[1:])
+        elif change.startswith('+'):
+            name, cpus, mem = change[1:].split(':')
+            count = 1
+            if 'x' in mem:
+                mem, count = mem.split('x')
+            for i in range(int(count)):
+                adds.append({
+                    'node': name if int(count) == 1 else '{}{}'.format(name, i+1),
+                    'id': 'node/{}'.format(name if int(count) == 1 else '{}{}'.format(name, i+1)),
+                    'status': 'online',
+                    'maxcpu': int(cpus),
+                    'maxmem': int(float(mem) * 2**30),
+                    'cpu': 0.0,
+                    'mem': 0,
+                })
+        else:
+            raise ValueError("Node change {} should start with + or -".format(change))
+    return adds, removes
+
+
+@functools.lru_cache(maxsize=None)
+def build_nodes(minfreecpu, minfreemem_perc, variant):
+    adds, removes = parse_variant(variant)
+    node_list = [n for n in DATA[0] if n['node'] not in removes] + adds
+    return [Node(data=n, minfreecpu=minfreecpu, minfreemem_perc=minfreemem_perc) for n in node_list]
+
+
+@functools.lru_cache(maxsize=None)
+def build_vms(growth):
+    if growth <= 0:
+        raise ValueError("VM growth factor must be more than 0, not {}".format(growth))
+
+    vm_list = list(DATA[1])
+
+    if growth < 1.0:
+        # shrink: keep VMs spread evenly through the list
+        keep = max(1, int(round(len(vm_list) * growth)))
+        vm_list = [vm_list[i * len(vm_list) // keep] for i in range(keep)]
+
+    # clone round robin through the existing VMs until we have enough
+    extra = int(round(len(vm_list) * (growth - 1.0)))
+    for i in range(max(0, extra)):
+        clone = dict(vm_list[i % len(DATA[1])])
+        clone['name'] = '{}+{}'.format(clone['name'], i // len(DATA[1]) + 1)
+        clone['vmid'] = 100000 + i
+        vm_list.append(clone)
+
+    return [VM(data=v) for v in vm_list]
+
+
+def evaluate(combo):
+    '''Pack one combination of knobs.  Runs in the worker pool.'''
+
+    minfreecpu, minfreemem_perc, cpu_weight, mem_weight, variant, growth, strategy, key = combo
+
+    nodes = build_nodes(minfreecpu, minfreemem_perc, variant)
+    vms = build_vms(growth)
+
+    # the weights are class attributes: put them back afterwards
+    node_weight, vm_weight = Node.weight, VM.weight
+    Node.weight = dict(node_weight, cpu=cpu_weight, mem=mem_weight)
+    VM.weight = dict(vm_weight, cpu=cpu_weight, mem=mem_weight)
+    try:
+        start = time.perf_counter()
+        packed, placed, unplaced = getattr(packing, strategy)(nodes, vms, key=key)
+        elapsed = time.perf_counter() - start
+    finally:
+        Node.weight, VM.weight = node_weight, vm_weight
+
+    return dict(zip(COLUMNS, combo + (
+        placed,
+        placed + unplaced,
+        bounds.nodes_used(packed),
+        bounds.lower_bound(nodes, vms),
+        len(packed),
+        round(sum(node.freemem - node.minfreemem for node in packed) / 2**30, 1),
+        sum(node.freecpu - node.minfreecpu for node in packed),
+        round(elapsed, 3),
+    )))
+
+
+def sweep(node_list, vm_list, minfreecpu=(1,), minfreemem_perc=(0.10,), cpu_weight=(1.0,), mem_weight=(1.0,),
+          variants=('',), growth=(1.0,), strategies=('pack_size',), keys=('area',), workers=None):
+    '''Evaluate every combination; returns a list of row dicts.'''
+
+    combos = list(itertools.product(minfreecpu, minfreemem_perc, cpu_weight, mem_weight,
+                                    variants, growth, strategies, keys))
+    log.info("Sweeping %d combinations", len(combos))
+
+    if workers == 1 or len(combos) < 4:
+        set_data((node_list, vm_list))
+        return [evaluate(combo) for combo in combos]
+
+    # run combos sharing a node setup and growth next to each other, so
+    # they tend to land in the same chunk and each worker's caches hit;
+    # results go back in the original order
+    order = sorted(range(len(combos)), key=lambda i: (combos[i][4], combos[i][5], combos[i][0], combos[i][1]))
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_data, initargs=((node_list, vm_list),)) as pool:
+        results = pool.map(evaluate, [combos[i] for i in order],
+                           chunksize=max(1, len(combos) // (4 * (workers or 4))))
+        rows = [None] * len(combos)
+        for index, row in zip(order, results):
+            rows[index] = row
+    return rows
+
+
+def floats(text):
+    return tuple(float(x) for x in text.split(','))
+
+
+def growth_factors(text):
+    values = floats(text)
+    if any(value <= 0 for value in values):
+        raise argparse.ArgumentTypeError("growth factors must be more than 0: {}".format(text))
+    return values
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('json_files', nargs=2, help="nodes.json and vms.json")
+    parser.add_argument('--minfreecpu', type=lambda t: tuple(int(x) for x in t.split(',')), default=(1,),
+                        help="Comma separated CPU reservations per node")
+    parser.add_argument('--minfreemem', type=floats, default=(0.10,), help="Comma separated memory reservations (fraction)")
+    parser.add_argument('--cpu-weight', type=floats, default=(1.0,), help="Comma separated cpu scoring weights")
+    parser.add_argument('--mem-weight', type=floats, default=(1.0,), help="Comma separated mem scoring weights")
+    parser.add_argument('--variant', action='append', default=[''],
+                        help="Node changes, e.g. '+big:64:512x2,-pve3' (repeatable; the unchanged cluster is always included)")
+    parser.add_argument('--growth', type=growth_factors, default=(1.0,),
+                        help="Comma separated VM count growth factors (below 1 drops VMs)")
+    parser.add_argument('--strategies', default='pack_size', help="Comma separated packing routines")
+    parser.add_argument('--keys', default='area', help="Comma separated VM sort keys")
+    parser.add_argument('--csv', metavar='FILE', help="Write results as CSV ('-' for stdout)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Worker processes")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)-15s [%(levelname)s] %(message)s', level=max(1, 30 - options.verbose * 10))
+
+    with open(options.json_files[0]) as fp:
+        node_list = json.load(fp)['data']
+    with open(options.json_files[1]) as fp:
+        vm_list = json.load(fp)['data']
+
+    rows = sweep(node_list, vm_list,
+                 minfreecpu=options.minfreecpu, minfreemem_perc=options.minfreemem,
+                 cpu_weight=options.cpu_weight, mem_weight=options.mem_weight,
+                 variants=options.variant, growth=options.growth,
+                 strategies=options.strategies.split(','), keys=options.keys.split(','),
+                 workers=options.jobs)
+
+    if options.csv:
+        fp = sys.stdout if options.csv == '-' else open(options.csv, 'w', newline='')
+        writer = csv.DictWriter(fp, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+        if fp is not sys.stdout:
+            fp.close()
+    else:
+        fmt = '{:>4} {:>5} {:>4} {:>4} {:20} {:>5} {:14} {:10} {:>9} {:>6} {:>5} {:>9} {:>9}'
+        print(fmt.format('cpu', 'mem%', 'cw', 'mw', 'variant', 'grow', 'strategy', 'key',
+                         'placed', 'nodes', 'bound', 'free(GB)', 'free(cpu)'))
+        for row in rows:
+            print(fmt.format(row['minfreecpu'], row['minfreemem_perc'], row['cpu_weight'], row['mem_weight'],
+                             row['variant'] or '-', row['growth'], row['strategy'], row['key'],
+                             '{}/{}'.format(row['vms_placed'], row['vms_total']),
+                             '{}/{}'.format(row['nodes_used'], row['nodes_total']), row['nodes_bound'],
+                             row['headroom_mem_gb'], row['headroom_cpu']))
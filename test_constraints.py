@@ -0,0 +1,107 @@
+'''Tests for the placement constraint engine (constraints.py) and how
+the packers use it.  Run with pytest.'''
+
+import packing
+from Node import Node
+from VM import VM
+from constraints import Constraints
+
+GB = 2**30
+
+
+def make_node(name, maxcpu=16, maxmem_gb=64, status='online'):
+    return Node(data={'node': name, 'id': 'node/' + name, 'status': status, 'maxcpu': maxcpu,
+                      'maxmem': maxmem_gb * GB, 'cpu': 0.0, 'mem': 0})
+
+
+def make_vm(vmid, name, node='n1', maxcpu=2, maxmem_gb=4):
+    return VM(data={'vmid': vmid, 'name': name, 'node': node, 'status': 'running', 'maxcpu': maxcpu,
+                    'maxmem': maxmem_gb * GB, 'cpu': 0.0, 'mem': 0, 'type': 'qemu', 'id': 'qemu/{}'.format(vmid)})
+
+
+def placement(nodes):
+    return {vm.name: node.name for node in nodes for vm in node.allocated_vms}
+
+
+def bound(nodes, groups, exclude_nodes=None):
+    '''Nodes (copies) with a fresh constraint state, as pack_setup does'''
+    packed, vms = packing.pack_setup(nodes, [], constraints=Constraints(groups=groups, exclude_nodes=exclude_nodes))
+    return {node.name: node for node in packed}
+
+
+def test_pin_and_exclude():
+    nodes = bound([make_node('n1'), make_node('n2'), make_node('n3')], [
+        {'name': 'pin', 'type': 'pin', 'vms': ['a'], 'nodes': ['n1', 'n2']},
+        {'name': 'ex', 'type': 'exclude', 'vms': [102], 'nodes': ['n1']},
+    ], exclude_nodes=['n3'])
+    a, b, c = make_vm(101, 'a'), make_vm(102, 'b'), make_vm(103, 'c')
+
+    assert [n for n in sorted(nodes) if nodes[n].allows(a)] == ['n1', 'n2']
+    # by vmid, and exclude_nodes applies to everyone
+    assert [n for n in sorted(nodes) if nodes[n].allows(b)] == ['n2']
+    assert [n for n in sorted(nodes) if nodes[n].allows(c)] == ['n1', 'n2']
+
+
+def test_anti_affinity_tracks_placements():
+    nodes = bound([make_node('n1'), make_node('n2')], [
+        {'name': 'aa', 'type': 'anti-affinity', 'vms': ['a', 'b']},
+    ])
+    a, b = make_vm(101, 'a'), make_vm(102, 'b')
+
+    assert nodes['n1'].allocate(a)
+    assert not nodes['n1'].allows(b)
+    assert nodes['n2'].allows(b)
+
+    # the bit clears again when the last member leaves
+    nodes['n1'].deallocate(a)
+    assert nodes['n1'].allows(b)
+
+
+def test_affinity_keeps_group_together():
+    nodes = bound([make_node('n1'), make_node('n2')], [
+        {'name': 'af', 'type': 'affinity', 'vms': ['a', 'b']},
+    ])
+    a, b = make_vm(101, 'a'), make_vm(102, 'b')
+
+    assert nodes['n2'].allows(a) and nodes['n1'].allows(a)
+    assert nodes['n2'].allocate(a)
+    assert not nodes['n1'].allows(b)
+    assert nodes['n2'].allows(b)
+
+
+def test_packers_honour_anti_affinity():
+    nodes = [make_node('n1'), make_node('n2'), make_node('n3')]
+    vms = [make_vm(100 + i, 'v{}'.format(i)) for i in range(3)]
+    constraints = Constraints(groups=[{'name': 'aa', 'type': 'anti-affinity', 'vms': ['v0', 'v1', 'v2']}])
+
+    packed, placed, unplaced = packing.pack_size(nodes, vms, constraints=constraints)
+
+    assert (placed, unplaced) == (3, 0)
+    assert len(set(placement(packed).values())) == 3
+    assert not packed[0].constraints.violations(packed)
+
+
+def test_partial_gang_is_released():
+    # room for one of the two big VMs only
+    nodes = [make_node('n1', maxcpu=16, maxmem_gb=64)]
+    vms = [make_vm(101, 'g1', maxmem_gb=40), make_vm(102, 'g2', maxmem_gb=40), make_vm(103, 'small')]
+    constraints = Constraints(groups=[{'name': 'gang', 'type': 'gang', 'vms': ['g1', 'g2']}])
+
+    packed, placed, unplaced = packing.pack_size(nodes, vms, constraints=constraints)
+
+    assert placement(packed) == {'small': 'n1'}
+    assert (placed, unplaced) == (1, 2)
+    assert packed[0].freemem == 60 * GB
+
+
+def test_current_placement_keeps_partial_gangs():
+    # pack_null describes what is running: a gang member on a node that
+    # isn't there doesn't take the others off theirs
+    nodes = [make_node('n1')]
+    vms = [make_vm(101, 'g1', node='n1'), make_vm(102, 'g2', node='gone')]
+    constraints = Constraints(groups=[{'name': 'gang', 'type': 'gang', 'vms': ['g1', 'g2']}])
+
+    packed, placed, unplaced = packing.pack_null(nodes, vms, constraints=constraints)
+
+    assert placement(packed) == {'g1': 'n1'}
+    assert (placed, unplaced) == (1, 1)
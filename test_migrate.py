@@ -0,0 +1,99 @@
+'''Tests for carrying out a placement plan (migrate.py), against the fake
+API server in fake_pve.py.  Run with pytest.'''
+
+import pytest
+
+import fake_pve
+import migrate
+from PVE import PVE
+
+GB = 2**30
+
+
+@pytest.fixture
+def cluster():
+    '''(fake server, PVE client) for three nodes with two small VMs each'''
+    node_list, vm_list = fake_pve.synthetic_cluster(num_nodes=3, num_vms=6, seed=1)
+    for vm in vm_list:
+        vm.update(maxcpu=1, maxmem=GB, status='running')
+    fake = fake_pve.FakePVE(node_list, vm_list, migrate_seconds=0.05).start()
+    P = PVE(host='127.0.0.1', u='monitoring@pve', pw='monitoring', **fake.client_options())
+    yield fake, P
+    P.api.close()
+    fake.stop()
+
+
+def executor(P, **options):
+    '''An Executor moving every VM on to the next node along'''
+    nodes = P.get_nodes(full=True)
+    vms = P.get_vms(full=True)
+    names = [node.name for node in nodes]
+    moves = [migrate.Move(vm, vm.node, names[(names.index(vm.node) + 1) % len(names)]) for vm in vms]
+    options = dict({'poll_interval': 0.01, 'refresh': 60.0}, **options)
+    return migrate.Executor(P, nodes, vms, moves, **options)
+
+
+def test_dry_run_leaves_the_cluster_alone(cluster):
+    fake, P = cluster
+    ex = executor(P)
+    requests = fake.requests
+
+    moves = ex.dry_run()
+
+    assert fake.requests == requests
+    assert not fake.tasks
+    assert all(move.status == migrate.DONE and move.wave for move in moves)
+    assert all(fake.vms[str(move.vm.vmid)]['node'] == move.source for move in moves)
+
+
+def test_run_moves_every_vm(cluster):
+    fake, P = cluster
+    ex = executor(P)
+
+    moves = ex.run()
+
+    assert [move.status for move in moves] == [migrate.DONE] * len(moves)
+    assert all(fake.vms[str(move.vm.vmid)]['node'] == move.target for move in moves)
+    assert all(move.vm.node == move.target for move in moves)
+
+
+def test_refused_migrations_fail_and_give_back_room(cluster, monkeypatch):
+    fake, P = cluster
+    ex = executor(P)
+    free = {name: list(room) for name, room in ex.ledger.free.items()}
+    monkeypatch.setattr(fake, 'migrate', lambda node, vmid, form: (503, None))
+
+    moves = ex.run()
+
+    assert [move.status for move in moves] == [migrate.FAILED] * len(moves)
+    assert all(move.error.startswith("can't start") and move.upid is None for move in moves)
+    assert ex.ledger.free == free
+    assert not ex.running
+
+
+def test_abort_lets_running_moves_finish(cluster):
+    fake, P = cluster
+    ex = executor(P, max_concurrent=1)
+    # abort as soon as the first move is done
+    ex.progress = lambda move, done, total: ex.abort()
+
+    moves = ex.run()
+
+    assert [move.status for move in moves] == [migrate.DONE] + [migrate.ABORTED] * (len(moves) - 1)
+    assert len(fake.tasks) == 1
+
+
+def test_abort_puts_back_moves_never_started(cluster):
+    # a run cut short after startable() chose moves, before start() was called
+    fake, P = cluster
+    ex = executor(P)
+    free = {name: list(room) for name, room in ex.ledger.free.items()}
+    chosen = ex.startable()
+    assert chosen and all(move.status == migrate.RUNNING for move in chosen)
+
+    ex.abort()
+    moves = ex.run()
+
+    assert all(move.status == migrate.ABORTED for move in moves)
+    assert ex.ledger.free == free
+    assert not fake.tasks
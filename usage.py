@@ -0,0 +1,194 @@
+'''Size VMs by historical usage instead of the instantaneous sample
+from cluster/resources.  Each VM's rrddata is reduced to a percentile
+(p50/p95/p99...) with a streaming estimator, and the results are cached
+per VM for a while, since the history only changes slowly.'''
+
+# The P^2 algorithm (Jain & Chlamtac, 1985) keeps five markers per
+# quantile and adjusts them as observations stream past, so memory
+# is constant no matter how many rrd points we feed it.
+
+import os
+import json
+import time
+import logging
+
+from cachedir import cache_dir
+
+log = logging.getLogger(__name__)
+
+
+class P2Quantile:
+    '''Streaming, bounded-memory estimate of a single quantile.'''
+
+    def __init__(self, percentile):
+        if not 0 < percentile < 100:
+            raise ValueError("percentile must be between 0 and 100, not {}".format(percentile))
+
+        self.p = percentile / 100.0
+        self.count = 0
+
+        # marker heights, actual positions, desired positions and
+        # the increments of the desired positions
+        self.q = []
+        self.n = [0, 1, 2, 3, 4]
+        self.np = [0, 2*self.p, 4*self.p, 2 + 2*self.p, 4]
+        self.dn = [0, self.p/2, self.p, (1+self.p)/2, 1]
+
+
+    def add(self, x):
+        '''Feed one observation to the estimator.'''
+
+        self.count += 1
+
+        if self.count <= 5:
+            self.q.append(x)
+            self.q.sort()
+            return
+
+        q = self.q
+        n = self.n
+
+        # find the cell the observation lands in, extending the
+        # extreme markers if needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k+1]:
+                k += 1
+
+        for i in range(k+1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+
+        # adjust the three middle markers
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = self._parabolic(i, d)
+                if not q[i-1] < qp < q[i+1]:
+                    qp = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+
+    def _parabolic(self, i, d):
+        q = self.q
+        n = self.n
+        return q[i] + d / (n[i+1] - n[i-1]) * (
+            (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+            (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+
+
+    def value(self):
+        '''Current estimate, or None if nothing has been seen yet.'''
+
+        if not self.count:
+            return None
+
+        if self.count <= 5:
+            # too few points for the markers; use the exact answer
+            index = int(round(self.p * (self.count - 1)))
+            return self.q[index]
+
+        return self.q[2]
+
+
+
+class UsageCache:
+    '''Per-VM percentile results stored on disk with a TTL.'''
+
+    def __init__(self, filename=None, ttl=3600):
+        self.filename = filename or os.path.join(cache_dir(), 'usage.json')
+        self.ttl = ttl
+        self.entries = {}
+        self.dirty = False
+
+        try:
+            with open(self.filename) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = {}
+
+
+    def get(self, key):
+        '''Return the cached value for key, unless it has expired.'''
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['value']
+
+
+    def put(self, key, value):
+        self.entries[key] = {'time': time.time(), 'value': value}
+        self.dirty = True
+
+
+    def save(self):
+        '''Write the cache back out, dropping expired entries.'''
+        if not self.dirty:
+            return
+
+        now = time.time()
+        self.entries = {k: e for k, e in self.entries.items() if now - e['time'] <= self.ttl}
+
+        tmp = '{}.{}'.format(self.filename, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp, self.filename)
+        self.dirty = False
+
+
+
+def percentiles(points, percentile, fields=('cpu', 'mem')):
+    '''Reduce a list of rrddata points to the given percentile for
+    each field.  Points with missing values (the rrd has gaps) are skipped.'''
+
+    estimators = {field: P2Quantile(percentile) for field in fields}
+
+    for point in points:
+        for field, estimator in estimators.items():
+            value = point.get(field)
+            if value is not None:
+                estimator.add(float(value))
+
+    return {field: estimator.value() for field, estimator in estimators.items()}
+
+
+
+def size_vms(pve, vms, percentile=95, timeframe='week', cf='AVERAGE', cache=None):
+    '''Resize each VM's cpu/mem usage to a percentile of its rrddata history.
+    VMs with no usable history keep their instantaneous sample.'''
+
+    if cache is None:
+        cache = UsageCache()
+
+    for vm in vms:
+        key = '{}:{}:{}:p{:g}'.format(vm.id, timeframe, cf, percentile)
+        usage = cache.get(key)
+
+        if usage is None:
+            try:
+                points = pve.get_rrddata(vm, timeframe=timeframe, cf=cf)
+            except Exception as e:    # pylint: disable=broad-except
+                log.warning("Unable to fetch rrddata for %s: %s", vm.name, e)
+                continue
+
+            usage = percentiles(points, percentile)
+            cache.put(key, usage)
+
+        if usage['cpu'] is None or usage['mem'] is None:
+            log.info("No usage history for %s, keeping current sample.", vm.name)
+            continue
+
+        log.debug("%s sized at p%g: cpu %.3f->%.3f mem %.1fG->%.1fG", vm.name, percentile,
+                  vm.cpu, usage['cpu'], vm.mem_gb, usage['mem']/2**30)
+        vm.set_usage(usage['cpu'], usage['mem'], sizing='p{:g}'.format(percentile))
+
+    cache.save()